@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Brain Execution Server Queue Processor
+Runs the processor against a scratch queue and reports timings
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Add the parent directory to the path so we can import server
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server
+
+
+def scratch_queue():
+    """Create a throwaway queue and point the server module at it"""
+    base = Path(tempfile.mkdtemp(prefix='brain-bench-'))
+    server.set_queue_base(base)
+    server.PENDING_DIR.mkdir(parents=True)
+    return base
+
+
+@contextlib.contextmanager
+def running_processor(engine=server.QueueProcessor, **kwargs):
+    """Run a QueueProcessor in a background thread for the duration of a block"""
+    processor = engine(**kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        thread = threading.Thread(target=processor.run, daemon=True)
+        thread.start()
+        while processor.watcher is None:
+            time.sleep(0.001)
+        try:
+            yield processor
+        finally:
+            processor.stop()
+            thread.join(10)
+
+
+def submit(name, job):
+    """Write a job file into pending/"""
+    with open(server.PENDING_DIR / name, 'w') as f:
+        json.dump(job, f)
+
+
+def wait_for(path, timeout=30):
+    """Busy-wait until a path exists"""
+    deadline = time.perf_counter() + timeout
+    while not path.exists():
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"{path} never appeared")
+        time.sleep(0.0005)
+
+
+def summarize(label, samples, unit='ms', scale=1000):
+    """Print min/median/max for a list of samples in seconds"""
+    print(f"   {label:<12} min {min(samples) * scale:8.1f}{unit}"
+          f"   median {statistics.median(samples) * scale:8.1f}{unit}"
+          f"   max {max(samples) * scale:8.1f}{unit}")
+
+
+def bench_watcher(args):
+    """Submit-to-result latency for the poll loop versus the inotify watcher"""
+    print("⏱  Watcher latency (submit → result file)")
+    for backend in ['poll', 'inotify']:
+        base = scratch_queue()
+        samples = []
+        try:
+            with running_processor(watcher=backend) as processor:
+                if processor.watcher.name != backend:
+                    samples = None
+                    continue
+                for i in range(args.jobs):
+                    # Stagger submissions so they do not line up with the poll interval
+                    time.sleep(0.05 + (i % 7) * 0.1)
+                    start = time.perf_counter()
+                    submit(f'latency_{i}.json', {"command": "true"})
+                    wait_for(server.COMPLETED_DIR / f'latency_{i}.json')
+                    samples.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(base)
+        if samples:
+            summarize(backend, samples)
+        else:
+            print(f"   {backend:<12} unavailable on this platform")
+
+
+def wait_for_count(path, count, timeout=120):
+    """Busy-wait until a directory holds count entries"""
+    deadline = time.perf_counter() + timeout
+    while len(os.listdir(path)) < count:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"{path} never reached {count} entries")
+        time.sleep(0.001)
+
+
+def bench_workers(args):
+    """Throughput of sleep-bound jobs as the worker count grows"""
+    jobs = max(args.jobs, 16)
+    print(f"👷 Worker pool throughput ({jobs} × sleep 0.2s jobs)")
+    baseline = None
+    for workers in [1, 2, 4, 8]:
+        base = scratch_queue()
+        try:
+            for i in range(jobs):
+                submit(f'sleep_{i:04d}.json', {"command": "sleep", "args": ["0.2"]})
+            start = time.perf_counter()
+            with running_processor(workers=workers):
+                wait_for_count(server.COMPLETED_DIR, jobs)
+                elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(base)
+        rate = jobs / elapsed
+        baseline = baseline or rate
+        print(f"   {workers} worker(s)   {rate:7.1f} jobs/s   speedup {rate / baseline:4.1f}x")
+
+
+def count_fs_events(dirs):
+    """Start counting filesystem events in the queue directories (None without inotify)"""
+    try:
+        watcher = server.InotifyWatcher()
+    except (OSError, AttributeError):
+        return None
+    for path in dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        watcher.add_dir(path)
+    return watcher
+
+
+def drain_fs_events(watcher):
+    """Stop counting and return the number of events seen"""
+    if watcher is None:
+        return None
+    count = 0
+    while True:
+        events = watcher.wait(0.05)
+        if not events:
+            break
+        count += len(events)
+    watcher.close()
+    return count
+
+
+def bench_batch(args):
+    """Per-file jobs versus one JSONL batch for many small commands"""
+    jobs = max(args.jobs, 500)
+    print(f"📦 Batch submission ({jobs} × true)")
+    for mode in ['files', 'batch']:
+        base = scratch_queue()
+        try:
+            watcher = count_fs_events([server.PENDING_DIR, server.RUNNING_DIR,
+                                       server.COMPLETED_DIR, server.FAILED_DIR])
+            start = time.perf_counter()
+            with running_processor(workers=1):
+                if mode == 'files':
+                    for i in range(jobs):
+                        submit(f'small_{i:05d}.json', {"command": "true"})
+                    wait_for_count(server.COMPLETED_DIR, jobs)
+                else:
+                    with open(server.PENDING_DIR / 'small.jsonl', 'w') as f:
+                        for i in range(jobs):
+                            f.write(json.dumps({"command": "true"}) + '\n')
+                    wait_for(server.COMPLETED_DIR / 'small_results.jsonl')
+                elapsed = time.perf_counter() - start
+            events = drain_fs_events(watcher)
+        finally:
+            shutil.rmtree(base)
+        files = 'n/a' if events is None else events
+        print(f"   {mode:<6} {elapsed:7.2f}s   {jobs / elapsed:7.1f} jobs/s   fs events {files}")
+
+
+def bench_logging(args):
+    """Per-job logging cost of synchronous open/append/close versus the background writer"""
+    jobs = max(args.jobs, 2000)
+    print(f"📝 Logging overhead ({jobs} jobs × 4 lines)")
+    for mode in ['sync', 'threaded']:
+        base = scratch_queue()
+        try:
+            writer = server.LogWriter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                if mode == 'threaded':
+                    writer.start()
+                start = time.perf_counter()
+                for i in range(jobs):
+                    writer.write(f"Processing JSON job: job_{i}.json")
+                    writer.write("Executing: true")
+                    writer.write(f"Job job_{i}.json completed", job=f'job_{i}.json',
+                                 status='completed', returncode=0, duration=0.001)
+                    writer.write(f"Saved results to completed/job_{i}.json")
+                caller = time.perf_counter() - start
+                writer.stop()
+                total = time.perf_counter() - start
+        finally:
+            shutil.rmtree(base)
+        print(f"   {mode:<9} {caller / jobs * 1e6:7.1f}µs/job in caller"
+              f"   {total / jobs * 1e6:7.1f}µs/job until flushed")
+
+
+def bench_warm(args):
+    """python3 -c jobs on a fresh interpreter (plain Popen) versus the warm pool"""
+    jobs = max(args.jobs, 100)
+    code = "import json, datetime, pathlib; print(json.dumps({'ok': True}))"
+    print(f"🐍 Python job startup ({jobs} × python3 -c)")
+    for runner in ['subprocess', 'python-warm']:
+        base = scratch_queue()
+        try:
+            job = {"command": "python3", "args": ["-c", code]}
+            if runner == 'python-warm':
+                job['runner'] = runner
+            for i in range(jobs):
+                submit(f'py_{i:04d}.json', job)
+            start = time.perf_counter()
+            with running_processor(workers=1):
+                wait_for_count(server.COMPLETED_DIR, jobs)
+                elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(base)
+        print(f"   {runner:<12} {elapsed / jobs * 1000:7.1f}ms/job   {jobs / elapsed:7.1f} jobs/s")
+
+
+def bench_engines(args):
+    """Many concurrent short jobs on worker threads versus the asyncio event loop"""
+    jobs = max(args.jobs, 200)
+    print(f"🔀 Execution engines ({jobs} × sleep 0.05s jobs, 64 slots)")
+    for engine in [server.QueueProcessor, server.AsyncQueueProcessor]:
+        base = scratch_queue()
+        try:
+            for i in range(jobs):
+                submit(f'short_{i:04d}.json', {"command": "sleep", "args": ["0.05"]})
+            start = time.perf_counter()
+            peak = 0
+            with running_processor(engine=engine, workers=64):
+                while len(os.listdir(server.COMPLETED_DIR)) < jobs:
+                    peak = max(peak, threading.active_count())
+                    time.sleep(0.001)
+                elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(base)
+        print(f"   {engine.engine:<12} {jobs / elapsed:7.1f} jobs/s   peak {peak} threads")
+
+
+def bench_api(args):
+    """Submit-to-result round trip: writing pending/ and polling completed/ versus the job API"""
+    jobs = args.jobs
+    print(f"🔌 Job API round trip ({jobs} × echo, one at a time)")
+    base = scratch_queue()
+    try:
+        with running_processor(api=True):
+            wait_for(server.API_SOCKET)
+            timings = {'files': [], 'api': []}
+            for i in range(jobs):
+                # The caller's side of integration_test.py, at a tighter 0.1s poll
+                start = time.perf_counter()
+                submit(f'poll_{i:04d}.json', {"command": "echo", "args": ["hi"]})
+                while not (server.COMPLETED_DIR / f'poll_{i:04d}.json').exists():
+                    time.sleep(0.1)
+                timings['files'].append(time.perf_counter() - start)
+                
+                start = time.perf_counter()
+                replies = list(server.api_call({'op': 'submit', 'wait': True,
+                                                'job': {"command": "echo", "args": ["hi"]}}))
+                assert replies[-1]['status'] == 'completed'
+                timings['api'].append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(base)
+    for mode, samples in timings.items():
+        print(f"   {mode:<12} median {statistics.median(samples) * 1000:7.1f}ms")
+
+
+def bench_schedule(args):
+    """Tick-to-start latency: a cron-style file drop into pending/ versus an in-process schedule"""
+    ticks = max(args.jobs, 20)
+    print(f"⏰ Scheduled jobs ({ticks} ticks every 0.05s)")
+    for mode, watcher in [('files', 'poll'), ('files', 'auto'), ('schedule', 'auto')]:
+        base = scratch_queue()
+        try:
+            server.SCHEDULES_DIR.mkdir()
+            with running_processor(api=False, watcher=watcher):
+                if mode == 'files':
+                    for i in range(ticks):
+                        submit(f'tick_{i:04d}.json', {"command": "true", "ticked_at": time.time()})
+                        time.sleep(0.05)
+                else:
+                    with open(server.SCHEDULES_DIR / 'tick.json', 'w') as f:
+                        json.dump({"every": 0.05, "command": "true"}, f)
+                wait_for_count(server.COMPLETED_DIR, ticks)
+            latencies = []
+            for path in sorted(server.COMPLETED_DIR.iterdir())[:ticks]:
+                with open(path) as f:
+                    data = json.load(f)
+                if mode == 'files':
+                    ticked = data['ticked_at']
+                else:
+                    # Run names carry the planned tick time
+                    stamp = path.stem.split('_', 1)[1]
+                    ticked = datetime.strptime(stamp + '000', '%Y%m%d_%H%M%S_%f').timestamp()
+                latencies.append(data['result']['timing']['started_at'] - ticked)
+        finally:
+            shutil.rmtree(base)
+        print(f"   {mode:<8} {watcher:<5} median {statistics.median(latencies) * 1000:7.2f}ms   "
+              f"max {max(latencies) * 1000:7.2f}ms")
+
+
+def bench_results(args):
+    """Result write and read cost of one JSON file per job versus the segmented log store"""
+    count = max(args.jobs * 400, 2000)
+    print(f"🗄️  Result stores ({count} results)")
+    result = {"command": "echo", "args": ["hi"],
+              "result": {"status": "completed", "returncode": 0, "stdout": "hi\n", "stderr": ""}}
+    for backend in ['files', 'log']:
+        base = scratch_queue()
+        try:
+            server.COMPLETED_DIR.mkdir()
+            store = server.make_result_store(backend)
+            paths = [server.COMPLETED_DIR / f'job_{i:06d}.json' for i in range(count)]
+            start = time.perf_counter()
+            for path in paths:
+                store.write(path, result)
+            written = time.perf_counter() - start
+            start = time.perf_counter()
+            for path in paths:
+                store.read(path)
+            read = time.perf_counter() - start
+            store.close()
+            files = sum(len(names) for _, _, names in os.walk(base))
+        finally:
+            shutil.rmtree(base)
+        print(f"   {backend:<6} write {written / count * 1e6:7.1f}µs   read {read / count * 1e6:7.1f}µs   "
+              f"files {files}")
+
+
+def bench_nodes(args):
+    """Throughput of several single-worker nodes sharing one queue through shard leases"""
+    jobs = max(args.jobs * 8, 40)
+    print(f"🔗 Nodes sharing a queue ({jobs} × sleep 0.05, one worker per node)")
+    lease_timeout, server.LEASE_TIMEOUT = server.LEASE_TIMEOUT, 1
+    try:
+        for count in (1, 2, 4):
+            base = scratch_queue()
+            try:
+                with contextlib.ExitStack() as stack:
+                    nodes = [stack.enter_context(running_processor(node=f'node{i}', workers=1, api=False,
+                                                                   archive=False))
+                             for i in range(count)]
+                    # Let the nodes settle on an even split of the shards
+                    while sum(len(node.leases.held) for node in nodes) != server.SHARDS or \
+                            max(len(node.leases.held) for node in nodes) > -(-server.SHARDS // count):
+                        time.sleep(0.05)
+                    start = time.perf_counter()
+                    for i in range(jobs):
+                        submit(f'job_{i:04d}.json', {"command": "sleep", "args": ["0.05"]})
+                    wait_for_count(server.COMPLETED_DIR, jobs)
+                    elapsed = time.perf_counter() - start
+            finally:
+                shutil.rmtree(base)
+            print(f"   {count} node(s) {elapsed:6.2f}s   {jobs / elapsed:6.1f} jobs/s")
+    finally:
+        server.LEASE_TIMEOUT = lease_timeout
+
+
+def bench_admission(args):
+    """A probe job's latency behind a runaway producer, without and with a pending limit"""
+    flood = max(args.jobs * 40, 200)
+    print(f"🚧 Admission control ({flood} queued jobs, then one probe)")
+    max_pending = server.MAX_PENDING
+    for limit in (0, flood // 10):
+        base = scratch_queue()
+        server.MAX_PENDING = limit
+        try:
+            with running_processor(api=False, workers=4) as processor:
+                for i in range(flood):
+                    submit(f'flood_{i:05d}.json', {"command": "true"})
+                # Let the watcher admit or refuse the whole flood before the probe arrives
+                while len(processor.meta) + len(processor.timing) + processor.admission.rejected + \
+                        len(list(server.COMPLETED_DIR.glob('flood_*.json'))) < flood:
+                    time.sleep(0.01)
+                start = time.perf_counter()
+                submit('probe.json', {"command": "true"})
+                wait_for(server.COMPLETED_DIR / 'probe.json', timeout=300)
+                latency = time.perf_counter() - start
+                rejected = len(list(server.REJECTED_DIR.glob('*.json'))) if server.REJECTED_DIR.exists() else 0
+        finally:
+            server.MAX_PENDING = max_pending
+            shutil.rmtree(base)
+        label = f"limit {limit}" if limit else 'no limit'
+        print(f"   {label:<12} probe latency {latency * 1000:8.1f}ms   rejected {rejected}")
+
+
+def bench_coalesce(args):
+    """Time to answer a burst of identical slow jobs, each run versus coalesced into one"""
+    burst = max(args.jobs * 4, 20)
+    print(f"🔗 Coalescing ({burst} identical sleep 0.2s jobs, 2 workers)")
+    for coalesce in (False, True):
+        base = scratch_queue()
+        try:
+            with running_processor(api=False, workers=2):
+                start = time.perf_counter()
+                for i in range(burst):
+                    submit(f'sync_{i:03d}.json', {"command": "sleep", "args": ["0.2"], "coalesce": coalesce})
+                wait_for_count(server.COMPLETED_DIR, burst)
+                elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(base)
+        label = 'coalesced' if coalesce else 'each run'
+        print(f"   {label:<12} {elapsed * 1000:8.1f}ms   {burst / elapsed:6.1f} results/s")
+
+
+def bench_spawn(args):
+    """Text jobs exec'd through /bin/sh versus directly, with and without close_fds"""
+    jobs = max(args.jobs * 40, 200)
+    print(f"🚀 Spawn path ({jobs} × uname text jobs, 4 workers)")
+    close_fds_default = server.SPAWN_CLOSE_FDS
+    # The trailing ';' is shell syntax, so that line still goes through /bin/sh
+    for label, line, close_fds in [('sh -c', 'uname;', True), ('direct', 'uname', True),
+                                   ('no close', 'uname', False)]:
+        base = scratch_queue()
+        try:
+            for i in range(jobs):
+                (server.PENDING_DIR / f'spawn_{i:04d}.txt').write_text(line)
+            server.SPAWN_CLOSE_FDS = close_fds
+            start = time.perf_counter()
+            with running_processor(api=False, archive=False, workers=4):
+                wait_for_count(server.COMPLETED_DIR, jobs)
+                elapsed = time.perf_counter() - start
+        finally:
+            server.SPAWN_CLOSE_FDS = close_fds_default
+            shutil.rmtree(base)
+        print(f"   {label:<12} {elapsed / jobs * 1000:7.2f}ms/job   {jobs / elapsed:7.1f} jobs/s")
+
+
+BENCHMARKS = {
+    'watcher': bench_watcher,
+    'workers': bench_workers,
+    'batch': bench_batch,
+    'logging': bench_logging,
+    'warm': bench_warm,
+    'engines': bench_engines,
+    'api': bench_api,
+    'schedule': bench_schedule,
+    'results': bench_results,
+    'nodes': bench_nodes,
+    'admission': bench_admission,
+    'coalesce': bench_coalesce,
+    'spawn': bench_spawn,
+}
+
+
+def main():
+    """Run the selected benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmarks', nargs='*',
+                        help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--jobs', type=int, default=5, help='jobs per measurement')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(sorted(unknown))}")
+    
+    print("🏁 Brain Execution Server Benchmarks")
+    print("=" * 50)
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,6 +15,12 @@ PENDING_DIR = QUEUE_BASE / 'pending'
 COMPLETED_DIR = QUEUE_BASE / 'completed'
 FAILED_DIR = QUEUE_BASE / 'failed'
 
+def submit_job(job_file, content):
+    """Write a job as the server expects: to a dot-prefixed temp file, then renamed into place"""
+    tmp = job_file.with_name(f'.{job_file.name}.tmp')
+    tmp.write_text(content)
+    tmp.rename(job_file)
+
 def test_service_running():
     """Check if the service is running"""
     print("1. Checking if service is running...")
@@ -40,8 +46,7 @@ def test_simple_job():
     job_file = PENDING_DIR / 'integration_test_echo.json'
     
     # Write job
-    with open(job_file, 'w') as f:
-        json.dump(job_data, f)
+    submit_job(job_file, json.dumps(job_data))
     print(f"   Created job: {job_file}")
     
     # Wait for processing
@@ -81,8 +86,7 @@ def test_python_job():
     job_file = PENDING_DIR / 'integration_test_python.json'
     
     # Write job
-    with open(job_file, 'w') as f:
-        json.dump(job_data, f)
+    submit_job(job_file, json.dumps(job_data))
     print(f"   Created job: {job_file}")
     
     # Wait for processing
@@ -116,8 +120,7 @@ def test_text_job():
     job_file = PENDING_DIR / 'integration_test_text.txt'
     
     # Write job
-    with open(job_file, 'w') as f:
-        f.write('echo "Text job works!" && date')
+    submit_job(job_file, 'echo "Text job works!" && date')
     print(f"   Created job: {job_file}")
     
     # Wait for processing
@@ -156,8 +159,7 @@ def test_failing_job():
     job_file = PENDING_DIR / 'integration_test_fail.json'
     
     # Write job
-    with open(job_file, 'w') as f:
-        json.dump(job_data, f)
+    submit_job(job_file, json.dumps(job_data))
     print(f"   Created failing job: {job_file}")
     
     # Wait for processing
@@ -4,16 +4,45 @@ Queue Processor for Brain MCP Execution Server
 Monitors the command queue and executes pending jobs
 """
 
+import argparse
+import asyncio
+import codecs
+import concurrent.futures
+import contextlib
+import errno
 import json
+import mmap
 import subprocess
 import sys
 import os
 import time
 import shutil
 import traceback
+import types
+import collections
+import gzip
+import hashlib
+import heapq
+import http.server
+import io
+import queue
+import re
+import resource
+import runpy
+import ctypes
+import ctypes.util
+import select
+import selectors
+import shlex
+import socket
+import socketserver
+import struct
+import tempfile
+import uuid
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 import signal
+import sqlite3
 import threading
 
 # Queue directories
@@ -21,260 +50,4990 @@ QUEUE_BASE = Path('/Users/bard/mcp/memory_files/command_queue')
 PENDING_DIR = QUEUE_BASE / 'pending'
 COMPLETED_DIR = QUEUE_BASE / 'completed'
 FAILED_DIR = QUEUE_BASE / 'failed'
+RUNNING_DIR = QUEUE_BASE / 'running'
+REJECTED_DIR = QUEUE_BASE / 'rejected'
+QUEUE_STATUS = QUEUE_BASE / 'queue_status.json'
+CACHE_DIR = QUEUE_BASE / 'cache'
+JOB_DB = QUEUE_BASE / 'jobs.db'
+ARCHIVE_DIR = QUEUE_BASE / 'archive'
+RESULTS_DIR = QUEUE_BASE / 'results'
+SCHEDULES_DIR = QUEUE_BASE / 'schedules'
+SCHEDULE_STATE = QUEUE_BASE / 'schedule_state.json'
+LEASES_DIR = QUEUE_BASE / 'leases'
+NODES_DIR = QUEUE_BASE / 'nodes'
 LOG_FILE = QUEUE_BASE / 'daemon.log'
+API_SOCKET = QUEUE_BASE / 'exec.sock'
+
+# Output capture: the head of each stream is embedded in the result JSON and
+# anything longer is spooled to a file next to it, capped at OUTPUT_MAX_BYTES
+OUTPUT_PREVIEW_BYTES = int(os.environ.get('BRAIN_EXEC_PREVIEW_BYTES', 64 * 1024))
+OUTPUT_MAX_BYTES = int(os.environ.get('BRAIN_EXEC_MAX_OUTPUT_BYTES', 100 * 1024 * 1024))
+OUTPUT_CHUNK = 64 * 1024
+JOB_SUFFIXES = ('.json', '.jsonl', '.txt', '.sh')
+SPOOL_SUFFIXES = ('.stdout', '.stderr', '.progress')
+
+# Live progress: a job still running after PROGRESS_INTERVAL seconds gets a
+# running/<job>.progress record, rewritten at that interval, and its output is
+# spooled from the first byte so tails can be read by offset while it runs
+PROGRESS_INTERVAL = float(os.environ.get('BRAIN_EXEC_PROGRESS_INTERVAL', 1))
+PROGRESS_MARKER = b'##progress'
+PROGRESS_LINE_MAX = 1024
+TAIL_MAX_BYTES = 1024 * 1024
+
+# Scheduling lanes: higher priority runs first, sources share a lane round-robin
+PRIORITY_NAMES = {'low': -10, 'normal': 0, 'high': 10}
+DEFAULT_SOURCE = 'default'
+TEXT_JOB_PRIORITY = int(os.environ.get('BRAIN_EXEC_TEXT_PRIORITY', 0))
+TEXT_JOB_SOURCE = 'text'
+
+# Admission control: once the queued jobs reach MAX_PENDING, their files reach
+# MAX_PENDING_BYTES, or one source has MAX_PENDING_PER_SOURCE queued (0 turns a
+# limit off), new jobs are moved to rejected/ with a reason (API submissions are
+# refused with a retry_after) until that figure drops to ADMIT_RESUME of its limit.
+# Depth is published to QUEUE_STATUS at most every STATUS_INTERVAL seconds.
+MAX_PENDING = int(os.environ.get('BRAIN_EXEC_MAX_PENDING', 10000))
+MAX_PENDING_BYTES = int(os.environ.get('BRAIN_EXEC_MAX_PENDING_BYTES', 256 * 1024 * 1024))
+MAX_PENDING_PER_SOURCE = int(os.environ.get('BRAIN_EXEC_MAX_PENDING_PER_SOURCE', 0))
+ADMIT_RESUME = float(os.environ.get('BRAIN_EXEC_ADMIT_RESUME', 0.8))
+ADMIT_RETRY_AFTER = 5  # seconds suggested before the server has seen any job finish
+STATUS_INTERVAL = 0.5
+
+# Result cache for jobs marked cacheable: size-bounded LRU, entries expire after
+# cache_ttl seconds (CACHE_TTL by default); CACHE_ENV_VARS always feed the key
+CACHE_MAX_BYTES = int(os.environ.get('BRAIN_EXEC_CACHE_BYTES', 64 * 1024 * 1024))
+CACHE_TTL = int(os.environ.get('BRAIN_EXEC_CACHE_TTL', 3600))
+CACHE_ENV_VARS = ['PATH']
+
+# Retention: files in completed/ and failed/ older than RETENTION_AGE seconds, or
+# beyond the newest RETENTION_COUNT in each, are rolled into gzip archive segments
+RETENTION_AGE = float(os.environ.get('BRAIN_EXEC_RETENTION_AGE', 7 * 86400))
+RETENTION_COUNT = int(os.environ.get('BRAIN_EXEC_RETENTION_COUNT', 10000))
+ARCHIVE_INTERVAL = 300  # seconds between retention passes
+ARCHIVE_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Result store: 'files' writes one pretty-printed JSON file per job into completed/
+# or failed/; 'log' appends compact records to results/segment-NNNNNN.log (rolled
+# at RESULT_SEGMENT_BYTES) and only writes per-job files when they are materialised
+RESULT_STORE = os.environ.get('BRAIN_EXEC_RESULT_STORE', 'files')
+RESULT_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Resource limits: the keys a job's `limits` may set and the rlimit behind each.
+# Text jobs get TEXT_JOB_LIMITS (JSON in BRAIN_EXEC_TEXT_LIMITS). With CGROUP_ROOT
+# pointing at a delegated cgroup v2 directory, memory and process limits are
+# enforced by a per-job child cgroup instead of rlimits. There is no rlimit for
+# processes (RLIMIT_NPROC counts every process of the user), so that limit needs
+# the cgroup's pids.max.
+LIMIT_RESOURCES = {
+    'cpu_seconds': resource.RLIMIT_CPU,
+    'memory_bytes': resource.RLIMIT_AS,
+    'file_size_bytes': resource.RLIMIT_FSIZE,
+    'processes': None,
+    'open_files': resource.RLIMIT_NOFILE,
+}
+TEXT_JOB_LIMITS = json.loads(os.environ.get('BRAIN_EXEC_TEXT_LIMITS', '{}'))
+CGROUP_ROOT = os.environ.get('BRAIN_EXEC_CGROUP')
+
+# Timeouts: jobs without a `timeout` field get JOB_TIMEOUT seconds. A job past
+# its timeout (or still running at shutdown) has its whole process group sent
+# SIGTERM, then SIGKILL after KILL_GRACE seconds.
+JOB_TIMEOUT = float(os.environ.get('BRAIN_EXEC_TIMEOUT', 300))
+KILL_GRACE = float(os.environ.get('BRAIN_EXEC_KILL_GRACE', 5))
+
+# Spawning: children get stdin from /dev/null unless the job sets `stdin`.
+# No preexec_fn is ever passed, so CPython spawns with vfork instead of fork, and
+# nothing runs in a forked copy of the threaded server. The server's own descriptors are all close-on-exec, so SPAWN_CLOSE_FDS=0
+# skips closing every other descriptor in the child, which is slow where there
+# is no close_range (macOS with a high open-file limit).
+SPAWN_CLOSE_FDS = os.environ.get('BRAIN_EXEC_CLOSE_FDS', '1') != '0'
+# Text jobs skip /bin/sh when the line uses none of its syntax and starts with a
+# program on PATH rather than a builtin, whose behaviour can differ from the binary
+SHELL_SYNTAX = re.compile(r'[|&;<>()$`\\*?\[\]{}~#!\n]')
+SHELL_BUILTINS = frozenset([
+    'alias', 'bg', 'break', 'cd', 'command', 'continue', 'echo', 'eval', 'exec', 'exit', 'export',
+    'false', 'fc', 'fg', 'getopts', 'hash', 'jobs', 'kill', 'printf', 'pwd', 'read', 'readonly',
+    'return', 'set', 'shift', 'source', 'test', 'times', 'trap', 'true', 'type', 'ulimit', 'umask',
+    'unalias', 'unset', 'wait', '.', ':', '[',
+])
+
+# Warm Python pool for `"runner": "python-warm"` jobs: WARM_WORKERS interpreters
+# with WARM_PRELOAD imported, pre-forked at start-up and kept idle, each retired
+# (and replaced) after WARM_MAX_JOBS jobs or once its peak RSS passes WARM_MAX_RSS bytes
+WARM_WORKERS = int(os.environ.get('BRAIN_EXEC_WARM_WORKERS', 2))
+WARM_PRELOAD = [name for name in os.environ.get(
+    'BRAIN_EXEC_WARM_PRELOAD',
+    'json,os,re,sys,time,pathlib,collections,datetime,subprocess,urllib.request').split(',') if name]
+WARM_MAX_JOBS = int(os.environ.get('BRAIN_EXEC_WARM_MAX_JOBS', 100))
+WARM_MAX_RSS = int(os.environ.get('BRAIN_EXEC_WARM_MAX_RSS', 512 * 1024 * 1024))
+
+# Crash recovery: a job found in running/ at startup was cut off by a dead server.
+# It is requeued until it has been interrupted `retry` times (RECOVERY_RETRIES for
+# jobs without the field; true retries forever), then failed. Result files are
+# fsynced before being renamed into place unless BRAIN_EXEC_FSYNC=0.
+RECOVERY_RETRIES = int(os.environ.get('BRAIN_EXEC_RECOVERY_RETRIES', 1))
+FSYNC_RESULTS = os.environ.get('BRAIN_EXEC_FSYNC', '1') != '0'
+
+# Retries: a failed JSON job with `retries` left goes back to pending/ with a
+# `retry_at` time, doubling its `backoff` (RETRY_BACKOFF seconds by default) after
+# every attempt up to RETRY_MAX_BACKOFF; it waits in an in-memory timer heap
+RETRY_BACKOFF = float(os.environ.get('BRAIN_EXEC_RETRY_BACKOFF', 1))
+RETRY_MAX_BACKOFF = float(os.environ.get('BRAIN_EXEC_RETRY_MAX_BACKOFF', 300))
+
+# Schedules: each schedules/<name>.json is a JSON job plus a `schedule` (cron
+# expression, local time) or `every` (seconds) field; runs are queued in memory
+# and the last run of each schedule is kept in SCHEDULE_STATE across restarts
+SCHEDULE_FIELDS = ('schedule', 'every', 'overlap', 'catch_up')
+SCHEDULE_SOURCE = 'schedule'
+CRON_MACROS = {
+    '@yearly': '0 0 1 1 *', '@annually': '0 0 1 1 *', '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0', '@daily': '0 0 * * *', '@midnight': '0 0 * * *', '@hourly': '0 * * * *',
+}
+CRON_FIELDS = [
+    ('minute', 0, 59, None),
+    ('hour', 0, 23, None),
+    ('day of month', 1, 31, None),
+    ('month', 1, 12, ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']),
+    ('day of week', 0, 7, ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']),
+]
+
+# Number of jobs executed concurrently by the server
+WORKERS = int(os.environ.get('BRAIN_EXEC_WORKERS', os.cpu_count() or 1))
+
+# Execution engine: a worker thread per concurrent job, or one asyncio event loop
+ENGINE = os.environ.get('BRAIN_EXEC_ENGINE', 'threads')
+
+# Nodes: servers sharing one queue root each run with a distinct NODE name. Jobs
+# are hash-partitioned into pending/<shard>/ (SHARDS of them, the same on every
+# node); a node leases an even share of shards in leases/, heartbeats nodes/<node>.json
+# every LEASE_TIMEOUT / 3 seconds, and the leases and running/<node>/ jobs of a
+# node silent for LEASE_TIMEOUT seconds are taken over by the others
+NODE = os.environ.get('BRAIN_EXEC_NODE')
+SHARDS = int(os.environ.get('BRAIN_EXEC_SHARDS', 16))
+LEASE_TIMEOUT = float(os.environ.get('BRAIN_EXEC_LEASE_TIMEOUT', 30))
+
+# Pending directory watcher: 'auto' uses inotify where available, else polls
+WATCHER_BACKEND = os.environ.get('BRAIN_EXEC_WATCHER', 'auto')
+POLL_INTERVAL = 2  # seconds between directory scans for the poll watcher
+
+# Logging: daemon.log rotates to daemon.log.1 .. daemon.log.N once it reaches
+# LOG_MAX_BYTES; LOG_FORMAT 'json' writes one JSON object per line with job fields
+LOG_MAX_BYTES = int(os.environ.get('BRAIN_EXEC_LOG_BYTES', 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get('BRAIN_EXEC_LOG_BACKUPS', 3))
+LOG_FORMAT = os.environ.get('BRAIN_EXEC_LOG_FORMAT', 'text')
+
+# Metrics: served in the Prometheus text format at http://127.0.0.1:<port>/metrics
+# when METRICS_PORT is set (0 disables the endpoint)
+METRICS_PORT = int(os.environ.get('BRAIN_EXEC_METRICS_PORT', 0))
+METRICS_HOST = '127.0.0.1'
+
+# Local API: newline-delimited JSON requests on API_SOCKET to submit jobs and
+# wait for or stream their results (BRAIN_EXEC_API=0 turns it off)
+API_ENABLED = os.environ.get('BRAIN_EXEC_API', '1') != '0'
+
+
+def set_queue_base(base):
+    """Point all queue paths at a different base directory"""
+    global QUEUE_BASE, PENDING_DIR, COMPLETED_DIR, FAILED_DIR, RUNNING_DIR, CACHE_DIR, JOB_DB
+    global REJECTED_DIR, QUEUE_STATUS
+    global ARCHIVE_DIR, RESULTS_DIR, SCHEDULES_DIR, SCHEDULE_STATE, LEASES_DIR, NODES_DIR
+    global LOG_FILE, API_SOCKET
+    QUEUE_BASE = Path(base)
+    PENDING_DIR = QUEUE_BASE / 'pending'
+    COMPLETED_DIR = QUEUE_BASE / 'completed'
+    FAILED_DIR = QUEUE_BASE / 'failed'
+    RUNNING_DIR = QUEUE_BASE / 'running'
+    REJECTED_DIR = QUEUE_BASE / 'rejected'
+    QUEUE_STATUS = QUEUE_BASE / 'queue_status.json'
+    CACHE_DIR = QUEUE_BASE / 'cache'
+    JOB_DB = QUEUE_BASE / 'jobs.db'
+    ARCHIVE_DIR = QUEUE_BASE / 'archive'
+    RESULTS_DIR = QUEUE_BASE / 'results'
+    SCHEDULES_DIR = QUEUE_BASE / 'schedules'
+    SCHEDULE_STATE = QUEUE_BASE / 'schedule_state.json'
+    LEASES_DIR = QUEUE_BASE / 'leases'
+    NODES_DIR = QUEUE_BASE / 'nodes'
+    LOG_FILE = QUEUE_BASE / 'daemon.log'
+    API_SOCKET = QUEUE_BASE / 'exec.sock'
+
+
+class PollWatcher:
+    """Fallback watcher that rescans the watched directories on an interval"""
+    name = 'poll'
+
+    def __init__(self, interval=None):
+        self.interval = POLL_INTERVAL if interval is None else interval
+        self.dirs = {}
+        self.last_scan = time.monotonic()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+
+    def _list(self, path):
+        """Return the set of regular file names in a directory"""
+        try:
+            with os.scandir(path) as entries:
+                return {e.name for e in entries if e.is_file()}
+        except FileNotFoundError:
+            return set()
+
+    def add_dir(self, path):
+        """Start watching a directory and return the files already in it"""
+        names = self._list(path)
+        self.dirs[Path(path)] = names
+        return sorted(names)
+
+    def remove_dir(self, path):
+        """Stop watching a directory"""
+        self.dirs.pop(Path(path), None)
+
+    def wake(self):
+        """Interrupt a blocking wait() from another thread or a signal handler"""
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    def _sleep(self, timeout):
+        """Sleep up to timeout seconds, returning early if woken"""
+        r, _, _ = select.select([self._wake_r], [], [], max(timeout, 0))
+        if r:
+            os.read(self._wake_r, 4096)
+            return True
+        return False
+
+    def wait(self, timeout=None):
+        """Wait for changes and return a list of (event, path) tuples"""
+        due = self.interval - (time.monotonic() - self.last_scan)
+        if timeout is not None and timeout < due:
+            self._sleep(timeout)
+            return []
+        if self._sleep(due):
+            return []
+        
+        # Diff each directory against the previous scan
+        self.last_scan = time.monotonic()
+        events = []
+        for path, known in list(self.dirs.items()):
+            current = self._list(path)
+            events.extend(('added', path / n) for n in sorted(current - known))
+            events.extend(('removed', path / n) for n in known - current)
+            self.dirs[path] = current
+        return events
+
+    def close(self):
+        """Release the wake pipe"""
+        for fd in (self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class InotifyWatcher(PollWatcher):
+    """Linux watcher that wakes as soon as a job file is closed or moved in"""
+    name = 'inotify'
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        super().__init__()
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_dir(self, path):
+        """Start watching a directory and return the files already in it"""
+        path = Path(path)
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(path)), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch failed: {os.strerror(err)}", str(path))
+        self.watches[wd] = path
+        # List after adding the watch so nothing slips through the gap
+        return sorted(self._list(path))
+
+    def remove_dir(self, path):
+        """Stop watching a directory"""
+        for wd, watched in list(self.watches.items()):
+            if watched == Path(path):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def wait(self, timeout=None):
+        """Wait for changes and return a list of (event, path) tuples"""
+        r, _, _ = select.select([self.fd, self._wake_r], [], [], timeout)
+        if self._wake_r in r:
+            os.read(self._wake_r, 4096)
+        if self.fd not in r:
+            return []
+        
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    # Kernel dropped events; the caller must rescan
+                    events.append(('rescan', None))
+                    continue
+                if mask & self.IN_ISDIR or wd not in self.watches or not name:
+                    continue
+                path = self.watches[wd] / os.fsdecode(name)
+                if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    events.append(('added', path))
+                else:
+                    events.append(('removed', path))
+        return events
+
+    def rescan(self):
+        """Return every file currently present in the watched directories"""
+        return [path / n for path in list(self.watches.values()) for n in sorted(self._list(path))]
+
+    def close(self):
+        """Release the inotify descriptor and wake pipe"""
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        super().close()
+
+
+def make_watcher(backend=None):
+    """Create the configured pending directory watcher"""
+    backend = backend or WATCHER_BACKEND
+    if backend == 'poll':
+        return PollWatcher()
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        if backend == 'inotify':
+            raise
+        return PollWatcher()
+
+
+def parse_priority(value):
+    """Turn a job's priority field into an integer; higher runs first"""
+    if value is None:
+        return PRIORITY_NAMES['normal']
+    if isinstance(value, str) and value.lower() in PRIORITY_NAMES:
+        return PRIORITY_NAMES[value.lower()]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return PRIORITY_NAMES['normal']
+
+
+def job_meta(job_file):
+    """Read the scheduling fields of a pending job without running it"""
+    try:
+        size = job_file.stat().st_size
+    except OSError:
+        size = 0
+    if job_file.suffix == '.jsonl':
+        # Batches run in the default lane; their lines are not read until they run
+        return {'id': job_file.stem, 'priority': PRIORITY_NAMES['normal'],
+                'source': DEFAULT_SOURCE, 'depends_on': [], 'bytes': size}
+    if job_file.suffix != '.json':
+        return {'id': job_file.stem, 'priority': TEXT_JOB_PRIORITY,
+                'source': TEXT_JOB_SOURCE, 'depends_on': [], 'bytes': size}
+    try:
+        with open(job_file) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        # Unreadable jobs still run (and fail) in the default lane
+        data = {}
+    meta = json_job_meta(data, job_file.stem)
+    meta['bytes'] = size
+    return meta
+
+
+def json_job_meta(data, stem):
+    """Scheduling fields of a JSON job's parsed contents"""
+    if not isinstance(data, dict):
+        data = {}
+    depends_on = data.get('depends_on') or []
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    meta = {
+        'id': str(data.get('task_id') or stem),
+        'priority': parse_priority(data.get('priority')),
+        'source': str(data.get('source') or data.get('tool') or DEFAULT_SOURCE),
+        'depends_on': [str(parent) for parent in depends_on]
+    }
+    if isinstance(data.get('retry_at'), (int, float)):
+        meta['retry_at'] = data['retry_at']
+    key = dedupe_key(data)
+    if key:
+        meta['dedupe_key'] = key
+    return meta
+
+
+def job_type(job_file):
+    """Metrics label for a job file: json, text or batch (batch lines included)"""
+    if job_file.suffix in ('.txt', '.sh'):
+        return 'text'
+    return 'json' if job_file.suffix == '.json' else 'batch'
+
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+MAXRSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+
+def reap(process, timeout):
+    """Wait for a child with wait4 and return its CPU time and peak RSS"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped through Popen (e.g. poll() during shutdown)
+            process.wait()
+            return None
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return {
+                'user_cpu': round(usage.ru_utime, 6),
+                'system_cpu': round(usage.ru_stime, 6),
+                'max_rss_bytes': usage.ru_maxrss * MAXRSS_SCALE
+            }
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+def job_timeout(timeout):
+    """A job's timeout in seconds, or the server default"""
+    timeout = JOB_TIMEOUT if timeout is None else float(timeout)
+    if timeout <= 0:
+        raise ValueError(f"Invalid timeout: {timeout}")
+    return timeout
+
+
+def signal_group(process, signum):
+    """Send a signal to every process in a job's process group"""
+    try:
+        os.killpg(process.pid, signum)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def kill_group(process, grace):
+    """SIGTERM a job's process group, SIGKILL what is left after grace seconds, and reap the child"""
+    usage = None
+    signal_group(process, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        if process.returncode is None:
+            try:
+                usage = reap(process, 0)
+            except subprocess.TimeoutExpired:
+                pass
+        # Signal 0 only checks whether any member of the group is still alive
+        if process.returncode is not None and not signal_group(process, 0):
+            return usage
+        time.sleep(0.01)
+    signal_group(process, signal.SIGKILL)
+    if process.returncode is None:
+        usage = reap(process, None)
+    return usage
+
+
+def process_usage(pid):
+    """CPU seconds and resident memory of a live child, or None once it has exited"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the parenthesised command name, starting at the state (stat(5) field 3)
+            fields = f.read().rsplit(')', 1)[1].split()
+    except FileNotFoundError:
+        if os.path.exists('/proc/self/stat'):
+            return None
+        return ps_usage(pid)
+    except (OSError, IndexError):
+        return None
+    # utime and stime, plus those of the children it has already reaped
+    ticks = sum(int(value) for value in fields[11:15])
+    return {'cpu_seconds': round(ticks / os.sysconf('SC_CLK_TCK'), 3),
+            'rss_bytes': int(fields[21]) * os.sysconf('SC_PAGE_SIZE')}
+
+
+def ps_usage(pid):
+    """process_usage() through ps(1), for systems without /proc (macOS)"""
+    try:
+        out = subprocess.run(['ps', '-o', 'rss=,time=', '-p', str(pid)],
+                             capture_output=True, text=True, timeout=5).stdout.split()
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if len(out) != 2:
+        return None
+    # [[dd-]hh:]mm:ss[.cc]
+    days, _, clock = out[1].rpartition('-')
+    seconds = 0.0
+    for part in clock.split(':'):
+        seconds = seconds * 60 + float(part)
+    return {'cpu_seconds': round(seconds + int(days or 0) * 86400, 3), 'rss_bytes': int(out[0]) * 1024}
+
+
+def parse_progress(line):
+    """Parse '##progress 40%', '##progress 3/10' or '##progress 0.4', each optionally followed by a message"""
+    parts = line[len(PROGRESS_MARKER):].strip().split(None, 1)
+    if not parts:
+        return None
+    figure, message = parts[0], parts[1] if len(parts) > 1 else None
+    progress = {}
+    try:
+        if figure.endswith('%'):
+            percent = float(figure[:-1])
+        elif '/' in figure:
+            done, total = (float(n) for n in figure.split('/', 1))
+            progress.update((key, int(n) if n.is_integer() else n)
+                            for key, n in (('done', done), ('total', total)))
+            percent = done / total * 100 if total else 0.0
+        else:
+            percent = float(figure) * 100
+    except ValueError:
+        return None
+    progress['percent'] = round(min(max(percent, 0.0), 100.0), 2)
+    if message:
+        progress['message'] = message
+    progress['reported_at'] = round(time.time(), 6)
+    return progress
+
+
+def utf8_prefix(data):
+    """data without a UTF-8 sequence cut off at its end, so a tail can resume at that offset"""
+    for back in range(1, min(len(data), 4) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            # Continuation byte; keep looking for the start of the sequence
+            continue
+        length = 1 if byte < 0x80 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+        return data[:-back] if length > back else data
+    return data
+
+
+def finished_on_disk(job_id, results=None):
+    """Look for a result left by an earlier run of the job with this id"""
+    results = results or FileResultStore()
+    for dir, status in [(COMPLETED_DIR, 'completed'), (FAILED_DIR, 'failed')]:
+        for name in (f"{job_id}.json", f"{job_id}_result.json"):
+            if results.written_at(dir / name) is not None:
+                return status
+    return None
+
+
+def is_job_file(name):
+    """Whether a pending/ entry is a job rather than a submitter's half-written temp file"""
+    return not name.startswith('.') and not name.endswith('.tmp')
+
+
+def shard_of(name, shards=None):
+    """pending/ subdirectory a job file name hashes to when several nodes share the queue"""
+    # A stable digest, since hash() differs between processes
+    digest = hashlib.sha1(name.encode()).digest()
+    return f"{int.from_bytes(digest[:4], 'big') % (shards or SHARDS):02x}"
+
+
+def fsync_dir(path):
+    """Make renames into a directory durable"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, text, durable=True):
+    """Write a file via a temp file, fsync and rename, so it is never seen half written"""
+    path = Path(path)
+    durable = durable and FSYNC_RESULTS
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp, 'w') as f:
+            f.write(text)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    if durable:
+        fsync_dir(path.parent)
+
+
+def result_names(job_file):
+    """File names a job's result is written under in completed/ or failed/"""
+    if job_file.suffix == '.json':
+        return [job_file.name]
+    if job_file.suffix == '.jsonl':
+        return [f"{job_file.stem}_results.jsonl"]
+    return [f"{job_file.stem}_result.json"]
+
+
+def recovery_limit(job_file):
+    """How often an interrupted job may be requeued (None: always), from its retry field"""
+    value = RECOVERY_RETRIES
+    if job_file.suffix == '.json':
+        try:
+            with open(job_file) as f:
+                data = json.load(f)
+            if isinstance(data, dict) and 'retry' in data:
+                value = data['retry']
+        except (OSError, ValueError):
+            pass
+    if value is True:
+        return None
+    if value is False:
+        return 0
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return RECOVERY_RETRIES
+
+
+def attempt_record(result, number):
+    """Summary of one run of a job for its attempt history"""
+    record = {'attempt': number}
+    record.update((k, result[k]) for k in ('status', 'returncode', 'error', 'timed_out',
+                                           'duration', 'completed_at') if k in result)
+    return record
+
+
+def retry_wanted(data, result, attempts):
+    """Whether a JSON job's retry policy calls for another run after a failed attempt"""
+    try:
+        retries = int(data.get('retries') or 0)
+    except (TypeError, ValueError):
+        return False
+    if attempts > retries:
+        return False
+    retry_on = data.get('retry_on')
+    if retry_on is None:
+        return True
+    if not isinstance(retry_on, list):
+        retry_on = [retry_on]
+    if result.get('timed_out'):
+        return 'timeout' in retry_on
+    if 'returncode' in result:
+        return result['returncode'] in retry_on
+    # The command could not be run at all
+    return 'error' in retry_on
+
+
+def retry_delay(data, attempts):
+    """Seconds to wait before the next attempt: backoff doubled per failed attempt, capped"""
+    try:
+        backoff = float(data.get('backoff', RETRY_BACKOFF))
+    except (TypeError, ValueError):
+        backoff = RETRY_BACKOFF
+    return min(max(backoff, 0) * 2 ** (attempts - 1), RETRY_MAX_BACKOFF)
+
+
+def job_command(data):
+    """Extract the command to run from a JSON job: an argv list, or a string for /bin/sh"""
+    if 'argv' in data:
+        # Format: {"argv": ["python3", "-c", "print('a b')"]}
+        cmd = data['argv']
+    elif 'shell' in data:
+        # Format: {"shell": "ls *.log | wc -l"}
+        if not isinstance(data['shell'], str) or not data['shell'].strip():
+            raise ValueError("shell must be a command line")
+        return data['shell']
+    elif 'command' in data and 'args' in data:
+        # Format: {"command": "which", "args": ["node"]}
+        cmd = [data['command']] + data.get('args', [])
+    elif 'command' in data:
+        # Format: {"command": "python3 'my script.py'"}, split with shell quoting but run directly
+        cmd = data['command']
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+    else:
+        raise ValueError("No command found in job file")
+    if not isinstance(cmd, list) or not cmd or not all(isinstance(arg, str) for arg in cmd):
+        raise ValueError("argv must be a non-empty list of strings")
+    return cmd
+
+
+def spawn_options(data):
+    """A JSON job's cwd, env and stdin, checked; empty when it sets none of them"""
+    options = {}
+    if data.get('cwd') is not None:
+        if not isinstance(data['cwd'], str):
+            raise ValueError("cwd must be a path")
+        options['cwd'] = os.path.expanduser(data['cwd'])
+    if data.get('env') is not None:
+        env = data['env']
+        if not isinstance(env, dict) or not all(isinstance(value, (str, type(None)))
+                                                for value in env.values()):
+            raise ValueError("env must map names to strings (or null to unset)")
+        # Layered over the server's environment; null removes a variable
+        options['env'] = {name: value for name, value in dict(os.environ, **env).items()
+                          if value is not None}
+    if data.get('stdin') is not None:
+        if not isinstance(data['stdin'], str):
+            raise ValueError("stdin must be a string")
+        options['stdin'] = data['stdin']
+    return options
+
+
+def direct_argv(line):
+    """argv for a text job's command line that needs nothing from the shell, or None"""
+    if SHELL_SYNTAX.search(line):
+        return None
+    try:
+        argv = shlex.split(line)
+    except ValueError:
+        return None
+    if not argv or '=' in argv[0] or argv[0] in SHELL_BUILTINS or shutil.which(argv[0]) is None:
+        return None
+    return argv
+
+
+@contextlib.contextmanager
+def job_stdin(options):
+    """File to give a child as stdin: the job's stdin text, or /dev/null"""
+    if not options or 'stdin' not in options:
+        yield subprocess.DEVNULL
+        return
+    # A file rather than a pipe, so feeding it can never block on the child
+    with tempfile.TemporaryFile() as f:
+        f.write(options['stdin'].encode())
+        f.seek(0)
+        yield f
+
+
+def spawn_kwargs(options):
+    """Popen arguments both engines use for a job's child, besides its stdio"""
+    options = options or {}
+    return {
+        'cwd': options.get('cwd'),
+        'env': options.get('env'),
+        'close_fds': SPAWN_CLOSE_FDS,
+        # Its own session, so a timeout or shutdown can signal the whole tree
+        'start_new_session': True
+    }
+
+
+def dedupe_key(data):
+    """Key under which identical pending JSON jobs share one run, or None"""
+    if data.get('dedupe_key') is not None:
+        return str(data['dedupe_key'])
+    if not data.get('coalesce'):
+        return None
+    try:
+        cmd = job_command(data)
+    except (ValueError, TypeError):
+        return None
+    # "echo hi" and {"command": "echo", "args": ["hi"]} run the same argv
+    spec = [cmd] + [data.get(field) for field in ('cwd', 'env', 'stdin')]
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class QueueFull(Exception):
+    """An API submission refused by admission control"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def api_job_name(job_id):
+    """Job file name for an API job id: a bare id names a JSON job"""
+    name = str(job_id)
+    if not name or name != Path(name).name or name.startswith('.'):
+        raise ValueError(f"Invalid job id: {job_id!r}")
+    return name if Path(name).suffix in JOB_SUFFIXES else f"{name}.json"
+
+
+def cache_key(data, cmd):
+    """Fingerprint a cacheable job: command, cwd, env, stdin and input files"""
+    cwd = Path(os.getcwd()) / os.path.expanduser(data.get('cwd') or '.')
+    env_vars = sorted(set(CACHE_ENV_VARS) | set(data.get('cache_env', [])))
+    inputs = {}
+    for name in data.get('cache_inputs', []):
+        path = cwd / name
+        try:
+            if data.get('cache_hash_inputs'):
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(OUTPUT_CHUNK), b''):
+                        digest.update(block)
+                inputs[name] = digest.hexdigest()
+            else:
+                st = path.stat()
+                inputs[name] = [st.st_mtime_ns, st.st_size]
+        except OSError:
+            inputs[name] = None
+    fingerprint = {
+        'command': cmd,
+        'cwd': str(cwd),
+        'env': {name: os.environ.get(name) for name in env_vars},
+        'job_env': data.get('env'),
+        'stdin': data.get('stdin'),
+        'inputs': inputs
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """On-disk LRU store of result blocks for cacheable jobs, evicted by total size"""
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = Path(path or CACHE_DIR)
+        self.max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.entries = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        """Index existing entries, least recently used first"""
+        if self.entries is not None:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        files = sorted(self.path.glob('*.json'), key=lambda p: p.stat().st_mtime)
+        self.entries = collections.OrderedDict((p.stem, p.stat().st_size) for p in files)
+        self.size = sum(self.entries.values())
+
+    def _drop(self, key):
+        """Remove an entry from the index and disk"""
+        self.size -= self.entries.pop(key, 0)
+        try:
+            (self.path / f"{key}.json").unlink()
+        except FileNotFoundError:
+            pass
+
+    def get(self, key, ttl):
+        """Return a cached result block younger than ttl seconds, or None"""
+        with self.lock:
+            self._load()
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            path = self.path / f"{key}.json"
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is None or time.time() - entry['cached_at'] > ttl:
+                self._drop(key)
+                self.misses += 1
+                return None
+            # The file mtime doubles as the LRU clock across restarts
+            os.utime(path)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['result']
+
+    def put(self, key, result):
+        """Store a result block, evicting least recently used entries over the size cap"""
+        payload = json.dumps({'cached_at': time.time(), 'result': result}).encode()
+        with self.lock:
+            self._load()
+            self._drop(key)
+            tmp = self.path / f".{key}.tmp"
+            tmp.write_bytes(payload)
+            os.replace(tmp, self.path / f"{key}.json")
+            self.entries[key] = len(payload)
+            self.size += len(payload)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self._drop(next(iter(self.entries)))
+
+
+class JobIndex:
+    """SQLite (WAL mode) index of every job and its state transitions"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            task_id TEXT,
+            state TEXT NOT NULL,
+            submitted_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            returncode INTEGER,
+            duration REAL,
+            result_path TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_by_name ON jobs (name, id);
+        CREATE INDEX IF NOT EXISTS jobs_by_task ON jobs (task_id, id);
+        CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, finished_at);
+    """
+    OPEN_STATES = ('queued', 'waiting', 'delayed', 'running', 'coalesced')
+    # Seen in pending/ again in one of these, a job was admitted before (interrupted ones are requeued)
+    ADMITTED_STATES = OPEN_STATES + ('interrupted',)
+    COLUMNS = ('task_id', 'submitted_at', 'started_at', 'finished_at', 'returncode', 'result_path')
+
+    def __init__(self, path=None):
+        self.path = Path(path or JOB_DB)
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        """Open the database on first use"""
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(self.SCHEMA)
+        return self.conn
+
+    def update(self, name, state, **fields):
+        """Record a state change for the newest unfinished job with this name"""
+        unknown = set(fields) - set(self.COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job index fields: {', '.join(sorted(unknown))}")
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                row = conn.execute(
+                    f"SELECT id, started_at FROM jobs WHERE name = ? "
+                    f"AND state IN ({', '.join('?' * len(self.OPEN_STATES))}) "
+                    "ORDER BY id DESC LIMIT 1", (name,) + self.OPEN_STATES).fetchone()
+                if state not in self.OPEN_STATES and row and row['started_at'] and 'finished_at' in fields:
+                    fields['duration'] = fields['finished_at'] - row['started_at']
+                fields['state'] = state
+                if row is None:
+                    fields.setdefault('submitted_at', time.time())
+                    columns = ['name'] + list(fields)
+                    conn.execute(f"INSERT INTO jobs ({', '.join(columns)}) "
+                                 f"VALUES ({', '.join('?' * len(columns))})",
+                                 [name] + list(fields.values()))
+                else:
+                    assignments = ', '.join(f"{column} = ?" for column in fields)
+                    conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?",
+                                 list(fields.values()) + [row['id']])
+
+    def _query(self, sql, params=()):
+        """Run a read query and return the rows as dicts"""
+        with self.lock:
+            return [dict(row) for row in self._connect().execute(sql, params)]
+
+    def get(self, name):
+        """Newest record for a job file name"""
+        rows = self._query("SELECT * FROM jobs WHERE name = ? ORDER BY id DESC LIMIT 1", (name,))
+        return rows[0] if rows else None
+
+    def find_task(self, task_id):
+        """Newest record for a task_id (or job file stem)"""
+        rows = self._query("SELECT * FROM jobs WHERE task_id = ? ORDER BY id DESC LIMIT 1",
+                           (task_id,))
+        return rows[0] if rows else None
+
+    def count(self, state=None, since=None):
+        """Count jobs, optionally by state and finished within the last since seconds"""
+        sql, params = "SELECT COUNT(*) AS n FROM jobs WHERE 1 = 1", []
+        if state:
+            sql += " AND state = ?"
+            params.append(state)
+        if since is not None:
+            sql += " AND finished_at >= ?"
+            params.append(time.time() - since)
+        return self._query(sql, params)[0]['n']
+
+    def admitted(self, names):
+        """Those of these job file names whose newest record is in ADMITTED_STATES"""
+        names, found = list(names), set()
+        # Chunked to stay under SQLite's limit on query parameters
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            rows = self._query(
+                f"SELECT name, state FROM jobs WHERE id IN (SELECT MAX(id) FROM jobs "
+                f"WHERE name IN ({', '.join('?' * len(chunk))}) GROUP BY name)", chunk)
+            found.update(row['name'] for row in rows if row['state'] in self.ADMITTED_STATES)
+        return found
+    
+    def interruptions(self, name, since):
+        """Times a job file name was found interrupted since the given epoch time"""
+        rows = self._query("SELECT COUNT(*) AS n FROM jobs WHERE name = ? AND state = 'interrupted' "
+                           "AND submitted_at >= ?", (name, since))
+        return rows[0]['n']
+
+    def counts(self):
+        """Number of jobs in each state"""
+        rows = self._query("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")
+        return {row['state']: row['n'] for row in rows}
+
+    def recent(self, state=None, limit=20):
+        """Most recent jobs, newest first"""
+        if state:
+            return self._query("SELECT * FROM jobs WHERE state = ? ORDER BY id DESC LIMIT ?",
+                               (state, limit))
+        return self._query("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+
+    def close(self):
+        """Close the database connection"""
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+
+def result_task_id(data, name):
+    """task_id recorded for a result: its own, or the stem of the job it came from"""
+    return str(data.get('task_id') or Path(data.get('source_file', name)).stem)
+
+
+class FileResultStore:
+    """Result store writing one pretty-printed JSON file per job (the original layout)"""
+    name = 'files'
+
+    def write(self, path, data):
+        """Store a job's result document under its completed/ or failed/ path"""
+        write_atomic(path, json.dumps(data, indent=2))
+
+    def read(self, path):
+        """Stored JSON of a result, or None"""
+        try:
+            return Path(path).read_bytes()
+        except OSError:
+            return None
+
+    def written_at(self, path):
+        """When a result was stored, or None if there is none"""
+        try:
+            return Path(path).stat().st_mtime
+        except OSError:
+            return None
+
+    def materialize(self, path):
+        """Make sure a result exists as a per-job file; return its path or None"""
+        return Path(path) if Path(path).exists() else None
+
+    def recover(self):
+        """Repair what an interrupted write left behind; only the writing process calls this"""
+        pass
+
+    def names(self):
+        """(dir, name) of every result held in the store itself"""
+        return []
+
+    def expired(self, max_age):
+        """Sealed storage older than max_age, as (segment, records) pairs"""
+        return []
+
+    def close(self):
+        pass
+
+
+class LogResultStore(FileResultStore):
+    """Result store appending compact records to segment files, found through an offset index and read via mmap"""
+    name = 'log'
+
+    MAGIC = b'BRR1'
+    HEADER = struct.Struct('<4sHI')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY,
+            dir TEXT NOT NULL,
+            name TEXT NOT NULL,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            written_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS results_by_name ON results (name, dir, id);
+        CREATE INDEX IF NOT EXISTS results_by_segment ON results (segment, offset);
+    """
+
+    def __init__(self, path=None, segment_bytes=None):
+        self.path = Path(path or RESULTS_DIR)
+        self.segment_bytes = segment_bytes or RESULT_SEGMENT_BYTES
+        self.lock = threading.Lock()
+        self.conn = None
+        self.fd = None
+        self.segment = None
+        self.size = 0
+        self.maps = {}
+        self.recovered = False
+
+    def _connect(self):
+        """Open the index on first use"""
+        if self.conn is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path / 'index.db'), check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(self.SCHEMA)
+        return self.conn
+
+    def recover(self):
+        """Index records a crash left unindexed in the newest segment and cut off a torn tail"""
+        with self.lock:
+            self._recover()
+
+    def _recover(self):
+        if self.recovered:
+            return
+        self.recovered = True
+        self._connect()
+        segments = sorted(self.path.glob('segment-*.log'))
+        if not segments:
+            return
+        segment = segments[-1]
+        row = self.conn.execute("SELECT MAX(offset + length) AS end FROM results WHERE segment = ?",
+                                (segment.name,)).fetchone()
+        position = row['end'] or 0
+        with open(segment, 'r+b') as f:
+            f.seek(position)
+            tail = f.read()
+            offset, found = 0, []
+            while offset + self.HEADER.size <= len(tail):
+                magic, key_length, length = self.HEADER.unpack_from(tail, offset)
+                start = offset + self.HEADER.size + key_length
+                if magic != self.MAGIC or start + length > len(tail):
+                    break
+                dir_name, _, name = tail[offset + self.HEADER.size:start].decode().partition('/')
+                found.append((dir_name, name, segment.name, position + start, length,
+                              segment.stat().st_mtime))
+                offset = start + length
+            if offset < len(tail):
+                f.truncate(position + offset)
+        if found:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO results (dir, name, segment, offset, length, written_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", found)
+
+    def _roll(self):
+        """Switch appends to the newest segment, starting a new one when it is full"""
+        if self.fd is not None:
+            os.close(self.fd)
+        segments = sorted(self.path.glob('segment-*.log'))
+        if segments and segments[-1].stat().st_size < self.segment_bytes and self.segment is None:
+            self.segment = segments[-1]
+        else:
+            number = int(segments[-1].name[8:14]) + 1 if segments else 1
+            self.segment = self.path / f"segment-{number:06d}.log"
+        self.fd = os.open(self.segment, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+
+    def write(self, path, data):
+        """Append a compact record with one write, then index its offset"""
+        path = Path(path)
+        key = f"{path.parent.name}/{path.name}".encode()
+        payload = json.dumps(data, separators=(',', ':')).encode()
+        record = self.HEADER.pack(self.MAGIC, len(key), len(payload)) + key + payload
+        with self.lock:
+            self._recover()
+            conn = self._connect()
+            if self.fd is None or (self.size and self.size + len(record) > self.segment_bytes):
+                self._roll()
+            os.write(self.fd, record)
+            if FSYNC_RESULTS:
+                os.fsync(self.fd)
+            offset = self.size + self.HEADER.size + len(key)
+            self.size += len(record)
+            with conn:
+                conn.execute("INSERT INTO results (dir, name, segment, offset, length, written_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             (path.parent.name, path.name, self.segment.name, offset,
+                              len(payload), time.time()))
+
+    def _locate(self, path):
+        """Index row of the newest record stored under a path"""
+        path = Path(path)
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT * FROM results WHERE name = ? AND dir = ? ORDER BY id DESC LIMIT 1",
+                (path.name, path.parent.name)).fetchone()
+        return dict(row) if row else None
+
+    def _map(self, segment, end):
+        """Read-only mapping of a segment covering at least `end` bytes"""
+        mapped = self.maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            with open(self.path / segment, 'rb') as f:
+                # Views of an older, shorter mapping keep it alive until they are released
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mapped
+        return mapped
+
+    def view(self, path):
+        """Zero-copy memoryview of a stored record's JSON, or None"""
+        row = self._locate(path)
+        if row is None:
+            return None
+        with self.lock:
+            mapped = self._map(row['segment'], row['offset'] + row['length'])
+        return memoryview(mapped)[row['offset']:row['offset'] + row['length']]
+
+    def read(self, path):
+        """Stored JSON of a result, falling back to per-job files (batches, materialised results)"""
+        view = self.view(path)
+        if view is None:
+            return super().read(path)
+        with view:
+            return bytes(view)
+
+    def written_at(self, path):
+        row = self._locate(path)
+        return row['written_at'] if row else super().written_at(path)
+
+    def materialize(self, path):
+        """Write a stored record out as the per-job JSON file the files store would have made"""
+        data = self.read(path)
+        if data is None:
+            return None
+        path = Path(path)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_atomic(path, json.dumps(json.loads(data), indent=2))
+        return path
+
+    def names(self):
+        with self.lock:
+            rows = self._connect().execute("SELECT DISTINCT dir, name FROM results ORDER BY id").fetchall()
+        return [(row['dir'], row['name']) for row in rows]
+
+    def expired(self, max_age):
+        """Sealed segments whose newest record is older than max_age, with their records"""
+        cutoff = time.time() - max_age
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT segment, MAX(written_at) AS newest FROM results GROUP BY segment").fetchall()
+            current = self.segment.name if self.segment else None
+        expired = []
+        for row in rows:
+            if row['segment'] == current or row['newest'] >= cutoff:
+                continue
+            with self.lock:
+                records = self.conn.execute("SELECT * FROM results WHERE segment = ? ORDER BY offset",
+                                            (row['segment'],)).fetchall()
+            with open(self.path / row['segment'], 'rb') as f:
+                data = f.read()
+            expired.append((row['segment'], [
+                (r['dir'], r['name'], data[r['offset']:r['offset'] + r['length']], r['written_at'])
+                for r in records]))
+        return expired
+
+    def drop(self, segment):
+        """Forget a segment and delete its file"""
+        with self.lock:
+            with self._connect():
+                self.conn.execute("DELETE FROM results WHERE segment = ?", (segment,))
+            self.maps.pop(segment, None)
+        (self.path / segment).unlink()
+
+    def close(self):
+        """Close the active segment, mappings and index"""
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            for mapped in self.maps.values():
+                try:
+                    mapped.close()
+                except BufferError:
+                    # A caller still holds a view
+                    pass
+            self.maps = {}
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+
+def make_result_store(backend=None):
+    """Create the configured result store"""
+    backend = backend or RESULT_STORE
+    if backend == 'log':
+        return LogResultStore()
+    if backend == 'files':
+        return FileResultStore()
+    raise ValueError(f"Unknown result store: {backend}")
+
+
+class ResultArchive:
+    """Rolls old result files into append-only gzip segments with a lookup index"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archived (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            dir TEXT NOT NULL,
+            task_id TEXT,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            mtime REAL,
+            archived_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS archived_by_name ON archived (name, id);
+        CREATE INDEX IF NOT EXISTS archived_by_task ON archived (task_id, id);
+    """
+
+    def __init__(self, path=None, max_age=None, max_count=None, log=None, results=None, leader=None):
+        self.path = Path(path or ARCHIVE_DIR)
+        # With several nodes, passes only run on the one this returns true for
+        self.leader = leader
+        # A log result store whose old segments are archived record by record
+        self.results = results
+        self.max_age = RETENTION_AGE if max_age is None else max_age
+        self.max_count = RETENTION_COUNT if max_count is None else max_count
+        self.log = log or (lambda message, level='INFO': None)
+        self.conn = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _connect(self):
+        """Open the archive index on first use"""
+        if self.conn is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path / 'index.db'), check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(self.SCHEMA)
+        return self.conn
+
+    def _segment(self):
+        """Path of the segment to append to, rolling to a new one when full"""
+        segments = sorted(self.path.glob('segment-*.gz'))
+        if segments and segments[-1].stat().st_size < ARCHIVE_SEGMENT_BYTES:
+            return segments[-1]
+        number = int(segments[-1].name[8:14]) + 1 if segments else 1
+        return self.path / f"segment-{number:06d}.gz"
+
+    def expired(self, dir):
+        """Files in a result directory outside the retention limits, each result with its companions"""
+        try:
+            with os.scandir(dir) as entries:
+                files = [(e.stat().st_mtime, Path(e.path)) for e in entries if e.is_file()]
+        except FileNotFoundError:
+            return []
+        results, spools = [], collections.defaultdict(list)
+        for mtime, path in files:
+            if path.suffix in ('.stdout', '.stderr'):
+                # A result's stdout_file/stderr_file; it counts as part of that result
+                job = Path(path.stem)
+                if job.suffix[1:].isdigit():
+                    # A batch line's, named <batch stem>.<line>: part of the batch's results
+                    job = job.with_suffix('.jsonl')
+                spools[result_names(job)[0]].append((mtime, path))
+            elif path.suffix == '.reason':
+                # Beside a job admission control turned away
+                spools[path.stem].append((mtime, path))
+            else:
+                results.append((mtime, path))
+        results.sort(reverse=True)
+        cutoff = time.time() - self.max_age
+        expired = []
+        for i, (mtime, path) in enumerate(results):
+            own = [spool for _, spool in sorted(spools.pop(path.name, ()))]
+            if i >= self.max_count or mtime < cutoff:
+                expired += [path] + own
+        # Companions whose result is gone go by age alone
+        expired += [path for entries in spools.values() for mtime, path in entries if mtime < cutoff]
+        return expired
+
+    def add(self, path, dir_name):
+        """Append one file to the current segment as its own gzip member and remove it"""
+        task_id = None
+        if path.suffix == '.json':
+            try:
+                with open(path) as f:
+                    task_id = result_task_id(json.load(f), path.name)
+            except (OSError, ValueError, AttributeError):
+                pass
+        with open(path, 'rb') as src:
+            self.append(path.name, dir_name, src, path.stat().st_mtime, task_id)
+        path.unlink()
+
+    def append(self, name, dir_name, src, mtime, task_id=None):
+        """Append the contents of a file object to the current segment as its own gzip member"""
+        with self.lock:
+            conn = self._connect()
+            segment = self._segment()
+            with open(segment, 'ab') as out:
+                offset = out.tell()
+                # The member header carries the original name, so segments are self-describing
+                with gzip.GzipFile(filename=f"{dir_name}/{name}", mode='wb',
+                                   fileobj=out, mtime=int(mtime)) as member:
+                    shutil.copyfileobj(src, member)
+                out.flush()
+                os.fsync(out.fileno())
+                length = out.tell() - offset
+            with conn:
+                conn.execute(
+                    "INSERT INTO archived (name, dir, task_id, segment, offset, length, mtime, archived_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (name, dir_name, task_id, segment.name, offset, length, mtime, time.time()))
+
+    def run_once(self):
+        """Archive everything outside the retention limits; return the number of files"""
+        archived = 0
+        for dir in (COMPLETED_DIR, FAILED_DIR, REJECTED_DIR):
+            for path in self.expired(dir):
+                try:
+                    self.add(path, dir.name)
+                    archived += 1
+                except FileNotFoundError:
+                    continue
+        if self.results and self.max_age is not None:
+            for segment, records in self.results.expired(self.max_age):
+                for dir_name, name, data, mtime in records:
+                    self.append(name, dir_name, io.BytesIO(data), mtime,
+                                result_task_id(json.loads(data), name))
+                    archived += 1
+                self.results.drop(segment)
+        if archived:
+            self.log(f"Archived {archived} result file(s) to {self.path}")
+        return archived
+
+    def lookup(self, name=None, task_id=None):
+        """Index record of the newest archived file with this name or task_id"""
+        column, value = ('name', name) if name else ('task_id', task_id)
+        with self.lock:
+            row = self._connect().execute(
+                f"SELECT * FROM archived WHERE {column} = ? ORDER BY id DESC LIMIT 1",
+                (value,)).fetchone()
+        return dict(row) if row else None
+
+    def fetch(self, name=None, task_id=None):
+        """Contents of an archived file by job/result name or task_id, or None"""
+        record = self.lookup(name=name, task_id=task_id)
+        if record is None:
+            return None
+        with open(self.path / record['segment'], 'rb') as f:
+            f.seek(record['offset'])
+            return gzip.decompress(f.read(record['length']))
+
+    def _loop(self):
+        """Background thread body"""
+        while not self.stopped.wait(ARCHIVE_INTERVAL):
+            if self.leader and not self.leader():
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                self.log(f"Error archiving results: {str(e)}", 'ERROR')
+
+    def start(self):
+        """Run retention passes on a background thread"""
+        self.thread = threading.Thread(target=self._loop, name='archiver', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and close the index"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+
+def read_checkpoint(path):
+    """Return the line numbers already finished in a batch checkpoint and how many failed"""
+    done, failed = set(), 0
+    if not path.exists():
+        return done, failed
+    with open(path, 'rb+') as f:
+        content = f.read()
+        # Drop a line torn by a crash mid-write
+        complete = content[:content.rfind(b'\n') + 1]
+        if len(complete) != len(content):
+            f.truncate(len(complete))
+    for line in complete.splitlines():
+        record = json.loads(line)
+        done.add(record['line'])
+        if record['result']['status'] != 'completed':
+            failed += 1
+    return done, failed
+
+
+class JobGraph:
+    """Jobs held back until the jobs they depend on have finished"""
+
+    # Recently finished ids kept in memory; older ones are answered by lookup
+    MAX_FINISHED = 10000
+
+    def __init__(self, lookup=None):
+        self.lookup = lookup or finished_on_disk
+        self.finished = collections.OrderedDict()
+        self.queued = set()
+        self.waiting = {}
+        self.children = collections.defaultdict(set)
+
+    def state(self, job_id):
+        """Return 'completed', 'failed', 'pending' or None for an unknown job"""
+        # A resubmitted id is pending again, whatever its earlier run did
+        if job_id in self.queued or job_id in self.waiting:
+            return 'pending'
+        if job_id in self.finished:
+            return self.finished[job_id]
+        return self.lookup(job_id)
+    
+    def _record(self, job_id, status):
+        """Remember a finished job, forgetting the oldest past MAX_FINISHED"""
+        self.finished.pop(job_id, None)
+        self.finished[job_id] = status
+        while len(self.finished) > self.MAX_FINISHED:
+            self.finished.popitem(last=False)
+
+    def _depends_on(self, job_id, target, deps):
+        """Whether job_id transitively depends on target"""
+        seen, stack = set(), list(deps.get(job_id, ()))
+        while stack:
+            parent = stack.pop()
+            if parent == target:
+                return True
+            if parent not in seen:
+                seen.add(parent)
+                stack.extend(deps.get(parent, ()))
+        return False
+
+    def add(self, batch):
+        """Register newly submitted (name, meta) jobs; return (ready, rejected)"""
+        for name, meta in batch:
+            self.queued.add(meta['id'])
+            self.finished.pop(meta['id'], None)
+        deps = {job_id: entry[1]['depends_on'] for job_id, entry in self.waiting.items()}
+        deps.update((meta['id'], meta['depends_on']) for _, meta in batch)
+        
+        ready, rejected = [], []
+        for name, meta in batch:
+            job_id, parents = meta['id'], meta['depends_on']
+            states = {parent: self.state(parent) for parent in parents}
+            missing = [parent for parent, state in states.items() if state is None]
+            failed = [parent for parent, state in states.items() if state == 'failed']
+            if missing:
+                error = f"Unknown dependency: {', '.join(missing)}"
+            elif self._depends_on(job_id, job_id, deps):
+                error = f"Dependency cycle through {job_id}"
+            elif failed:
+                error = f"Dependency failed: {', '.join(failed)}"
+            else:
+                unfinished = {parent for parent, state in states.items() if state != 'completed'}
+                if not unfinished:
+                    ready.append((name, meta))
+                    continue
+                self.queued.discard(job_id)
+                self.waiting[job_id] = (name, meta, unfinished)
+                for parent in unfinished:
+                    self.children[parent].add(job_id)
+                continue
+            
+            # Rejected jobs fail their own dependents too
+            rejected.append((name, meta, error))
+            _, cascaded = self.finish(job_id, 'failed')
+            rejected.extend(cascaded)
+        return ready, rejected
+
+    def discard(self, job_id):
+        """Forget a job that is no longer this server's to run"""
+        self.queued.discard(job_id)
+        entry = self.waiting.pop(job_id, None)
+        if entry:
+            for parent in entry[2]:
+                self.children[parent].discard(job_id)
+    
+    def remove(self, job_id):
+        """Forget a job deleted before it ran; return the dependents that now fail"""
+        self.discard(job_id)
+        _, failed = self.finish(job_id, 'failed')
+        return failed
+
+    def finish(self, job_id, status):
+        """Record a finished job; return (released, failed) dependents"""
+        self.queued.discard(job_id)
+        self._record(job_id, status)
+        released, failed = [], []
+        failed_ids = {job_id} if status == 'failed' else set()
+        stack = [job_id]
+        while stack:
+            parent = stack.pop()
+            for child in sorted(self.children.pop(parent, ())):
+                if child not in self.waiting:
+                    continue
+                name, meta, unfinished = self.waiting[child]
+                if parent in failed_ids:
+                    # Cascade the failure to everything downstream
+                    del self.waiting[child]
+                    self._record(child, 'failed')
+                    failed_ids.add(child)
+                    failed.append((name, meta, f"Dependency failed: {parent}"))
+                    stack.append(child)
+                    continue
+                unfinished.discard(parent)
+                if not unfinished:
+                    del self.waiting[child]
+                    self.queued.add(child)
+                    released.append((name, meta))
+        return released, failed
+
+
+class PendingJobs(dict):
+    """Metadata of queued jobs by file name, keeping the totals admission control checks"""
+
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+        self.sources = collections.Counter()
+
+    def __setitem__(self, name, meta):
+        self.pop(name, None)
+        super().__setitem__(name, meta)
+        self.bytes += meta.get('bytes', 0)
+        self.sources[meta['source']] += 1
+
+    def pop(self, name, *default):
+        if name not in self:
+            return super().pop(name, *default)
+        meta = super().pop(name)
+        self.bytes -= meta.get('bytes', 0)
+        self.sources[meta['source']] -= 1
+        if not self.sources[meta['source']]:
+            del self.sources[meta['source']]
+        return meta
+
+
+class Admission:
+    """High and low watermarks on queued jobs, their bytes and each source's share"""
+
+    def __init__(self, max_jobs=None, max_bytes=None, max_per_source=None, resume=None):
+        self.max_jobs = MAX_PENDING if max_jobs is None else max_jobs
+        self.max_bytes = MAX_PENDING_BYTES if max_bytes is None else max_bytes
+        self.max_per_source = MAX_PENDING_PER_SOURCE if max_per_source is None else max_per_source
+        self.resume = ADMIT_RESUME if resume is None else resume
+        # Limits past their high watermark and not yet back under the low one
+        self.shedding = set()
+        # Accepted through the API but not yet seen in pending/; they count as queued
+        self.reserved = PendingJobs()
+        self.rejected = 0
+        self.finishes = collections.deque(maxlen=256)
+
+    def levels(self, jobs, source=None):
+        """(limit name, current figure, high watermark, unit) for every enabled limit"""
+        sources = jobs.sources + self.reserved.sources if self.reserved else jobs.sources
+        levels = [('jobs', len(jobs) + len(self.reserved), self.max_jobs, 'jobs'),
+                  ('bytes', jobs.bytes + self.reserved.bytes, self.max_bytes, 'bytes')]
+        levels += [(f"source {name}", sources[name], self.max_per_source, 'jobs')
+                   for name in ([source] if source else list(sources))]
+        return [level for level in levels if level[2]]
+    
+    def reserve(self, name, meta):
+        """Hold room for a job admitted ahead of its file reaching pending/"""
+        self.reserved[name] = meta
+    
+    def release(self, name):
+        """Drop a reservation once its job is queued, or gone"""
+        self.reserved.pop(name, None)
+
+    def refresh(self, jobs):
+        """Reopen the limits that have drained to their low watermark"""
+        for name, value, high, _ in self.levels(jobs):
+            if name in self.shedding and value <= high * self.resume:
+                self.shedding.discard(name)
+        # Sources with nothing queued have drained too
+        self.shedding = {name for name in self.shedding if not name.startswith('source ') or
+                         name[7:] in jobs.sources or name[7:] in self.reserved.sources}
+
+    def check(self, jobs, meta):
+        """Reason to refuse one more job given the queued ones, or None to admit it"""
+        self.refresh(jobs)
+        for name, value, high, unit in self.levels(jobs, meta['source']):
+            added = meta.get('bytes', 0) if unit == 'bytes' else 1
+            if name not in self.shedding and value + added > high:
+                self.shedding.add(name)
+            if name in self.shedding:
+                self.rejected += 1
+                return (f"Queue full: {value} {unit} pending against a {name} limit of {high}; "
+                        f"accepting again below {int(high * self.resume)}")
+        return None
+
+    def finished(self):
+        """Note that a queued job has been run, for retry_after estimates"""
+        self.finishes.append(time.monotonic())
+
+    def retry_after(self, jobs):
+        """Seconds until the queue has likely drained to its low watermark"""
+        excess = max(len(jobs) - int(self.max_jobs * self.resume), 1) if self.max_jobs else 1
+        if len(self.finishes) < 2 or self.finishes[-1] == self.finishes[0]:
+            return ADMIT_RETRY_AFTER
+        rate = (len(self.finishes) - 1) / (self.finishes[-1] - self.finishes[0])
+        return round(min(max(excess / rate, 1), RETRY_MAX_BACKOFF), 1)
+
+
+class Coalescer:
+    """Jobs sharing a dedupe key: the first one queued runs, the rest wait for its result"""
+
+    def __init__(self):
+        # dedupe key -> the job that will run for it, queued or already running
+        self.leaders = {}
+        self.keys = {}
+        # leader -> jobs waiting for its result, and the reverse
+        self.followers = {}
+        self.leader_of = {}
+        self.coalesced = 0
+
+    def join(self, name, meta):
+        """Leader a runnable job should wait for, or None if it runs itself"""
+        key = meta.get('dedupe_key')
+        if not key:
+            return None
+        leader = self.leaders.get(key)
+        if leader is None or leader == name:
+            self.leaders[key] = name
+            self.keys[name] = key
+            return None
+        self.followers.setdefault(leader, []).append(name)
+        self.leader_of[name] = leader
+        self.coalesced += 1
+        return leader
+
+    def finish(self, name):
+        """Forget a leader whose run is over; return the jobs that were waiting for it"""
+        key = self.keys.pop(name, None)
+        if key and self.leaders.get(key) == name:
+            del self.leaders[key]
+        followers = self.followers.pop(name, [])
+        for follower in followers:
+            self.leader_of.pop(follower, None)
+        return followers
+
+    def discard(self, name):
+        """Forget a job removed before it ran; return the follower promoted to run instead, or None"""
+        leader = self.leader_of.pop(name, None)
+        if leader:
+            self.followers[leader].remove(name)
+            return None
+        key = self.keys.get(name)
+        followers = self.finish(name)
+        if not followers:
+            return None
+        promoted, rest = followers[0], followers[1:]
+        self.leaders[key] = promoted
+        self.keys[promoted] = key
+        if rest:
+            self.followers[promoted] = rest
+            self.leader_of.update((follower, promoted) for follower in rest)
+        return promoted
+
+
+class PendingIndex:
+    """Priority lanes of pending jobs, round-robin across sources within a lane"""
+
+    def __init__(self):
+        self._levels = []
+        self._lanes = {}
+        self._entries = {}
+
+    def add(self, name, priority=0, source=None):
+        """Add a job name to its lane, ignoring duplicates"""
+        if name in self._entries:
+            return
+        source = source or DEFAULT_SOURCE
+        self._entries[name] = (priority, source)
+        lane = self._lanes.get(priority)
+        if lane is None:
+            lane = self._lanes[priority] = collections.OrderedDict()
+            heapq.heappush(self._levels, -priority)
+        heapq.heappush(lane.setdefault(source, []), name)
+
+    def discard(self, name):
+        """Remove a job name if present (lazily dropped from its heap)"""
+        self._entries.pop(name, None)
+
+    def pop(self):
+        """Remove and return the next job name, or None"""
+        while self._levels:
+            priority = -self._levels[0]
+            lane = self._lanes[priority]
+            while lane:
+                source, heap = next(iter(lane.items()))
+                name = heapq.heappop(heap)
+                # Rotate so the next pop at this level serves another source
+                if heap:
+                    lane.move_to_end(source)
+                else:
+                    del lane[source]
+                if self._entries.get(name) == (priority, source):
+                    del self._entries[name]
+                    return name
+            heapq.heappop(self._levels)
+            del self._lanes[priority]
+        return None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+
+def parse_cron(expr):
+    """Parse a 5-field cron expression (or @daily etc.) into sets of allowed values"""
+    expr = CRON_MACROS.get(expr.strip().lower(), expr)
+    parts = expr.split()
+    if len(parts) != 5:
+        raise ValueError(f"Cron expression needs 5 fields: {expr!r}")
+    fields = []
+    for text, (label, low, high, names) in zip(parts, CRON_FIELDS):
+        values = set()
+        for item in text.lower().split(','):
+            span, _, step = item.partition('/')
+            if names:
+                for i, name in enumerate(names):
+                    span = span.replace(name, str(i + low))
+            try:
+                step = int(step) if step else 1
+                if span == '*':
+                    start, end = low, high
+                elif '-' in span:
+                    start, end = (int(x) for x in span.split('-', 1))
+                else:
+                    start = int(span)
+                    end = high if step > 1 else start
+            except ValueError:
+                raise ValueError(f"Bad cron {label} field: {text!r}") from None
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"Bad cron {label} field: {text!r}")
+            values.update(range(start, end + 1, step))
+        fields.append(values)
+    # Sunday is both 0 and 7
+    if 7 in fields[4]:
+        fields[4].add(0)
+    # Day of month and day of week combine with OR when both are restricted
+    fields.append((parts[2] == '*', parts[4] == '*'))
+    return fields
+
+
+def cron_next(fields, after):
+    """Epoch time of the first minute after `after` that the parsed cron fields match"""
+    minutes, hours, days, months, weekdays, (any_day, any_weekday) = fields
+    t = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=5 * 366)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            continue
+        day_ok = t.day in days
+        weekday_ok = (t.weekday() + 1) % 7 in weekdays
+        if not (day_ok and weekday_ok if any_day or any_weekday else day_ok or weekday_ok):
+            t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+            continue
+        if t.hour not in hours:
+            t = (t + timedelta(hours=1)).replace(minute=0)
+            continue
+        if t.minute not in minutes:
+            t += timedelta(minutes=1)
+            continue
+        return t.timestamp()
+    raise ValueError("Cron expression never matches")
+
+
+class Scheduler:
+    """Cron and interval schedules from schedules/, fired from a timer heap"""
+    
+    def __init__(self, path=None, state_path=None, log=None):
+        self.path = Path(path or SCHEDULES_DIR)
+        self.state_path = Path(state_path or SCHEDULE_STATE)
+        self.log = log or (lambda message, level='INFO', **fields: None)
+        self.schedules = {}
+        self.heap = []
+        self.state = None
+        # Schedules with a run queued or in flight
+        self.active = set()
+        # Scheduled runs in flight by run name, and failed runs waiting to retry
+        self.runs = {}
+        self.retries = []
+    
+    def load(self):
+        """(Re)read schedules/ and plan the next run of each schedule"""
+        if self.state is None:
+            try:
+                self.state = json.loads(self.state_path.read_text())
+            except (OSError, ValueError):
+                self.state = {}
+        schedules = {}
+        for path in sorted(self.path.glob('*.json')):
+            try:
+                with open(path) as f:
+                    spec = json.load(f)
+                schedules[path.stem] = self.parse(spec)
+            except (OSError, ValueError, TypeError) as e:
+                self.log(f"Ignoring schedule {path.name}: {e}", 'ERROR')
+        
+        now = time.time()
+        self.schedules = schedules
+        self.heap = [(self.first_run(name, spec, now), name) for name, spec in schedules.items()]
+        heapq.heapify(self.heap)
+    
+    def clear(self):
+        """Drop every schedule, leaving them to another node; load() re-reads the state"""
+        self.schedules = {}
+        self.heap = []
+        self.state = None
+    
+    def parse(self, spec):
+        """Validate a schedule file and split it into timing and job fields"""
+        if not isinstance(spec, dict):
+            raise ValueError("schedule is not a JSON object")
+        job = {k: v for k, v in spec.items() if k not in SCHEDULE_FIELDS}
+        job_command(job)
+        if 'schedule' in spec:
+            timing = {'cron': parse_cron(str(spec['schedule']))}
+        elif 'every' in spec:
+            every = float(spec['every'])
+            if every <= 0:
+                raise ValueError("every must be positive")
+            timing = {'every': every}
+        else:
+            raise ValueError("needs a schedule or every field")
+        timing['overlap'] = bool(spec.get('overlap', False))
+        timing['catch_up'] = bool(spec.get('catch_up', True))
+        return dict(timing, job=job)
+    
+    def next_run(self, spec, after):
+        """Time of the first run strictly after `after`"""
+        if 'cron' in spec:
+            return cron_next(spec['cron'], after)
+        return after + spec['every']
+    
+    def first_run(self, name, spec, now):
+        """When a schedule should next run, given the last run recorded for it"""
+        last = self.state.get(name, {}).get('last_run')
+        if last is None:
+            # New interval schedules start at once, cron schedules at their next match
+            return now if 'every' in spec else self.next_run(spec, now)
+        due = self.next_run(spec, last)
+        if due <= now:
+            # Runs missed while the server was down collapse into one catch-up run
+            return now if spec['catch_up'] else self.next_run(spec, now)
+        return due
+    
+    def due(self, now):
+        """Pop the runs due by now as (name, job data, planned time); plan each schedule's next run"""
+        runs = []
+        while self.heap and self.heap[0][0] <= now:
+            planned, name = heapq.heappop(self.heap)
+            spec = self.schedules[name]
+            following = self.next_run(spec, planned)
+            if following <= now:
+                # Fell behind: skip the missed ticks rather than firing them in a burst
+                following = self.next_run(spec, now)
+            heapq.heappush(self.heap, (following, name))
+            if name in self.active and not spec['overlap']:
+                self.log(f"Skipping scheduled run of {name}: the previous run is still going", 'WARNING')
+                continue
+            self.active.add(name)
+            self.state[name] = {'last_run': round(planned, 6)}
+            runs.append((name, json.loads(json.dumps(spec['job'])), planned))
+        if runs:
+            self.save()
+        return runs
+    
+    def retry(self, run, data, at):
+        """Hold a failed run in memory until its retry is due; its schedule stays active"""
+        heapq.heappush(self.retries, (at, run, self.runs[run], data))
+    
+    def retries_due(self, now):
+        """Pop the retries due by now as (run name, schedule, job data)"""
+        runs = []
+        while self.retries and self.retries[0][0] <= now:
+            _, run, name, data = heapq.heappop(self.retries)
+            runs.append((run, name, data))
+        return runs
+    
+    def next_due(self):
+        """Epoch time of the next planned run or retry, or None"""
+        timers = [heap[0][0] for heap in (self.heap, self.retries) if heap]
+        return min(timers) if timers else None
+    
+    def finished(self, name):
+        """Note that a schedule's run is over, allowing the next one"""
+        self.active.discard(name)
+    
+    def save(self):
+        """Persist the last run of every schedule"""
+        try:
+            # Losing the newest last_run to a power cut only costs one catch-up run
+            write_atomic(self.state_path, json.dumps(self.state, indent=2), durable=False)
+        except OSError as e:
+            self.log(f"Cannot save schedule state: {e}", 'ERROR')
+
+
+class ShardLeases:
+    """The pending/ shards one node holds, renewed by heartbeats and taken over from silent nodes"""
+    
+    def __init__(self, node, shards=None, timeout=None, log=None):
+        self.node = node
+        self.shards = [f"{n:02x}" for n in range(shards or SHARDS)]
+        self.timeout = timeout or LEASE_TIMEOUT
+        self.interval = self.timeout / 3
+        self.log = log or (lambda message, level='INFO', **fields: None)
+        self.held = set()
+        self.next_beat = 0
+    
+    def lease_path(self, shard):
+        return LEASES_DIR / f"{shard}.lease"
+    
+    def due(self):
+        """Seconds until the next heartbeat"""
+        return max(self.next_beat - time.monotonic(), 0)
+    
+    def leads(self):
+        """Whether this node holds the first shard, whose holder also runs schedules and retention"""
+        return self.shards[0] in self.held
+    
+    def age(self, path):
+        """Seconds since a lease or heartbeat file was renewed, or None if it is gone"""
+        try:
+            return time.time() - path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+    
+    def nodes(self):
+        """Heartbeat age of every node that has not left the queue, by name"""
+        ages = {path.stem: self.age(path) for path in NODES_DIR.glob('*.json')}
+        return {node: age for node, age in ages.items() if age is not None}
+    
+    def dead_nodes(self):
+        """Other nodes whose heartbeat is older than the lease timeout"""
+        return sorted(node for node, age in self.nodes().items()
+                      if age > self.timeout and node != self.node)
+    
+    def heartbeat(self):
+        """Renew held leases, then release or take shards toward an even share; return (gained, lost)"""
+        LEASES_DIR.mkdir(parents=True, exist_ok=True)
+        NODES_DIR.mkdir(parents=True, exist_ok=True)
+        self.next_beat = time.monotonic() + self.interval
+        write_atomic(NODES_DIR / f"{self.node}.json", json.dumps({
+            'node': self.node, 'host': socket.gethostname(), 'pid': os.getpid(),
+            'shards': sorted(self.held), 'heartbeat_at': time.time()}), durable=False)
+        
+        lost = set()
+        for shard in self.held:
+            path = self.lease_path(shard)
+            try:
+                if path.read_text() == self.node:
+                    os.utime(path)
+                    continue
+            except FileNotFoundError:
+                pass
+            lost.add(shard)
+        if lost:
+            self.log(f"Lost the lease on shard(s) {', '.join(sorted(lost))}", 'WARNING')
+        self.held -= lost
+        
+        live = sum(1 for age in self.nodes().values() if age <= self.timeout)
+        share = -(-len(self.shards) // max(live, 1))
+        for shard in sorted(self.held, reverse=True)[:max(len(self.held) - share, 0)]:
+            self.release(shard)
+            lost.add(shard)
+        gained = set()
+        for shard in self.shards:
+            if len(self.held) >= share:
+                break
+            if shard not in self.held and self.acquire(shard):
+                gained.add(shard)
+        return gained, lost
+    
+    def acquire(self, shard):
+        """Take a free shard, or one whose holder stopped renewing its lease"""
+        path = self.lease_path(shard)
+        age = self.age(path)
+        if age is not None:
+            if age <= self.timeout:
+                return False
+            # Only the node whose rename succeeds may steal the lease
+            stolen = path.with_name(f".{path.name}.{self.node}")
+            try:
+                os.rename(path, stolen)
+            except FileNotFoundError:
+                return False
+            holder = stolen.read_text()
+            if self.age(stolen) <= self.timeout:
+                # Retaken by another node between the check and the rename; put it back
+                try:
+                    os.link(stolen, path)
+                except FileExistsError:
+                    pass
+                stolen.unlink()
+                return False
+            stolen.unlink()
+            self.log(f"Taking over shard {shard} from node {holder}", 'WARNING')
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.node)
+        self.held.add(shard)
+        return True
+    
+    def release(self, shard):
+        """Give up a shard for other nodes to take"""
+        self.held.discard(shard)
+        try:
+            if self.lease_path(shard).read_text() == self.node:
+                self.lease_path(shard).unlink()
+        except FileNotFoundError:
+            pass
+    
+    def forget(self, node):
+        """Remove a dead node's heartbeat file once its jobs have been recovered"""
+        (NODES_DIR / f"{node}.json").unlink(missing_ok=True)
+    
+    def close(self):
+        """Leave the queue: release every lease and remove this node's heartbeat"""
+        for shard in list(self.held):
+            self.release(shard)
+        self.forget(self.node)
+
+
+class LogWriter:
+    """Appends log records to daemon.log, from a background thread once started"""
+
+    BATCH = 256  # most records written per flush
+
+    def __init__(self, path=None, format=None, max_bytes=None, backups=None, echo=True):
+        self.path = path
+        self.format = format or LOG_FORMAT
+        self.max_bytes = LOG_MAX_BYTES if max_bytes is None else max_bytes
+        self.backups = LOG_BACKUPS if backups is None else backups
+        self.echo = echo
+        self.records = queue.SimpleQueue()
+        self.thread = None
+        self.file = None
+
+    def format_record(self, record):
+        """Render one record as a log line"""
+        if self.format == 'json':
+            return json.dumps(record, default=str) + '\n'
+        return f"{record['time']} [{record['level']}] {record['message']}\n"
+
+    def write(self, message, level='INFO', **fields):
+        """Queue a record for the writer thread, or write it now if there is none"""
+        record = {'time': datetime.now().isoformat(), 'level': level, 'message': message}
+        record.update((k, v) for k, v in fields.items() if v is not None)
+        if self.thread is None:
+            self._write([record])
+            self._close()
+        else:
+            self.records.put(record)
+
+    def _write(self, records):
+        """Write a batch of records with one write per destination"""
+        lines = ''.join(self.format_record(r) for r in records)
+        if self.echo:
+            sys.stdout.write(lines)
+            sys.stdout.flush()
+        if self.file is None:
+            self.file = open(self.path or LOG_FILE, 'a')
+        self.file.write(lines)
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """Shift daemon.log to daemon.log.1 and so on, dropping the oldest"""
+        self._close()
+        path = Path(self.path or LOG_FILE)
+        if not self.backups:
+            path.unlink(missing_ok=True)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            older = path.with_name(f"{path.name}.{i}")
+            if older.exists():
+                older.replace(path.with_name(f"{path.name}.{i + 1}"))
+        path.replace(path.with_name(f"{path.name}.1"))
+
+    def _close(self):
+        """Close the log file if it is open"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _loop(self):
+        """Writer thread body: block for one record, then drain whatever else is queued"""
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            done = any(r is None for r in batch)
+            batch = [r for r in batch if r is not None]
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                print(f"Log write failed: {e}", file=sys.stderr)
+            if done:
+                self._close()
+                return
+
+    def start(self):
+        """Hand writes off to a background thread"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name='log-writer', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Flush queued records and go back to writing synchronously"""
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def parse_size(value):
+    """Parse a byte count given as an int or a string like '512M' or '2G'"""
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    text = str(value).strip().lower().rstrip('b')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# Started in place of a limited job's command: joins the job's cgroup, lowers the
+# rlimits and execs the command, so no Python runs between fork and exec
+LIMITS_WRAPPER = '''
+import json, os, resource, sys
+procs, pairs, executable, argv = sys.argv[1], json.loads(sys.argv[2]), sys.argv[3], sys.argv[4:]
+if procs:
+    with open(procs, 'w') as f:
+        f.write('0')
+for rlimit, soft, hard in pairs:
+    resource.setrlimit(rlimit, (soft, hard))
+os.execv(executable, argv)
+'''
+
+
+class ResourceLimits:
+    """A job's rlimits and optional cgroup, applied by a wrapper that execs the command"""
+
+    # Signs in a failed job's stderr that an allocation or fork was refused
+    MEMORY_ERRORS = ('MemoryError', 'Cannot allocate memory', 'out of memory', 'bad_alloc')
+    FORK_ERRORS = ('Resource temporarily unavailable', 'fork: retry')
+    FILE_ERRORS = ('File too large',)
+
+    def __init__(self, limits, name):
+        unknown = set(limits) - set(LIMIT_RESOURCES)
+        if unknown:
+            raise ValueError(f"Unknown limits: {', '.join(sorted(unknown))}")
+        self.limits = {key: parse_size(value) if key.endswith('_bytes') else int(value)
+                       for key, value in limits.items()}
+        self.name = name
+        self.cgroup = None
+
+    def setup(self):
+        """Create the job's cgroup when memory or process limits can be delegated to one"""
+        delegated = {'memory_bytes': 'memory.max', 'processes': 'pids.max'}
+        wanted = {key: delegated[key] for key in self.limits if key in delegated}
+        if not wanted:
+            return
+        path = Path(CGROUP_ROOT) / f"job-{os.getpid()}-{self.name}" if CGROUP_ROOT else None
+        try:
+            if not path:
+                raise OSError("BRAIN_EXEC_CGROUP is not set")
+            path.mkdir()
+            for key, control in wanted.items():
+                (path / control).write_text(str(self.limits[key]))
+            if 'memory_bytes' in wanted:
+                (path / 'memory.swap.max').write_text('0')
+        except OSError as e:
+            self.cleanup(path)
+            if 'processes' in wanted:
+                raise ValueError(f"The processes limit needs a delegated cgroup: {e}")
+            # No delegation or controller here: fall back to RLIMIT_AS
+            return
+        self.cgroup = path
+
+    def rlimits(self):
+        """(resource, (soft, hard)) pairs for the limits not handled by the cgroup"""
+        pairs = []
+        for key, value in self.limits.items():
+            if LIMIT_RESOURCES[key] is None or (self.cgroup and key == 'memory_bytes'):
+                continue
+            # SIGXCPU at the limit, SIGKILL a second later if it is ignored
+            hard = value + 1 if key == 'cpu_seconds' else value
+            pairs.append((LIMIT_RESOURCES[key], (value, hard)))
+        return pairs
+
+    def wrap(self, cmd, shell, env=None):
+        """Argument list that runs cmd under LIMITS_WRAPPER, which applies the limits and execs it"""
+        argv = ['/bin/sh', '-c', cmd] if shell else list(cmd)
+        executable = argv[0]
+        if os.sep not in executable:
+            executable = shutil.which(executable, path=os.pathsep.join(os.get_exec_path(env)))
+        if not executable:
+            # The same error Popen raises, so a missing command fails the same way with limits
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), argv[0])
+        procs = str(self.cgroup / 'cgroup.procs') if self.cgroup else ''
+        pairs = [[rlimit, soft, hard] for rlimit, (soft, hard) in self.rlimits()]
+        return [sys.executable, '-S', '-c', LIMITS_WRAPPER, procs, json.dumps(pairs), executable] + argv
+
+    def hit(self, returncode, usage, stderr):
+        """Name of the limit that ended the job, or None"""
+        events = self.cgroup_events()
+        if events.get('memory.oom_kill'):
+            return 'memory_bytes'
+        if events.get('pids.max'):
+            return 'processes'
+        if not returncode:
+            return None
+        # A shell reports a child killed by signal N as exit status 128 + N
+        signum = -returncode if returncode < 0 else returncode - 128
+        cpu = usage['user_cpu'] + usage['system_cpu'] if usage else 0
+        if 'cpu_seconds' in self.limits and (
+                signum == signal.SIGXCPU or
+                (signum == signal.SIGKILL and cpu >= self.limits['cpu_seconds'])):
+            return 'cpu_seconds'
+        if 'file_size_bytes' in self.limits and signum == signal.SIGXFSZ:
+            return 'file_size_bytes'
+        # Otherwise look for the refused allocation, fork or write in stderr
+        checks = [('file_size_bytes', self.FILE_ERRORS), ('memory_bytes', self.MEMORY_ERRORS),
+                  ('processes', self.FORK_ERRORS)]
+        for key, errors in checks:
+            if key in self.limits and any(e in stderr for e in errors):
+                return key
+        return None
+
+    def cgroup_events(self):
+        """Counters from the cgroup's memory.events and pids.events"""
+        events = {}
+        if self.cgroup:
+            for name in ('memory.events', 'pids.events'):
+                try:
+                    for line in (self.cgroup / name).read_text().splitlines():
+                        key, value = line.split()
+                        events[f"{name.split('.')[0]}.{key}"] = int(value)
+                except (OSError, ValueError):
+                    continue
+        return events
+
+    def cleanup(self, path=None):
+        """Remove the job's cgroup once its processes are gone"""
+        path = path or self.cgroup
+        if path:
+            try:
+                path.rmdir()
+            except OSError:
+                pass
+
+
+class WarmWorker:
+    """A pooled Python process that runs python-warm jobs in-process, one at a time"""
 
-class QueueProcessor:
     def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), 'warm-worker'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            start_new_session=True
+        )
+        self.jobs = 0
+        self.rss = 0
+        self.buffer = b''
+
+    def send(self, argv, captures):
+        """Start python argv with its output written to the capture paths; False if the worker is gone"""
+        request = {'argv': argv, 'stdout': str(captures['stdout']), 'stderr': str(captures['stderr'])}
+        self.jobs += 1
+        try:
+            self.process.stdin.write(json.dumps(request).encode() + b'\n')
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            return False
+        return True
+
+    def feed(self):
+        """Read what the worker has replied so far; the reply once complete, else None"""
+        chunk = os.read(self.process.stdout.fileno(), 65536)
+        if not chunk:
+            return self.died()
+        self.buffer += chunk
+        if b'\n' not in self.buffer:
+            return None
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        reply = json.loads(line)
+        self.rss = reply.get('max_rss', 0)
+        return reply
+
+    def died(self):
+        """Reply for a job whose worker exited under it (os._exit, a crash or a kill)"""
+        self.process.wait()
+        return {'returncode': self.process.returncode or 1}
+
+    @property
+    def usable(self):
+        """Whether the worker can take another job"""
+        return (self.process.poll() is None and self.jobs < WARM_MAX_JOBS
+                and self.rss < WARM_MAX_RSS)
+
+    def close(self):
+        """Ask the worker to exit after its current job"""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            kill_group(self.process, 0)
+        self.process.stdout.close()
+
+
+class WarmPool:
+    """Idle warm workers, pre-forked at start-up and replaced in the background when worn out"""
+
+    def __init__(self, size=None):
+        self.size = WARM_WORKERS if size is None else size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.started = 0
+        # Workers being started by fill(); until start() the pool only starts them on demand
+        self.starting = 0
+        self.running = False
+
+    def start(self):
+        """Pre-fork the pool, so no job waits for an interpreter to start and preload"""
         self.running = True
-        self.current_process = None
+        self.fill()
+
+    def fill(self):
+        """Start workers until the pool has size idle (each preloads in its own process)"""
+        while True:
+            with self.lock:
+                if not self.running or len(self.idle) + self.starting >= self.size:
+                    return
+                self.starting += 1
+                self.started += 1
+            worker = WarmWorker()
+            with self.lock:
+                self.starting -= 1
+                if self.running:
+                    self.idle.append(worker)
+                    continue
+            worker.close()
+            return
+
+    def replenish(self):
+        """Replace retired workers on a background thread"""
+        if self.running:
+            threading.Thread(target=self.fill, name='warm-pool', daemon=True).start()
+
+    def acquire(self):
+        """An idle worker, or a freshly started one"""
+        retired = []
+        with self.lock:
+            while self.idle:
+                worker = self.idle.pop()
+                if worker.usable:
+                    break
+                retired.append(worker)
+            else:
+                worker = None
+                self.started += 1
+        for spent in retired:
+            spent.close()
+        if retired:
+            self.replenish()
+        return worker or WarmWorker()
+
+    def release(self, worker):
+        """Return a worker to the pool, retiring it if spent or surplus"""
+        with self.lock:
+            if worker.usable and len(self.idle) < self.size:
+                self.idle.append(worker)
+                return
+        worker.close()
+        if not worker.usable:
+            self.replenish()
+
+    def close(self):
+        """Stop every idle worker"""
+        with self.lock:
+            self.running = False
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            # No job to let finish, and it may still be preloading
+            kill_group(worker.process, KILL_GRACE)
+            worker.close()
+
+
+def run_warm_job(request):
+    """Run one python-warm job in this interpreter with a fresh __main__; return its exit code"""
+    argv = request['argv']
+    saved = {'argv': sys.argv, 'main': sys.modules['__main__'], 'path': list(sys.path),
+             'cwd': os.getcwd(), 'environ': dict(os.environ), 'fds': (os.dup(1), os.dup(2))}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(request['stdout'], 'wb') as out, open(request['stderr'], 'wb') as err:
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+    main = types.ModuleType('__main__')
+    sys.modules['__main__'] = main
+    try:
+        if argv[:1] == ['-c']:
+            sys.argv = ['-c'] + argv[2:]
+            sys.path.insert(0, '')
+            exec(compile(argv[1], '<string>', 'exec'), main.__dict__)
+        elif argv[:1] == ['-m']:
+            sys.argv = argv[1:]
+            runpy.run_module(argv[1], run_name='__main__', alter_sys=True)
+        else:
+            sys.argv = argv
+            sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+            runpy.run_path(argv[0], run_name='__main__')
+        returncode = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            returncode = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, copy in zip((1, 2), saved['fds']):
+            os.dup2(copy, fd)
+            os.close(copy)
+        sys.argv = saved['argv']
+        sys.modules['__main__'] = saved['main']
+        sys.path[:] = saved['path']
+        os.chdir(saved['cwd'])
+        os.environ.clear()
+        os.environ.update(saved['environ'])
+    return returncode
+
+
+def warm_worker():
+    """Pool process: preload modules, then serve python-warm jobs from stdin until EOF"""
+    for name in WARM_PRELOAD:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    # Keep the protocol pipes private; jobs see /dev/null on stdin and stdout
+    requests = os.fdopen(os.dup(0), 'rb')
+    replies = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    for line in requests:
+        returncode = run_warm_job(json.loads(line))
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_SCALE
+        replies.write(json.dumps({'returncode': returncode, 'max_rss': rss}).encode() + b'\n')
+        replies.flush()
+    return 0
+
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    HELP = {
+        'brain_exec_jobs_total': ('counter', 'Jobs finished, by job type and final status'),
+        'brain_exec_timeouts_total': ('counter', 'Jobs killed for exceeding their timeout'),
+        'brain_exec_wait_seconds': ('histogram', 'Time from a job being seen in pending/ to being claimed'),
+        'brain_exec_run_seconds': ('histogram', 'Time from a job being claimed to its result being written'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter"""
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += amount
+
+    def observe(self, name, value, **labels):
+        """Record one sample in a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.histograms.setdefault(key, [0] * len(self.BUCKETS) + [0, 0.0])
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def collect(self, name, kind, help, func):
+        """Register a value read at scrape time"""
+        self.collectors.append((name, kind, help, func))
+
+    @staticmethod
+    def labels(pairs, extra=()):
+        """Format label pairs as {k="v",...}"""
+        pairs = tuple(pairs) + tuple(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, kind, help, func in self.collectors:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {func()}"]
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+        for name, (kind, help) in self.HELP.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append(f"{name}{self.labels(labels)} {value:g}")
+            for (metric, labels), counts in histograms:
+                if metric != name:
+                    continue
+                for bound, count in zip(self.BUCKETS, counts):
+                    lines.append(f"{name}_bucket{self.labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self.labels(labels, [('le', '+Inf')])} {counts[-2]}")
+                lines.append(f"{name}_sum{self.labels(labels)} {counts[-1]:g}")
+                lines.append(f"{name}_count{self.labels(labels)} {counts[-2]}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves GET /metrics from the processor attached to the HTTP server"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.processor.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JobEvents:
+    """Fans job output and results out to the API clients waiting on each job"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, name, output=False):
+        """Queue that receives the events of a job (its output too if output is set)"""
+        events = queue.Queue()
+        with self.lock:
+            self.subscribers.setdefault(name, []).append((events, output))
+        return events
+
+    def unsubscribe(self, name, events):
+        """Stop delivering a job's events to a queue"""
+        with self.lock:
+            remaining = [s for s in self.subscribers.get(name, []) if s[0] is not events]
+            if remaining:
+                self.subscribers[name] = remaining
+            else:
+                self.subscribers.pop(name, None)
+
+    def streaming(self, name):
+        """Whether anyone is following a job's output"""
+        return any(output for _, output in self.subscribers.get(name, ()))
+
+    def publish(self, name, event):
+        """Deliver an event to a job's subscribers; output only goes to those streaming it"""
+        with self.lock:
+            targets = [events for events, output in self.subscribers.get(name, ())
+                       if output or event['event'] != 'output']
+        for events in targets:
+            events.put(event)
+
+    def close(self):
+        """Tell every waiting client that the server is going away"""
+        with self.lock:
+            subscribers = [(name, list(entries)) for name, entries in self.subscribers.items()]
+        for name, entries in subscribers:
+            for events, _ in entries:
+                events.put({'ok': False, 'event': 'closed', 'id': name, 'error': 'Server stopping'})
+
+
+class ApiHandler(socketserver.StreamRequestHandler):
+    """Answers newline-delimited JSON requests on the processor's Unix socket"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Request is not a JSON object")
+                for reply in self.server.processor.api_request(request):
+                    self.send(reply)
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away
+                return
+            except Exception as e:
+                self.send({'ok': False, 'error': str(e)})
+
+    def send(self, reply):
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+        self.wfile.flush()
+
+
+class OutputSink:
+    """Streams one child output stream into a preview buffer and a spool file"""
+
+    def __init__(self, spool_path, keep=False, listener=None):
+        self.spool_path = Path(spool_path)
+        self.keep = keep
+        self.listener = listener
+        self.preview_limit = OUTPUT_PREVIEW_BYTES
+        self.max_bytes = OUTPUT_MAX_BYTES
+        self.preview = bytearray()
+        self.total = 0
+        self.written = 0
+        self.truncated = False
+        self.spool = None
+
+    def write(self, chunk):
+        """Account for a chunk of output"""
+        if self.listener:
+            self.listener(chunk)
+        room = max(self.preview_limit - len(self.preview), 0)
+        if room:
+            self.preview += chunk[:room]
+        self.total += len(chunk)
+        if self.spool is None:
+            # Output that fits in the preview never touches the disk
+            if not self.keep and self.total <= self.preview_limit:
+                return
+            self.open_spool()
+            chunk = chunk[room:]
+        self._store(chunk)
+    
+    def open_spool(self):
+        """Start the spool file with the preview so far, if it is not open yet"""
+        if self.spool is None:
+            self.spool = open(self.spool_path, 'wb')
+            self._store(bytes(self.preview))
+    
+    def read(self, offset, limit):
+        """Up to limit bytes of the output so far, from offset"""
+        if self.spool is None:
+            return bytes(self.preview[offset:offset + limit])
+        try:
+            self.spool.flush()
+            with open(self.spool_path, 'rb') as f:
+                f.seek(offset)
+                return f.read(limit)
+        except (ValueError, FileNotFoundError):
+            # The job finished meanwhile; its result has the output now
+            return b''
+
+    def _store(self, data):
+        """Append to the spool, enforcing the byte cap"""
+        if self.truncated or not data:
+            return
+        allowed = self.max_bytes - self.written
+        if len(data) > allowed:
+            data = data[:allowed]
+            self.truncated = True
+        self.spool.write(data)
+        self.written += len(data)
+        if self.truncated:
+            self.spool.write(f"\n[... output truncated at {self.max_bytes} bytes ...]\n".encode())
+
+    def close(self):
+        """Flush and close the spool file"""
+        if self.spool:
+            self.spool.close()
+
+    def result_fields(self, stream, dest_dir):
+        """Move the spool next to the result and describe it for the result block"""
+        text = self.preview.decode('utf-8', 'replace')
+        if self.total > len(self.preview):
+            text += f"\n[... preview truncated, {self.total} bytes total ...]\n"
+        fields = {stream: text}
+        if self.spool and not self.keep and self.total <= self.preview_limit:
+            # Spooled only so a tail could be read while the job ran
+            self.spool_path.unlink(missing_ok=True)
+        elif self.spool:
+            path = self.spool_path
+            if not self.keep:
+                path = dest_dir / self.spool_path.name
+                os.replace(self.spool_path, path)
+            fields[f'{stream}_file'] = str(path)
+            fields[f'{stream}_bytes'] = self.total
+        if self.truncated:
+            fields[f'{stream}_truncated'] = True
+        return fields
+
+
+class JobProgress:
+    """A running job's progress record, rewritten in running/ every PROGRESS_INTERVAL seconds"""
+
+    def __init__(self, path, name, pid, sinks, listener=None, log=None):
+        self.path = Path(path)
+        self.name = name
+        self.pid = pid
+        self.sinks = sinks
+        self.listener = listener
+        self.log = log or (lambda message, level='INFO': None)
+        self.started_at = time.time()
+        self.next_at = time.monotonic() + PROGRESS_INTERVAL
+        # The latest ##progress line, and the unfinished line it may be in
+        self.reported = None
+        self.partial = b''
+        self.overlong = False
+
+    def scan(self, chunk):
+        """Pick ##progress lines out of a chunk of stdout"""
+        data = self.partial + chunk
+        end = data.rfind(b'\n') + 1
+        lines, self.partial = data[:end], data[end:]
+        if PROGRESS_MARKER in lines:
+            for number, line in enumerate(lines.splitlines()):
+                # The start of an over-long line was dropped, so its tail is not a marker
+                if line.startswith(PROGRESS_MARKER) and not (number == 0 and self.overlong):
+                    self.reported = parse_progress(line.decode('utf-8', 'replace')) or self.reported
+        if end:
+            self.overlong = False
+        if len(self.partial) > PROGRESS_LINE_MAX:
+            self.partial, self.overlong = b'', True
+
+    def due(self):
+        """Seconds until the record is next rewritten"""
+        return max(self.next_at - time.monotonic(), 0)
+
+    def tick(self):
+        """Rewrite the record if it is due"""
+        now = time.monotonic()
+        if now < self.next_at:
+            return
+        self.next_at = now + PROGRESS_INTERVAL
+        for sink in self.sinks.values():
+            # From here on every byte is on disk, so a tail can read it by offset
+            sink.open_spool()
+            sink.spool.flush()
+        record = self.record()
+        try:
+            write_atomic(self.path, json.dumps(record, indent=2), durable=False)
+        except OSError as e:
+            self.log(f"Cannot write {self.path.name}: {e}", 'ERROR')
+        if self.listener:
+            self.listener(record)
+
+    def record(self):
+        """Elapsed time, output so far, resource usage and reported progress"""
+        record = {
+            'id': self.name,
+            'state': 'running',
+            'pid': self.pid,
+            'started_at': round(self.started_at, 6),
+            'elapsed': round(time.time() - self.started_at, 3),
+        }
+        for stream, sink in self.sinks.items():
+            record[f'{stream}_bytes'] = sink.total
+            if sink.spool:
+                record[f'{stream}_file'] = str(sink.spool_path)
+        record.update(process_usage(self.pid) or {})
+        if self.reported:
+            record['progress'] = self.reported
+        record['updated_at'] = round(time.time(), 6)
+        return record
+
+    def close(self):
+        """Remove the record once the job has finished"""
+        self.path.unlink(missing_ok=True)
+
+
+class QueueProcessor:
+    engine = 'threads'
+    
+    def __init__(self, watcher=None, workers=1, archive=True, metrics_port=None, api=None,
+                 results=None, node=None):
+        self.running = True
+        self.logger = LogWriter()
+        self.workers = max(1, workers)
+        self.watcher_backend = watcher
+        self.watcher = None
+        self.pending = PendingIndex()
+        self.graph = JobGraph(lookup=self.lookup_finished)
+        self.meta = PendingJobs()
+        self.admission = Admission()
+        self.coalesce = Coalescer()
+        # (retry_at, name) of jobs backing off before another attempt
+        self.delayed = []
+        self.scheduler = Scheduler(log=self.log)
+        self.cache = ResultCache()
+        self.index = JobIndex()
+        self.results = make_result_store(results)
+        self.node = node or NODE
+        self.leases = None
+        # The node holding the first shard runs schedules and retention for everyone
+        self.leading = True
+        self.running_dir = RUNNING_DIR
+        self.api_socket = API_SOCKET
+        if self.node:
+            if '/' in self.node or self.node.startswith('.'):
+                raise ValueError(f"Invalid node name: {self.node}")
+            if self.results.name == 'log':
+                raise ValueError("The log result store has a single writer; nodes need the files store")
+            self.leases = ShardLeases(self.node, log=self.log)
+            self.leading = False
+            self.running_dir = RUNNING_DIR / self.node
+            self.api_socket = API_SOCKET.with_name(f"exec.{self.node}.sock")
+        self.status_path = QUEUE_STATUS.with_name(f"queue_status.{self.node}.json") if self.node else QUEUE_STATUS
+        self.status_at = 0
+        self.status_dirty = False
+        self.archive = ResultArchive(log=self.log, results=self.results,
+                                     leader=lambda: self.leading) if archive else None
+        # Seen/claimed timestamps of jobs currently held by a worker
+        self.timing = {}
+        self.metrics = Metrics()
+        self.warm = WarmPool()
+        self.metrics_port = METRICS_PORT if metrics_port is None else metrics_port
+        self.metrics_server = None
+        self.api = API_ENABLED if api is None else api
+        self.api_server = None
+        self.events = JobEvents()
+        self.metrics.collect('brain_exec_queue_depth', 'gauge', 'Jobs ready to run in pending/',
+                             lambda: len(self.pending))
+        self.metrics.collect('brain_exec_waiting_jobs', 'gauge', 'Jobs waiting on dependencies',
+                             lambda: len(self.graph.waiting))
+        self.metrics.collect('brain_exec_running_jobs', 'gauge', 'Jobs claimed by a worker',
+                             lambda: len(self.timing))
+        self.metrics.collect('brain_exec_delayed_jobs', 'gauge', 'Jobs waiting to be retried',
+                             lambda: len(self.delayed))
+        self.metrics.collect('brain_exec_pending_bytes', 'gauge', 'Size of the queued job files',
+                             lambda: self.meta.bytes)
+        self.metrics.collect('brain_exec_admission_shedding', 'gauge',
+                             'Whether new jobs are being rejected by admission control',
+                             lambda: int(bool(self.admission.shedding)))
+        self.metrics.collect('brain_exec_shards_held', 'gauge', 'pending/ shards leased by this node',
+                             lambda: len(self.leases.held) if self.leases else 0)
+        self.metrics.collect('brain_exec_coalesced_total', 'counter',
+                             "Jobs answered by an identical job's run",
+                             lambda: self.coalesce.coalesced)
+        self.metrics.collect('brain_exec_cache_hits_total', 'counter', 'Result cache hits',
+                             lambda: self.cache.hits)
+        self.metrics.collect('brain_exec_cache_misses_total', 'counter', 'Result cache misses',
+                             lambda: self.cache.misses)
+        # Guards the pending index, job graph and the table of in-flight children
+        self.cond = threading.Condition()
+        self.active = {}
+        self.progress = {}
+        
+    def log(self, message, level='INFO', **fields):
+        """Log message to daemon.log"""
+        self.logger.write(message, level, **fields)
+    
+    def stop(self, signum=None, frame=None):
+        """Gracefully stop the processor"""
+        self.log("Received stop signal, shutting down...")
+        self.running = False
+        with self.cond:
+            for process in list(self.active.values()):
+                signal_group(process, signal.SIGTERM)
+            self.cond.notify_all()
+        if self.watcher:
+            self.watcher.wake()
+    
+    def spawn(self, job_file, cmd, shell, limits=None, options=None):
+        """Start a job's child process and track it for shutdown"""
+        if limits:
+            cmd, shell = limits.wrap(cmd, shell, (options or {}).get('env')), False
+        with job_stdin(options) as stdin:
+            process = subprocess.Popen(
+                cmd,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                shell=shell,
+                **spawn_kwargs(options)
+            )
+        self.track(job_file, process)
+        return process
+    
+    def track(self, job_file, process):
+        """Record a job's child for stop(), or signal it now if stop() has already gone through"""
+        with self.cond:
+            self.active[job_file.name] = process
+            if not self.running:
+                signal_group(process, signal.SIGTERM)
+    
+    def untrack(self, job_file):
+        """Forget a finished job's child process and remove its progress record"""
+        with self.cond:
+            self.active.pop(job_file.name, None)
+            progress = self.progress.pop(job_file.name, None)
+        if progress:
+            progress.close()
+    
+    def track_progress(self, job_file, process, sinks):
+        """Start keeping a progress record for a spawned job"""
+        name = job_file.name
+        
+        def publish(record):
+            if self.events.streaming(name):
+                self.events.publish(name, dict(record, ok=True, event='progress'))
+        progress = JobProgress(self.running_dir / f"{name}.progress", name, process.pid, sinks,
+                               listener=publish, log=self.log)
+        with self.cond:
+            self.progress[name] = progress
+        return progress
+    
+    def stream_output(self, process, sinks, timeout, progress=None):
+        """Copy the child's stdout/stderr into their sinks until EOF, then reap it"""
+        deadline = time.monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ, sinks['stdout'])
+            selector.register(process.stderr, selectors.EVENT_READ, sinks['stderr'])
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(process.args, timeout)
+                for key, _ in selector.select(min(remaining, progress.due()) if progress else remaining):
+                    chunk = os.read(key.fd, OUTPUT_CHUNK)
+                    if chunk:
+                        key.data.write(chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+                if progress:
+                    progress.tick()
+        return reap(process, max(deadline - time.monotonic(), 0))
+    
+    def execute(self, job_file, cmd, shell, result_path=None, timeout=None, limits=None, options=None):
+        """Run a command, streaming its output to spool files, and return the result block"""
+        self.running_dir.mkdir(parents=True, exist_ok=True)
+        timeout = job_timeout(timeout)
+        limits = ResourceLimits(limits, job_file.name) if limits else None
+        if limits:
+            limits.setup()
+        started = time.monotonic()
+        try:
+            process = self.spawn(job_file, cmd, shell, limits, options)
+        except Exception:
+            if limits:
+                limits.cleanup()
+            raise
+        sinks = self.output_sinks(job_file, result_path)
+        progress = self.track_progress(job_file, process, sinks)
+        
+        try:
+            usage = self.stream_output(process, sinks, timeout, progress)
+            returncode = process.returncode
+            result = {
+                'status': 'completed' if returncode == 0 else 'failed',
+                'returncode': returncode
+            }
+        except subprocess.TimeoutExpired:
+            usage = kill_group(process, KILL_GRACE)
+            result = self.timed_out(job_file, timeout)
+        finally:
+            self.untrack(job_file)
+            for pipe in (process.stdout, process.stderr):
+                pipe.close()
+            for sink in sinks.values():
+                sink.close()
+        
+        if progress.reported:
+            result['progress'] = progress.reported
+        if limits:
+            self.check_limits(job_file, limits, result, process.returncode, usage, sinks)
+        return self.finish_result(job_file, result, sinks, started, usage)
+    
+    def check_limits(self, job_file, limits, result, returncode, usage, sinks):
+        """Report the job's limits and whether one of them stopped it, then drop its cgroup"""
+        result['limits'] = limits.limits
+        result['limit_hit'] = limits.hit(returncode, usage,
+                                         sinks['stderr'].preview.decode('utf-8', 'replace'))
+        limits.cleanup()
+        if result['limit_hit']:
+            self.log(f"Job {job_file.name} hit its {result['limit_hit']} limit", 'WARNING')
+    
+    def output_sinks(self, job_file, result_path=None):
+        """stdout/stderr sinks spooling to running/ (or a requested result_file)"""
+        return {
+            # A requested result_file is fed from the stdout stream directly
+            'stdout': OutputSink(result_path or self.running_dir / f"{job_file.name}.stdout",
+                                 keep=result_path is not None,
+                                 listener=self.output_listener(job_file, 'stdout')),
+            'stderr': OutputSink(self.running_dir / f"{job_file.name}.stderr",
+                                 listener=self.output_listener(job_file, 'stderr'))
+        }
+    
+    def output_listener(self, job_file, stream):
+        """Callback scanning stdout for progress lines and publishing chunks to API clients"""
+        name = job_file.name
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        
+        def publish(chunk):
+            progress = self.progress.get(name)
+            if progress and stream == 'stdout':
+                progress.scan(chunk)
+            if self.events.streaming(name):
+                self.events.publish(name, {'ok': True, 'event': 'output', 'id': name,
+                                           'stream': stream, 'data': decoder.decode(chunk)})
+        return publish
+    
+    def timed_out(self, job_file, timeout):
+        """Result block for a job killed at its timeout"""
+        self.metrics.inc('brain_exec_timeouts_total', type=job_type(job_file))
+        self.log(f"Job {job_file.name} timed out", 'ERROR')
+        return {
+            'status': 'failed',
+            'error': f'Timeout after {timeout:g} seconds',
+            'timed_out': True
+        }
+    
+    def finish_result(self, job_file, result, sinks, started, usage=None):
+        """Add output, timing and resource usage to a result block"""
+        # Spools travel with the result into completed/ or failed/
+        dest_dir = COMPLETED_DIR if result['status'] == 'completed' else FAILED_DIR
+        for stream, sink in sinks.items():
+            result.update(sink.result_fields(stream, dest_dir))
+        result['duration'] = round(time.monotonic() - started, 3)
+        result['timing'] = self.job_timing(job_file, time.time() - result['duration'])
+        if usage:
+            result['rusage'] = usage
+        result['completed_at'] = datetime.now().isoformat()
+        return result
+    
+    def execute_warm(self, job_file, cmd, result_path=None, timeout=None):
+        """Run a python-warm job on a pooled interpreter and return the result block"""
+        self.running_dir.mkdir(parents=True, exist_ok=True)
+        timeout = job_timeout(timeout)
+        if isinstance(cmd, str):
+            raise ValueError("python-warm jobs take an argv, not a shell command line")
+        argv = list(cmd)
+        if not Path(argv[0]).name.startswith('python'):
+            raise ValueError(f"python-warm jobs must run python, not {argv[0]}")
+        
+        started = time.monotonic()
+        worker = self.warm.acquire()
+        self.track(job_file, worker.process)
+        sinks = self.output_sinks(job_file, result_path)
+        progress = self.track_progress(job_file, worker.process, sinks)
+        captures, pipes = self.warm_captures(job_file)
+        try:
+            reply = self.stream_warm(worker, argv[1:], captures, pipes, sinks, timeout, progress)
+            result = {
+                'status': 'completed' if reply['returncode'] == 0 else 'failed',
+                'returncode': reply['returncode'],
+                'runner': 'python-warm'
+            }
+        except subprocess.TimeoutExpired:
+            kill_group(worker.process, KILL_GRACE)
+            result = self.timed_out(job_file, timeout)
+        finally:
+            self.untrack(job_file)
+            self.warm.release(worker)
+            for path in captures.values():
+                path.unlink(missing_ok=True)
+            for fd in pipes.values():
+                os.close(fd)
+            for sink in sinks.values():
+                sink.close()
+        
+        if progress.reported:
+            result['progress'] = progress.reported
+        return self.finish_result(job_file, result, sinks, started)
+    
+    def warm_captures(self, job_file):
+        """FIFOs in running/ for a warm job's stdout/stderr, and their read ends"""
+        captures, pipes = {}, {}
+        try:
+            for stream in ('stdout', 'stderr'):
+                path = self.running_dir / f"{job_file.name}.warm.{stream}"
+                path.unlink(missing_ok=True)
+                os.mkfifo(path)
+                captures[stream] = path
+                # Opened before the worker's open() so that does not block
+                pipes[stream] = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            for path in captures.values():
+                path.unlink(missing_ok=True)
+            for fd in pipes.values():
+                os.close(fd)
+            raise
+        return captures, pipes
+    
+    def stream_warm(self, worker, argv, captures, pipes, sinks, timeout, progress):
+        """Run a job on a warm worker, copying its output into the sinks as it is written"""
+        deadline = time.monotonic() + timeout
+        # Until the reply, a write end of our own keeps the FIFOs from reading as
+        # closed before the worker has opened them
+        holders = [os.open(captures[stream], os.O_WRONLY | os.O_NONBLOCK) for stream in pipes]
+        
+        def let_go():
+            while holders:
+                os.close(holders.pop())
+        try:
+            reply = None if worker.send(argv, captures) else worker.died()
+            with selectors.DefaultSelector() as selector:
+                for stream, fd in pipes.items():
+                    selector.register(fd, selectors.EVENT_READ, sinks[stream])
+                if reply is None:
+                    selector.register(worker.process.stdout, selectors.EVENT_READ)
+                else:
+                    let_go()
+                while selector.get_map():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise subprocess.TimeoutExpired(worker.process.args, timeout)
+                    for key, _ in selector.select(min(remaining, progress.due())):
+                        if key.data is None:
+                            reply = worker.feed()
+                            if reply is not None:
+                                selector.unregister(key.fileobj)
+                                let_go()
+                            continue
+                        chunk = os.read(key.fd, OUTPUT_CHUNK)
+                        if chunk:
+                            key.data.write(chunk)
+                        else:
+                            selector.unregister(key.fileobj)
+                    progress.tick()
+        finally:
+            let_go()
+        return reply
+    
+    def job_timing(self, job_file, started):
+        """Epoch timestamps for a job's result block: seen, claimed, command start and end"""
+        timing = dict(self.timing.get(job_file.name, {}))
+        timing['started_at'] = round(started, 6)
+        timing['ended_at'] = round(time.time(), 6)
+        if 'seen_at' in timing:
+            timing['wait'] = round(timing['claimed_at'] - timing['seen_at'], 6)
+        return timing
+    
+    def run_json_command(self, job_file, data, cmd):
+        """Execute a JSON job's command (or answer it from the cache) and return its result block"""
+        key, result_path, result = self.prepare_json_command(job_file, data, cmd)
+        if result:
+            return result
+        
+        options = spawn_options(data)
+        # The pool's interpreters share one cwd, env and stdin, so jobs setting them run normally
+        if data.get('runner') == 'python-warm' and not data.get('limits') and not options:
+            result = self.execute_warm(job_file, cmd, result_path, timeout=data.get('timeout'))
+        else:
+            result = self.execute(job_file, cmd, isinstance(cmd, str), result_path,
+                                  timeout=data.get('timeout'), limits=data.get('limits'),
+                                  options=options)
+        return self.json_command_done(key, result_path, result)
+    
+    def prepare_json_command(self, job_file, data, cmd):
+        """Cache key, result_file path and (on a cache hit) the result for a JSON job's command"""
+        result_path = QUEUE_BASE / data['result_file'] if 'result_file' in data else None
+        key = cache_key(data, cmd) if data.get('cacheable') else None
+        if key:
+            result = self.cached_result(job_file, key, data, result_path)
+            if result:
+                return key, result_path, result
+        
+        self.log(f"Executing: {' '.join(cmd if isinstance(cmd, list) else [cmd])}")
+        return key, result_path, None
+    
+    def json_command_done(self, key, result_path, result):
+        """Log and cache a JSON job's freshly executed result"""
+        if result_path and result_path.exists():
+            self.log(f"Saved results to {result_path}")
         
-    def log(self, message, level='INFO'):
-        """Log message to daemon.log"""
-        timestamp = datetime.now().isoformat()
-        log_entry = f"{timestamp} [{level}] {message}\n"
-        print(log_entry.strip())
-        with open(LOG_FILE, 'a') as f:
-            f.write(log_entry)
+        # Only successful runs whose output fit entirely in the result are cached
+        spooled = any(result.get(f'{stream}_bytes', 0) > OUTPUT_PREVIEW_BYTES
+                      for stream in ('stdout', 'stderr'))
+        if key and result['status'] == 'completed' and not spooled:
+            cached = {k: v for k, v in result.items()
+                      if k in ('status', 'returncode', 'stdout', 'stderr')}
+            self.cache.put(key, cached)
+        return result
     
-    def stop(self, signum=None, frame=None):
-        """Gracefully stop the processor"""
-        self.log("Received stop signal, shutting down...")
-        self.running = False
-        if self.current_process:
-            self.current_process.terminate()
+    def cached_result(self, job_file, key, data, result_path):
+        """Look up a cacheable job, returning a result block on a hit"""
+        cached = self.cache.get(key, data.get('cache_ttl', CACHE_TTL))
+        counts = f"hits={self.cache.hits} misses={self.cache.misses}"
+        if cached is None:
+            self.log(f"Cache miss for {job_file.name} ({counts})")
+            return None
+        
+        result = dict(cached, cached=True, completed_at=datetime.now().isoformat())
+        if result_path and result['stdout']:
+            result_path.write_text(result['stdout'])
+            result['stdout_file'] = str(result_path)
+        self.log(f"Cache hit for {job_file.name} ({counts})")
+        return result
+    
+    def save_result(self, job_file, dest_file, data):
+        """Write a job's result file, index it and remove the job file"""
+        # The result is durable before the job leaves running/, so a crash in between
+        # is recognised on restart instead of re-running the job
+        if self.node:
+            data['result']['node'] = self.node
+        self.results.write(dest_file, data)
+        # Scheduled runs exist only in memory
+        job_file.unlink(missing_ok=True)
+        result = data['result']
+        self.index.update(job_file.name, result['status'], finished_at=time.time(),
+                          task_id=str(data.get('task_id') or job_file.stem),
+                          returncode=result.get('returncode'), result_path=str(dest_file))
+        self.job_finished(job_file.name, result['status'], dest_file, result)
+        self.fan_out(job_file.name, result)
+    
+    def fan_out(self, name, result):
+        """Give each job coalesced into a finished run its own result file"""
+        with self.cond:
+            followers = [(follower, self.meta.pop(follower, None))
+                         for follower in self.coalesce.finish(name)]
+        for follower, meta in followers:
+            job_file = self.claim_job(follower)
+            if not job_file:
+                continue
+            with open(job_file) as f:
+                data = json.load(f)
+            data['result'] = dict(result, coalesced_with=name)
+            status = result['status']
+            dest_dir = COMPLETED_DIR if status == 'completed' else FAILED_DIR
+            self.save_result(job_file, dest_dir / follower, data)
+            self.log(f"Job {follower} {status} with {name}", job=follower, status=status,
+                     coalesced_with=name)
+            self.metrics.inc('brain_exec_jobs_total', type='json', status=status)
+            self.admission.finished()
+            if meta:
+                self.job_done(meta, status)
+    
+    def job_finished(self, name, status, result_path, result=None):
+        """Hand a job's final result to the API clients waiting on it"""
+        self.events.publish(name, {'ok': True, 'event': 'result', 'id': name, 'status': status,
+                                   'result_file': str(result_path), 'result': result})
     
     def process_json_job(self, job_file, data):
         """Process a JSON format job"""
         self.log(f"Processing JSON job: {job_file.name}")
         
-        # Extract command and arguments
-        if 'command' in data and 'args' in data:
-            # Format: {"command": "which", "args": ["node"]}
-            cmd = [data['command']] + data.get('args', [])
-        elif 'command' in data:
-            # Format: {"command": "python3 script.py"}
-            cmd = data['command']
-            if isinstance(cmd, str):
-                cmd = cmd.split()
-        else:
-            raise ValueError("No command found in job file")
-        
-        # Execute the command
-        self.log(f"Executing: {' '.join(cmd if isinstance(cmd, list) else [cmd])}")
+        try:
+            cmd = job_command(data)
+        except ValueError as e:
+            return self.json_job_failed(job_file, data, f"Invalid command: {e}", retry=False)
         
         try:
-            self.current_process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                shell=isinstance(cmd, str)
-            )
-            
-            stdout, stderr = self.current_process.communicate(timeout=300)  # 5 minute timeout
-            returncode = self.current_process.returncode
-            
-            # Update job data with results
-            data['result'] = {
-                'status': 'completed' if returncode == 0 else 'failed',
-                'returncode': returncode,
-                'stdout': stdout,
-                'stderr': stderr,
-                'completed_at': datetime.now().isoformat()
-            }
-            
-            # Save result file if specified
-            if 'result_file' in data and stdout:
-                result_path = QUEUE_BASE / data['result_file']
-                with open(result_path, 'w') as f:
-                    f.write(stdout)
-                self.log(f"Saved results to {result_path}")
-            
-            # Move to appropriate directory
-            dest_dir = COMPLETED_DIR if returncode == 0 else FAILED_DIR
-            dest_file = dest_dir / job_file.name
-            
-            # Write updated data
-            with open(dest_file, 'w') as f:
-                json.dump(data, f, indent=2)
-            
-            # Remove original
-            job_file.unlink()
-            
-            self.log(f"Job {job_file.name} {'completed' if returncode == 0 else 'failed'}")
-            
-        except subprocess.TimeoutExpired:
-            self.current_process.kill()
-            data['result'] = {
-                'status': 'failed',
-                'error': 'Timeout after 5 minutes',
-                'completed_at': datetime.now().isoformat()
-            }
-            dest_file = FAILED_DIR / job_file.name
-            with open(dest_file, 'w') as f:
-                json.dump(data, f, indent=2)
-            job_file.unlink()
-            self.log(f"Job {job_file.name} timed out", 'ERROR')
-            
+            return self.json_job_done(job_file, data, self.run_json_command(job_file, data, cmd))
         except Exception as e:
-            data['result'] = {
-                'status': 'failed',
-                'error': str(e),
-                'traceback': traceback.format_exc(),
-                'completed_at': datetime.now().isoformat()
-            }
-            dest_file = FAILED_DIR / job_file.name
-            with open(dest_file, 'w') as f:
-                json.dump(data, f, indent=2)
-            job_file.unlink()
-            self.log(f"Job {job_file.name} failed: {str(e)}", 'ERROR')
+            return self.json_job_failed(job_file, data, e)
+    
+    def json_job_done(self, job_file, data, result):
+        """Write a JSON job back with its result block and return its status"""
+        if result['status'] != 'completed' and self.retry_job(job_file, data, result):
+            return 'retrying'
+        self.add_attempts(data, result)
+        data['result'] = result
+        status = result['status']
         
-        finally:
-            self.current_process = None
+        # Move to appropriate directory
+        dest_dir = COMPLETED_DIR if status == 'completed' else FAILED_DIR
+        dest_file = dest_dir / job_file.name
+        
+        # Write updated data and remove the original
+        self.save_result(job_file, dest_file, data)
+        
+        self.log(f"Job {job_file.name} {status}", job=job_file.name, status=status,
+                 returncode=result.get('returncode'), duration=result.get('duration'))
+        return status
+    
+    def json_job_failed(self, job_file, data, error, retry=True):
+        """Write a JSON job to failed/ after an exception (call from the except block)"""
+        result = {
+            'status': 'failed',
+            'error': str(error),
+            'traceback': traceback.format_exc(),
+            'completed_at': datetime.now().isoformat()
+        }
+        # A malformed job would fail the same way on every attempt
+        if retry and self.retry_job(job_file, data, result):
+            return 'retrying'
+        self.add_attempts(data, result)
+        data['result'] = result
+        dest_file = FAILED_DIR / job_file.name
+        self.save_result(job_file, dest_file, data)
+        self.log(f"Job {job_file.name} failed: {str(error)}", 'ERROR', job=job_file.name)
+        return 'failed'
+    
+    def retry_job(self, job_file, data, result):
+        """Send a failed JSON job back to pending/ to run again later, if its policy allows"""
+        attempts = data.get('attempts', []) + [attempt_record(result, len(data.get('attempts', [])) + 1)]
+        if not retry_wanted(data, result, len(attempts)):
+            return False
+        
+        delay = retry_delay(data, len(attempts))
+        retry = {k: v for k, v in data.items() if k != 'result'}
+        retry['attempts'] = attempts
+        retry['retry_at'] = round(time.time() + delay, 6)
+        with self.cond:
+            scheduled = job_file.name in self.scheduler.runs
+            if scheduled:
+                # Scheduled runs have no file; the retry waits in the scheduler, never in pending/
+                self.scheduler.retry(job_file.name, retry, retry['retry_at'])
+                self.cond.notify_all()
+        if not scheduled:
+            # Rewritten in place, then renamed back; a crash in between leaves it to recovery
+            write_atomic(job_file, json.dumps(retry, indent=2))
+            os.rename(job_file, self.pending_path(job_file.name))
+        self.index.update(job_file.name, 'delayed', returncode=result.get('returncode'))
+        self.log(f"Job {job_file.name} failed on attempt {len(attempts)}, retrying in {delay:g}s",
+                 'WARNING', job=job_file.name, status='retrying', returncode=result.get('returncode'))
+        return True
+    
+    def add_attempts(self, data, result):
+        """Move a retried job's attempt history into its final result block"""
+        if 'attempts' in data:
+            attempts = data.pop('attempts')
+            result['attempts'] = attempts + [attempt_record(result, len(attempts) + 1)]
+        data.pop('retry_at', None)
     
     def process_text_job(self, job_file):
         """Process a text format job (shell command)"""
         self.log(f"Processing text job: {job_file.name}")
+        cmd = None
         
         try:
             # Read the command
             cmd = job_file.read_text().strip()
             self.log(f"Executing: {cmd}")
             
-            # Execute the command
-            self.current_process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                shell=True
-            )
-            
-            stdout, stderr = self.current_process.communicate(timeout=300)
-            returncode = self.current_process.returncode
-            
-            # Create result JSON
-            result_data = {
-                'command': cmd,
-                'source_file': job_file.name,
-                'result': {
-                    'status': 'completed' if returncode == 0 else 'failed',
-                    'returncode': returncode,
-                    'stdout': stdout,
-                    'stderr': stderr,
-                    'completed_at': datetime.now().isoformat()
-                }
-            }
-            
-            # Save result
-            dest_dir = COMPLETED_DIR if returncode == 0 else FAILED_DIR
-            result_file = dest_dir / f"{job_file.stem}_result.json"
-            with open(result_file, 'w') as f:
-                json.dump(result_data, f, indent=2)
-            
-            # Remove original
-            job_file.unlink()
-            
-            self.log(f"Job {job_file.name} {'completed' if returncode == 0 else 'failed'}")
-            
-        except subprocess.TimeoutExpired:
-            self.current_process.kill()
-            result_data = {
-                'command': cmd,
-                'source_file': job_file.name,
-                'result': {
-                    'status': 'failed',
-                    'error': 'Timeout after 5 minutes',
-                    'completed_at': datetime.now().isoformat()
-                }
-            }
-            result_file = FAILED_DIR / f"{job_file.stem}_result.json"
-            with open(result_file, 'w') as f:
-                json.dump(result_data, f, indent=2)
-            job_file.unlink()
-            self.log(f"Job {job_file.name} timed out", 'ERROR')
+            # Execute the command, through /bin/sh only if it needs it
+            argv = direct_argv(cmd)
+            result = self.execute(job_file, argv or cmd, shell=argv is None, limits=TEXT_JOB_LIMITS)
+            return self.text_job_done(job_file, cmd, result)
             
         except Exception as e:
-            result_data = {
-                'command': cmd if 'cmd' in locals() else 'unknown',
-                'source_file': job_file.name,
-                'result': {
-                    'status': 'failed',
-                    'error': str(e),
-                    'traceback': traceback.format_exc(),
-                    'completed_at': datetime.now().isoformat()
-                }
+            return self.text_job_failed(job_file, cmd, e)
+    
+    def text_job_done(self, job_file, cmd, result):
+        """Write a text job's <stem>_result.json and return its status"""
+        # Create result JSON
+        result_data = {
+            'command': cmd,
+            'source_file': job_file.name,
+            'result': result
+        }
+        
+        # Save result
+        dest_dir = COMPLETED_DIR if result['status'] == 'completed' else FAILED_DIR
+        result_file = dest_dir / f"{job_file.stem}_result.json"
+        
+        # Write the result and remove the original
+        self.save_result(job_file, result_file, result_data)
+        
+        self.log(f"Job {job_file.name} {result['status']}", job=job_file.name,
+                 status=result['status'], returncode=result.get('returncode'),
+                 duration=result.get('duration'))
+        return result['status']
+    
+    def text_job_failed(self, job_file, cmd, error):
+        """Write a text job's failed result after an exception (call from the except block)"""
+        result_data = {
+            'command': cmd if cmd is not None else 'unknown',
+            'source_file': job_file.name,
+            'result': {
+                'status': 'failed',
+                'error': str(error),
+                'traceback': traceback.format_exc(),
+                'completed_at': datetime.now().isoformat()
             }
-            result_file = FAILED_DIR / f"{job_file.stem}_result.json"
-            with open(result_file, 'w') as f:
-                json.dump(result_data, f, indent=2)
-            job_file.unlink()
-            self.log(f"Job {job_file.name} failed: {str(e)}", 'ERROR')
+        }
+        result_file = FAILED_DIR / f"{job_file.stem}_result.json"
+        self.save_result(job_file, result_file, result_data)
+        self.log(f"Job {job_file.name} failed: {str(error)}", 'ERROR', job=job_file.name)
+        return 'failed'
+    
+    def process_batch_job(self, job_file):
+        """Process a JSONL batch: one job per line, one consolidated results file"""
+        self.log(f"Processing batch job: {job_file.name}")
+        self.running_dir.mkdir(parents=True, exist_ok=True)
         
-        finally:
-            self.current_process = None
+        # Results are checkpointed line by line so a restarted server can resume
+        checkpoint = self.running_dir / f"{job_file.stem}_results.jsonl.part"
+        with contextlib.suppress(FileNotFoundError):
+            # Carried through pending/ when the batch was recovered from another node
+            os.replace(self.pending_path(job_file.name).with_name(f".{job_file.name}.part"), checkpoint)
+        try:
+            return self.run_batch(job_file, checkpoint)
+        except Exception:
+            # The crashed batch goes to failed/ whole, so nothing would ever resume from this
+            checkpoint.unlink(missing_ok=True)
+            raise
+    
+    def run_batch(self, job_file, checkpoint):
+        """Run a batch's remaining lines into its checkpoint, then publish it as the results file"""
+        done, failed = read_checkpoint(checkpoint)
+        if done:
+            self.log(f"Resuming batch {job_file.name} after line {max(done)}")
+        
+        with open(job_file) as lines, open(checkpoint, 'a') as out:
+            for lineno, line in enumerate(lines, 1):
+                if not line.strip() or lineno in done:
+                    continue
+                if not self.running:
+                    # Leave the batch in running/ to be requeued and resumed
+                    self.log(f"Batch {job_file.name} interrupted at line {lineno}", 'WARNING')
+                    return None
+                
+                line_file = job_file.with_name(f"{job_file.stem}.{lineno}")
+                try:
+                    data = json.loads(line)
+                    if not isinstance(data, dict):
+                        raise ValueError("Batch line is not a JSON object")
+                    data['result'] = self.run_json_command(line_file, data, job_command(data))
+                except Exception as e:
+                    data = {'source_line': line.rstrip('\n')}
+                    data['result'] = {
+                        'status': 'failed',
+                        'error': str(e),
+                        'completed_at': datetime.now().isoformat()
+                    }
+                if not self.running and data['result']['status'] != 'completed':
+                    # Most likely killed by stop(): not checkpointed, so the resumed batch reruns it
+                    self.discard_spools(data['result'])
+                    self.log(f"Batch {job_file.name} interrupted at line {lineno}", 'WARNING')
+                    return None
+                data['line'] = lineno
+                if data['result']['status'] != 'completed':
+                    failed += 1
+                out.write(json.dumps(data) + '\n')
+                out.flush()
+                done.add(lineno)
+            if FSYNC_RESULTS:
+                os.fsync(out.fileno())
+        
+        status = 'completed' if not failed else 'failed'
+        dest_dir = COMPLETED_DIR if status == 'completed' else FAILED_DIR
+        results_file = dest_dir / f"{job_file.stem}_results.jsonl"
+        os.replace(checkpoint, results_file)
+        if FSYNC_RESULTS:
+            fsync_dir(dest_dir)
+        job_file.unlink()
+        self.index.update(job_file.name, status, finished_at=time.time(),
+                          result_path=str(results_file))
+        self.job_finished(job_file.name, status, results_file)
+        self.log(f"Batch {job_file.name} {status}: {len(done) - failed} completed, {failed} failed")
+        return status
     
-    def process_job(self, job_file):
-        """Process a single job file"""
+    def discard_spools(self, result):
+        """Delete the output spools a result moved into failed/ (never a job's own result_file)"""
+        for stream in ('stdout', 'stderr'):
+            path = result.get(f'{stream}_file')
+            if path and Path(path).parent == FAILED_DIR:
+                Path(path).unlink(missing_ok=True)
+    
+    def process_job(self, job_file, data=None):
+        """Process a single job file (or an in-memory JSON job) and return its final status"""
         try:
+            if data is not None:
+                return self.process_json_job(job_file, data)
             if job_file.suffix == '.json':
                 with open(job_file) as f:
                     data = json.load(f)
-                self.process_json_job(job_file, data)
+                return self.process_json_job(job_file, data)
+            elif job_file.suffix == '.jsonl':
+                return self.process_batch_job(job_file)
             elif job_file.suffix in ['.txt', '.sh']:
-                self.process_text_job(job_file)
+                return self.process_text_job(job_file)
             else:
                 self.log(f"Unknown job format: {job_file.name}", 'WARNING')
                 
         except Exception as e:
-            self.log(f"Error processing {job_file.name}: {str(e)}", 'ERROR')
-            # Move to failed directory
+            self.job_crashed(job_file, e)
+        return 'failed'
+    
+    def job_crashed(self, job_file, error):
+        """Move a job that could not be processed at all into failed/"""
+        self.log(f"Error processing {job_file.name}: {str(error)}", 'ERROR')
+        try:
+            shutil.move(str(job_file), str(FAILED_DIR / job_file.name))
+            self.index.update(job_file.name, 'failed', finished_at=time.time(),
+                              result_path=str(FAILED_DIR / job_file.name))
+            self.job_finished(job_file.name, 'failed', FAILED_DIR / job_file.name,
+                              {'status': 'failed', 'error': str(error)})
+        except:
+            pass
+        self.fan_out(job_file.name, {'status': 'failed', 'error': str(error),
+                                     'completed_at': datetime.now().isoformat()})
+    
+    def lookup_finished(self, job_id):
+        """Final state of a job finished before this run, from the index or its result file"""
+        row = self.index.find_task(job_id)
+        if row and row['state'] in ('completed', 'failed'):
+            return row['state']
+        if row and row['state'] == 'rejected':
+            return 'failed'
+        # Queued on another node; check_foreign_parents() notices when it finishes
+        if self.leases and row and row['state'] in JobIndex.OPEN_STATES:
+            return 'pending'
+        status = finished_on_disk(job_id, self.results)
+        if status is None and self.archive:
+            record = self.archive.lookup(task_id=job_id)
+            status = record['dir'] if record else None
+        return status
+    
+    def fail_job(self, job_file, error):
+        """Record a job as failed without running it"""
+        result = {
+            'status': 'failed',
+            'error': error,
+            'completed_at': datetime.now().isoformat()
+        }
+        if job_file.suffix == '.json':
+            try:
+                with open(job_file) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = None
+            if not isinstance(data, dict):
+                data = {'source_file': job_file.name}
+            data['result'] = result
+            dest_file = FAILED_DIR / job_file.name
+        else:
+            data = {
+                'command': job_file.read_text().strip(),
+                'source_file': job_file.name,
+                'result': result
+            }
+            dest_file = FAILED_DIR / f"{job_file.stem}_result.json"
+        self.save_result(job_file, dest_file, data)
+        self.log(f"Job {job_file.name} failed: {error}", 'ERROR', job=job_file.name)
+    
+    def reject_job(self, name, error):
+        """Fail a pending job that can never run"""
+        job_file = self.claim_job(name)
+        if job_file:
+            self.fail_job(job_file, error)
+    
+    def job_done(self, meta, status):
+        """Release or fail the dependents of a finished job"""
+        with self.cond:
+            released, failed = self.graph.finish(meta['id'], status if status == 'completed' else 'failed')
+            for name, child in released:
+                self.index.update(name, 'queued')
+                self.queue_ready(name, child)
+            for name, child, error in failed:
+                self.meta.pop(name, None)
+            self.cond.notify_all()
+        for name, child, error in failed:
+            self.reject_job(name, error)
+    
+    def apply_events(self, events):
+        """Fold watcher events into the pending index and wake the workers"""
+        # Read job metadata before taking the lock so workers are not held up by file reads
+        rescan = any(event == 'rescan' for event, _ in events)
+        if rescan:
+            events = [('reset', None)] + [('added', p) for p in self.watcher.rescan()]
+        if self.leases:
+            events = self.route_jobs(events)
+        schedules = [path for _, path in events if path and path.parent == SCHEDULES_DIR]
+        if (schedules or rescan) and self.leading:
+            with self.cond:
+                self.scheduler.load()
+                self.cond.notify_all()
+        events = [(event, path) for event, path in events if path not in schedules]
+        metas = {path: job_meta(path) for event, path in events
+                 if event == 'added' and path.name not in self.meta and is_job_file(path.name)}
+        # Read before the updates below: requeued, restarted and API jobs were admitted already
+        admitted = self.index.admitted(path.name for path in metas) if metas else set()
+        now = time.time()
+        for path, meta in metas.items():
+            meta['seen_at'] = now
+            self.index.update(path.name, 'delayed' if meta.get('retry_at', 0) > now else 'queued',
+                              task_id=meta['id'])
+        
+        with self.cond:
+            batch, refused, orphaned = [], [], []
+            for event, path in events:
+                if event == 'reset':
+                    # Rebuild the index from the jobs we already know are runnable
+                    self.pending = PendingIndex()
+                    waiting = {entry[0] for entry in self.graph.waiting.values()}
+                    waiting.update(name for _, name in self.delayed)
+                    waiting.update(self.coalesce.leader_of)
+                    for name, meta in self.meta.items():
+                        if name not in waiting:
+                            self.pending.add(name, meta['priority'], meta['source'])
+                elif event == 'added':
+                    if path.name not in self.meta and path in metas:
+                        self.admission.release(path.name)
+                        # Retries were admitted on their first attempt
+                        reason = None if 'retry_at' in metas[path] or path.name in admitted else \
+                            self.admission.check(self.meta, metas[path])
+                        if reason:
+                            refused.append((path, reason))
+                            continue
+                        self.meta[path.name] = metas[path]
+                        batch.append((path.name, metas[path]))
+                elif event == 'released':
+                    # Its shard moved to another node, which picks the job up from there
+                    self.admission.release(path.name)
+                    self.pending.discard(path.name)
+                    meta = self.meta.pop(path.name, None)
+                    if meta:
+                        self.graph.discard(meta['id'])
+                        self.uncoalesce(path.name)
+                else:
+                    self.admission.release(path.name)
+                    self.pending.discard(path.name)
+                    meta = self.meta.pop(path.name, None)
+                    if meta:
+                        # Deleted before any worker claimed it, so its dependents can never run
+                        self.index.update(path.name, 'removed', finished_at=time.time())
+                        self.uncoalesce(path.name)
+                        orphaned.extend(self.graph.remove(meta['id']))
+            
+            # Jobs with unfinished parents wait in the graph instead of the index
+            ready, rejected = self.graph.add(batch)
+            rejected = orphaned + rejected
+            for name, meta in ready:
+                if meta.get('retry_at', 0) > now:
+                    heapq.heappush(self.delayed, (meta['retry_at'], name))
+                else:
+                    self.queue_ready(name, meta)
+            for name, meta, error in rejected:
+                self.meta.pop(name, None)
+            for name, meta in batch:
+                if meta['id'] in self.graph.waiting:
+                    self.index.update(name, 'waiting')
+            self.cond.notify_all()
+        
+        for name, meta, error in rejected:
+            self.reject_job(name, error)
+        if refused:
+            retry_after = self.admission.retry_after(self.meta)
+            for path, reason in refused:
+                self.refuse_job(path, reason, retry_after)
+        self.publish_status()
+    
+    def queue_ready(self, name, meta):
+        """Queue a runnable job, or attach it to an identical queued or running one (hold cond)"""
+        leader = self.coalesce.join(name, meta)
+        if leader is None:
+            self.pending.add(name, meta['priority'], meta['source'])
+            return
+        self.index.update(name, 'coalesced')
+        self.log(f"Coalesced {name} into {leader}", job=name, status='coalesced')
+    
+    def uncoalesce(self, name):
+        """Drop a job removed before it ran from its dedupe group (hold cond)"""
+        promoted = self.coalesce.discard(name)
+        if promoted and promoted in self.meta:
+            meta = self.meta[promoted]
+            self.index.update(promoted, 'queued')
+            self.pending.add(promoted, meta['priority'], meta['source'])
+    
+    def refuse_job(self, job_file, reason, retry_after):
+        """Move a job turned away by admission control to rejected/, with the reason beside it"""
+        REJECTED_DIR.mkdir(exist_ok=True)
+        write_atomic(REJECTED_DIR / f"{job_file.name}.reason", json.dumps({
+            'reason': reason, 'retry_after': retry_after,
+            'rejected_at': datetime.now().isoformat()}, indent=2), durable=False)
+        try:
+            # Unchanged, so moving it back into pending/ resubmits it
+            os.rename(job_file, REJECTED_DIR / job_file.name)
+        except FileNotFoundError:
+            return
+        self.index.update(job_file.name, 'rejected', finished_at=time.time(),
+                          result_path=str(REJECTED_DIR / job_file.name))
+        self.metrics.inc('brain_exec_jobs_total', type=job_type(job_file), status='rejected')
+        self.log(f"Rejected {job_file.name}: {reason}", 'WARNING', job=job_file.name, status='rejected')
+        self.job_finished(job_file.name, 'rejected', REJECTED_DIR / job_file.name,
+                          {'status': 'rejected', 'error': reason, 'retry_after': retry_after})
+    
+    def publish_status(self, force=False):
+        """Write the queue's depth and admission state for producers, at most every STATUS_INTERVAL"""
+        if not force and time.monotonic() - self.status_at < STATUS_INTERVAL:
+            if not self.status_dirty:
+                self.status_dirty = True
+                # watch_events() writes it once the interval is up
+                if self.watcher:
+                    self.watcher.wake()
+            return
+        self.status_dirty = False
+        self.status_at = time.monotonic()
+        with self.cond:
+            self.admission.refresh(self.meta)
+            status = {
+                'state': 'running' if self.running else 'stopped',
+                'accepting': not self.admission.shedding,
+                'shedding': sorted(self.admission.shedding),
+                'pending': len(self.meta),
+                'pending_bytes': self.meta.bytes,
+                'running': len(self.timing),
+                'waiting': len(self.graph.waiting),
+                'delayed': len(self.delayed),
+                'coalesced': len(self.coalesce.leader_of),
+                'sources': dict(self.meta.sources),
+                'limits': {'jobs': self.admission.max_jobs, 'bytes': self.admission.max_bytes,
+                           'per_source': self.admission.max_per_source,
+                           'resume': self.admission.resume},
+                'updated_at': time.time()
+            }
+            if self.admission.shedding:
+                status['retry_after'] = self.admission.retry_after(self.meta)
+        if self.node:
+            status['node'] = self.node
+        try:
+            write_atomic(self.status_path, json.dumps(status, indent=2), durable=False)
+        except OSError as e:
+            self.log(f"Cannot write {self.status_path.name}: {e}", 'ERROR')
+    
+    def route_jobs(self, events):
+        """Move jobs dropped straight into pending/ to their shard; return the remaining events"""
+        remaining = []
+        for event, path in events:
+            if path is None or path.parent != PENDING_DIR:
+                remaining.append((event, path))
+            elif event == 'added' and is_job_file(path.name):
+                try:
+                    os.rename(path, self.pending_path(path.name))
+                except FileNotFoundError:
+                    # Another node routed it first
+                    pass
+        return remaining
+    
+    def watch_events(self):
+        """Wait for watcher events, tending leases and the status file whenever they are due"""
+        timeouts = []
+        if self.leases:
+            timeouts.append(self.leases.due())
+        if self.status_dirty:
+            timeouts.append(max(self.status_at + STATUS_INTERVAL - time.monotonic(), 0))
+        events = self.watcher.wait(min(timeouts) if timeouts else None)
+        if self.leases and self.running and not self.leases.due():
+            events += self.tend_leases()
+        if self.status_dirty and self.running:
+            self.publish_status()
+        return events
+    
+    def tend_leases(self):
+        """Heartbeat, then follow the shards gained or lost as watcher-style events"""
+        self.running_dir.mkdir(parents=True, exist_ok=True)
+        gained, lost = self.leases.heartbeat()
+        events = []
+        for shard in sorted(lost):
+            self.watcher.remove_dir(PENDING_DIR / shard)
+            with self.cond:
+                names = [name for name, meta in self.meta.items()
+                         if 'data' not in meta and shard_of(name) == shard]
+            events.extend(('released', PENDING_DIR / shard / name) for name in names)
+        for shard in sorted(gained):
+            (PENDING_DIR / shard).mkdir(parents=True, exist_ok=True)
+            events.extend(('added', PENDING_DIR / shard / name)
+                          for name in self.watcher.add_dir(PENDING_DIR / shard))
+        if gained or lost:
+            self.log(f"Node {self.node} holds shard(s) {', '.join(sorted(self.leases.held)) or 'none'}")
+        
+        if self.leases.leads() != self.leading:
+            self.leading = self.leases.leads()
+            with self.cond:
+                if self.leading:
+                    self.scheduler.load()
+                else:
+                    self.scheduler.clear()
+                self.cond.notify_all()
+        for node in self.leases.dead_nodes():
+            self.adopt_node(node)
+        self.check_foreign_parents()
+        return events
+    
+    def adopt_node(self, node):
+        """Recover the jobs a node that stopped heartbeating left in running/<node>/"""
+        adopted = RUNNING_DIR / f".{node}.adopted-by.{self.node}"
+        try:
+            # Only one surviving node wins the rename
+            os.rename(RUNNING_DIR / node, adopted)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return
+        else:
+            self.log(f"Node {node} stopped heartbeating; recovering its jobs", 'WARNING')
+            self.recover_dir(adopted)
+            shutil.rmtree(adopted, ignore_errors=True)
+        self.leases.forget(node)
+    
+    def check_foreign_parents(self):
+        """Release dependents of parents that were queued on other nodes and have now finished"""
+        with self.cond:
+            parents = [parent for parent in self.graph.children
+                       if parent not in self.graph.queued and parent not in self.graph.finished]
+        for parent in parents:
+            status = self.lookup_finished(parent)
+            if status in ('completed', 'failed'):
+                self.job_done({'id': parent}, status)
+    
+    def pending_path(self, name):
+        """Where a job waits in pending/: its shard's subdirectory when nodes share the queue"""
+        return PENDING_DIR / shard_of(name) / name if self.node else PENDING_DIR / name
+    
+    def claim_job(self, name):
+        """Atomically move a pending job into running/, or None if another worker (or node) won"""
+        try:
+            os.rename(self.pending_path(name), self.running_dir / name)
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        return self.running_dir / name
+    
+    def next_job(self):
+        """Block until a pending job can be claimed, or return None when stopping"""
+        while True:
+            with self.cond:
+                while True:
+                    due = self.release_timers()
+                    if not self.running or len(self.pending):
+                        break
+                    self.cond.wait(due)
+                if not self.running:
+                    return None
+            job = self.take_job()
+            if job:
+                return job
+    
+    def take_job(self):
+        """Claim the next pending job as (job_file, meta) without blocking, or None if there is none"""
+        while True:
+            with self.cond:
+                self.release_timers()
+                if not len(self.pending):
+                    return None
+                name = self.pending.pop()
+                meta = self.meta.pop(name, None)
+                if meta and 'schedule' in meta:
+                    self.scheduler.runs[name] = meta['schedule']
+            # Scheduled runs have no file to claim
+            job_file = self.running_dir / name if meta and 'data' in meta else self.claim_job(name)
+            if job_file:
+                now = time.time()
+                self.timing[name] = {'seen_at': round(meta['seen_at'] if meta else now, 6),
+                                     'claimed_at': round(now, 6)}
+                self.index.update(name, 'running', started_at=now)
+                return job_file, meta
+    
+    def release_timers(self):
+        """Queue due retries and scheduled runs; seconds until the next timer, or None (hold cond)"""
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, name = heapq.heappop(self.delayed)
+            meta = self.meta.get(name)
+            # Jobs deleted while backing off have no metadata left
+            if meta:
+                self.pending.add(name, meta['priority'], meta['source'])
+        for run, schedule, data in self.scheduler.retries_due(now):
+            self.queue_scheduled(schedule, data, now, run)
+        for schedule, data, planned in self.scheduler.due(now):
+            self.queue_scheduled(schedule, data, planned)
+        timers = [t for t in (self.delayed[0][0] if self.delayed else None,
+                              self.scheduler.next_due()) if t is not None]
+        return max(min(timers) - now, 0) if timers else None
+    
+    def queue_scheduled(self, schedule, data, planned, name=None):
+        """Queue one run (or retry) of a schedule straight into the pending index (hold cond)"""
+        name = name or f"{schedule}_{datetime.fromtimestamp(planned).strftime('%Y%m%d_%H%M%S_%f')[:-3]}.json"
+        meta = {
+            'id': str(data.get('task_id') or Path(name).stem),
+            'priority': parse_priority(data.get('priority')),
+            'source': str(data.get('source') or data.get('tool') or SCHEDULE_SOURCE),
+            'depends_on': [],
+            'seen_at': time.time(),
+            'schedule': schedule,
+            'data': data
+        }
+        self.meta[name] = meta
+        self.pending.add(name, meta['priority'], meta['source'])
+        self.index.update(name, 'queued', task_id=meta['id'])
+    
+    def worker(self):
+        """Worker thread: claim and process jobs until stopped"""
+        while self.running:
+            try:
+                job = self.next_job()
+                if job:
+                    job_file, meta = job
+                    status = self.process_job(job_file, meta and meta.get('data'))
+                    self.job_processed(job_file, meta, status)
+            except Exception as e:
+                self.log(f"Error in worker: {str(e)}", 'ERROR')
+                time.sleep(5)
+    
+    def job_processed(self, job_file, meta, status):
+        """Bookkeeping once a worker is done with a job"""
+        self.record_metrics(job_file, status)
+        self.admission.finished()
+        if meta and 'schedule' in meta:
+            with self.cond:
+                self.scheduler.runs.pop(job_file.name, None)
+                if status in ('completed', 'failed'):
+                    self.scheduler.finished(meta['schedule'])
+        # Interrupted (None) and retrying jobs have not finished yet
+        if meta and status in ('completed', 'failed'):
+            self.job_done(meta, status)
+        self.publish_status()
+    
+    def record_metrics(self, job_file, status):
+        """Count a job a worker has finished with and record its wait and run times"""
+        timing = self.timing.pop(job_file.name, None)
+        kind = job_type(job_file)
+        self.metrics.inc('brain_exec_jobs_total', type=kind, status=status or 'interrupted')
+        if timing:
+            self.metrics.observe('brain_exec_wait_seconds', timing['claimed_at'] - timing['seen_at'],
+                                 type=kind)
+            self.metrics.observe('brain_exec_run_seconds', time.time() - timing['claimed_at'],
+                                 type=kind)
+    
+    def serve_metrics(self):
+        """Serve /metrics on localhost from a background thread"""
+        self.metrics_server = http.server.ThreadingHTTPServer((METRICS_HOST, self.metrics_port),
+                                                              MetricsHandler)
+        self.metrics_server.daemon_threads = True
+        self.metrics_server.processor = self
+        threading.Thread(target=self.metrics_server.serve_forever, name='metrics',
+                         daemon=True).start()
+        self.log(f"Serving metrics on http://{METRICS_HOST}:{self.metrics_server.server_port}/metrics")
+    
+    def serve_api(self):
+        """Accept API requests on the queue's Unix socket from a background thread"""
+        try:
+            # A socket file left by a previous run would make bind() fail
+            self.api_socket.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            self.api_server = socketserver.ThreadingUnixStreamServer(str(self.api_socket), ApiHandler)
+        except OSError as e:
+            self.log(f"Cannot serve the API on {self.api_socket}: {e}", 'ERROR')
+            return
+        self.api_server.daemon_threads = True
+        self.api_server.processor = self
+        threading.Thread(target=self.api_server.serve_forever, name='api', daemon=True).start()
+        self.log(f"Serving the job API on {self.api_socket}")
+    
+    def stop_api(self):
+        """Release waiting API clients and close the socket"""
+        self.events.close()
+        stopper = threading.Thread(target=self.api_server.shutdown)
+        stopper.start()
+        # Throwaway connections wake serve_forever() instead of waiting out its poll interval
+        while stopper.is_alive():
+            with socket.socket(socket.AF_UNIX) as wake:
+                try:
+                    wake.connect(str(self.api_socket))
+                except OSError:
+                    pass
+            stopper.join(0.05)
+        self.api_server.server_close()
+        try:
+            self.api_socket.unlink()
+        except FileNotFoundError:
+            pass
+    
+    def api_request(self, request):
+        """Handle one API request, yielding the replies to send back"""
+        op = request.get('op', 'submit')
+        if op == 'submit':
+            name = api_job_name(request.get('name') or
+                                f"api_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}")
+            follow = request.get('wait') or request.get('stream')
+            # Subscribe before the job is visible so its result cannot be missed
+            events = self.events.subscribe(name, request.get('stream')) if follow else None
+            try:
+                self.submit_job(name, request.get('job'))
+            except QueueFull as e:
+                if events:
+                    self.events.unsubscribe(name, events)
+                self.publish_status()
+                yield {'ok': False, 'event': 'rejected', 'id': name, 'error': str(e),
+                       'retry_after': e.retry_after}
+                return
+            except Exception:
+                if events:
+                    self.events.unsubscribe(name, events)
+                raise
+            yield {'ok': True, 'event': 'accepted', 'id': name}
+        elif op in ('wait', 'stream'):
+            if 'id' not in request:
+                raise ValueError(f"{op} needs a job id")
+            name = api_job_name(request['id'])
+            follow = True
+            events = self.events.subscribe(name, op == 'stream' or request.get('stream'))
+        elif op in ('progress', 'tail'):
+            if 'id' not in request:
+                raise ValueError(f"{op} needs a job id")
+            name = api_job_name(request['id'])
+            yield self.job_progress(name) if op == 'progress' else self.tail_output(name, request)
+            return
+        else:
+            raise ValueError(f"Unknown op: {op}")
+        if follow:
+            yield from self.follow_job(name, events, request.get('timeout'))
+    
+    def submit_job(self, name, job):
+        """Atomically place a JSON job in pending/ under the given file name"""
+        if not isinstance(job, dict):
+            raise ValueError("job must be a JSON object")
+        # The suffix picks the job type, and what is written here is always JSON
+        if Path(name).suffix != '.json':
+            raise ValueError(f"Invalid job id: {name!r} (API jobs are JSON jobs named *.json)")
+        job_command(job)
+        spawn_options(job)
+        if self.job_exists(name):
+            raise FileExistsError(f"Job {name} is already queued")
+        meta = json_job_meta(job, Path(name).stem)
+        meta['bytes'] = len(json.dumps(job))
+        with self.cond:
+            reason = self.admission.check(self.meta, meta)
+            if reason:
+                raise QueueFull(reason, self.admission.retry_after(self.meta))
+            # Counted until the watcher queues it; a node holding its shard admits it by the index
+            if not self.leases or shard_of(name) in self.leases.held:
+                self.admission.reserve(name, meta)
+        try:
+            self.index.update(name, 'queued', task_id=meta['id'])
+            # Written beside pending/ and renamed in, so watchers only see the complete file
+            tmp = QUEUE_BASE / f".{name}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(job, f)
+            os.rename(tmp, self.pending_path(name))
+        except Exception:
+            with self.cond:
+                self.admission.release(name)
+            self.index.update(name, 'removed', finished_at=time.time())
+            raise
+        self.log(f"Accepted API job: {name}")
+    
+    def job_exists(self, name):
+        """Whether a job is waiting in pending/ or held in running/ by any node"""
+        dirs = [PENDING_DIR, self.running_dir]
+        if self.node:
+            dirs.append(PENDING_DIR / shard_of(name))
+            dirs.extend(dir for dir in RUNNING_DIR.iterdir() if dir.is_dir())
+        return any((dir / name).exists() for dir in dirs)
+    
+    def follow_job(self, name, events, timeout=None):
+        """Yield a job's events from the subscription until its result (or a timeout)"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            done = self.finished_result(name)
+            if done:
+                yield done
+                return
+            if not self.job_exists(name):
+                yield {'ok': False, 'event': 'unknown', 'id': name, 'error': f"No job named {name}"}
+                return
+            # Another node may run it, and only the job index would say so
+            poll = self.leases.interval if self.leases else None
+            while True:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                waits = [t for t in (remaining, poll) if t is not None]
+                try:
+                    event = events.get(timeout=min(waits) if waits else None)
+                except queue.Empty:
+                    done = self.finished_result(name) if poll else None
+                    if done:
+                        yield done
+                        return
+                    if deadline is None or time.monotonic() < deadline:
+                        continue
+                    yield {'ok': False, 'event': 'timeout', 'id': name,
+                           'error': f"No result after {timeout:g} seconds"}
+                    return
+                yield event
+                if event['event'] != 'output':
+                    return
+        finally:
+            self.events.unsubscribe(name, events)
+    
+    def job_progress(self, name):
+        """A running job's progress record, or just the state of any other job"""
+        progress = self.progress.get(name)
+        if progress:
+            return dict(progress.record(), ok=True, event='progress')
+        row = self.index.get(name)
+        return {'ok': True, 'event': 'progress', 'id': name, 'state': row['state'] if row else None}
+    
+    def tail_output(self, name, request):
+        """Output of a job from a byte offset, read while it runs or from its result"""
+        stream = request.get('stream', 'stdout')
+        if stream not in ('stdout', 'stderr'):
+            raise ValueError(f"Unknown stream: {stream}")
+        offset = max(int(request.get('offset', 0)), 0)
+        limit = min(max(int(request.get('limit', OUTPUT_CHUNK)), 1), TAIL_MAX_BYTES)
+        progress = self.progress.get(name)
+        if progress:
+            state, sink = 'running', progress.sinks[stream]
+            data, total = sink.read(offset, limit), sink.total
+        else:
+            row = self.index.get(name)
+            state, data, total = row['state'] if row else None, b'', 0
+            event = self.finished_result(name)
+            result = event and event['result'] or {}
+            if f'{stream}_file' in result:
+                total = result.get(f'{stream}_bytes', 0)
+                try:
+                    with open(result[f'{stream}_file'], 'rb') as f:
+                        f.seek(offset)
+                        data = f.read(limit)
+                except FileNotFoundError:
+                    pass
+            elif stream in result:
+                # The whole output fitted in the result
+                output = result[stream].encode()
+                data, total = output[offset:offset + limit], len(output)
+        data = utf8_prefix(data)
+        return {'ok': True, 'event': 'output', 'id': name, 'state': state, 'stream': stream,
+                'offset': offset, 'next_offset': offset + len(data), 'bytes': total,
+                'data': data.decode('utf-8', 'replace')}
+    
+    def finished_result(self, name):
+        """Result event for a job that has already finished, or None"""
+        row = self.index.get(name)
+        if not row or row['state'] not in ('completed', 'failed'):
+            return None
+        result = None
+        if row['result_path']:
+            path = Path(row['result_path'])
+            data = self.results.read(path)
+            if data is None and self.archive:
+                data = self.archive.fetch(name=path.name)
             try:
-                shutil.move(str(job_file), str(FAILED_DIR / job_file.name))
-            except:
+                result = json.loads(data)['result'] if data else None
+            except (ValueError, KeyError, TypeError):
+                # Batch results are JSONL; clients read them from result_file
                 pass
+        return {'ok': True, 'event': 'result', 'id': name, 'status': row['state'],
+                'result_file': row['result_path'], 'result': result}
+    
+    def recover_orphans(self):
+        """Requeue or fail the jobs a previous run left in running/, and drop its temp files"""
+        # Other nodes may be writing theirs; only abandoned ones are removed then
+        cutoff = time.time() - self.leases.timeout if self.leases else None
+        for dir in [QUEUE_BASE, COMPLETED_DIR, FAILED_DIR, REJECTED_DIR]:
+            for tmp in dir.glob('.*.tmp'):
+                try:
+                    if cutoff is None or tmp.stat().st_mtime < cutoff:
+                        tmp.unlink()
+                except FileNotFoundError:
+                    pass
+        self.running_dir.mkdir(parents=True, exist_ok=True)
+        self.recover_dir(self.running_dir)
+        if self.node:
+            # Takeovers this node had not finished when it stopped
+            for adopted in RUNNING_DIR.glob(f".*.adopted-by.{self.node}"):
+                self.recover_dir(adopted)
+                shutil.rmtree(adopted, ignore_errors=True)
+    
+    def recover_dir(self, dir):
+        """Requeue or fail every job in a running/ directory"""
+        # Checkpoints first, so they are in place before their batch can be claimed again
+        for job_file in sorted(dir.iterdir(), key=lambda path: (path.suffix != '.part', path.name)):
+            if job_file.suffix in SPOOL_SUFFIXES or job_file.suffix == '.tmp':
+                # Partial output of an interrupted run
+                job_file.unlink()
+            elif job_file.suffix == '.part' and dir != self.running_dir:
+                # A dead node's batch checkpoint goes beside the batch, for whichever node claims it
+                batch = f"{job_file.name[:-len('_results.jsonl.part')]}.jsonl"
+                carried = self.pending_path(batch).with_name(f".{batch}.part")
+                carried.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(job_file, carried)
+            elif job_file.is_file() and job_file.suffix in JOB_SUFFIXES:
+                self.recover_job(job_file)
+    
+    def recover_job(self, job_file):
+        """Requeue an interrupted job, or fail it once its retry policy is used up"""
+        name = job_file.name
+        submitted = job_file.stat().st_mtime
+        for dir, status in [(COMPLETED_DIR, 'completed'), (FAILED_DIR, 'failed')]:
+            for result_name in result_names(job_file):
+                result = dir / result_name
+                written_at = self.results.written_at(result)
+                # Written after this job was submitted, so the server died while removing it
+                if written_at is not None and written_at >= submitted:
+                    job_file.unlink()
+                    self.index.update(name, status, finished_at=written_at,
+                                      result_path=str(result))
+                    self.log(f"Interrupted job {name} had already finished", 'WARNING')
+                    return
+        
+        interrupted = self.index.interruptions(name, submitted)
+        limit = recovery_limit(job_file)
+        self.index.update(name, 'interrupted', finished_at=time.time())
+        # Batches checkpoint every line, so resuming one never repeats work
+        if job_file.suffix == '.jsonl' or limit is None or interrupted < limit:
+            os.rename(job_file, self.pending_path(name))
+            self.log(f"Requeued interrupted job: {name}", 'WARNING')
+        else:
+            self.fail_job(job_file, f"Interrupted by a server restart {interrupted + 1} time(s), "
+                                    f"retry allows {limit}")
     
     def run(self):
         """Main processing loop"""
-        self.log("Queue processor started")
+        self.logger.start()
+        self.log(f"Queue processor started with {self.workers} worker(s) ({self.engine} engine)")
         
-        # Set up signal handlers
-        signal.signal(signal.SIGINT, self.stop)
-        signal.signal(signal.SIGTERM, self.stop)
+        # Set up signal handlers (only possible from the main thread)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
         
+        self.start_up()
+        try:
+            self.serve()
+        finally:
+            self.shut_down()
+        
+        self.log("Queue processor stopped")
+    
+    def start_up(self):
+        """Prepare the queue, seed the pending index and start the background services"""
         # Ensure directories exist
-        for dir in [PENDING_DIR, COMPLETED_DIR, FAILED_DIR]:
+        for dir in [PENDING_DIR, RUNNING_DIR, COMPLETED_DIR, FAILED_DIR, SCHEDULES_DIR]:
             dir.mkdir(parents=True, exist_ok=True)
+        if self.leases:
+            for shard in self.leases.shards:
+                (PENDING_DIR / shard).mkdir(exist_ok=True)
+        self.results.recover()
+        self.recover_orphans()
+        
+        # Seed the index from whatever is already pending (routed to shards first in node mode)
+        self.watcher = make_watcher(self.watcher_backend)
+        self.apply_events([('added', PENDING_DIR / name)
+                           for name in self.watcher.add_dir(PENDING_DIR)])
+        self.log(f"Watching {PENDING_DIR} with {self.watcher.name} watcher")
+        self.watcher.add_dir(SCHEDULES_DIR)
+        if self.leading:
+            with self.cond:
+                self.scheduler.load()
+        if self.leases:
+            self.apply_events(self.tend_leases())
+        self.publish_status()
+        if self.scheduler.schedules:
+            self.log(f"Loaded {len(self.scheduler.schedules)} schedule(s) from {SCHEDULES_DIR}")
+        
+        self.warm.start()
+        if self.archive:
+            self.archive.start()
+        if self.metrics_port:
+            self.serve_metrics()
+        if self.api:
+            self.serve_api()
+    
+    def serve(self):
+        """Run the worker threads while the main thread feeds them watcher events"""
+        threads = [threading.Thread(target=self.worker, name=f'worker-{i}', daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
         
+        try:
+            while self.running:
+                try:
+                    events = self.watch_events()
+                    if events:
+                        self.apply_events(events)
+                        
+                except Exception as e:
+                    self.log(f"Error in main loop: {str(e)}", 'ERROR')
+                    time.sleep(5)
+        finally:
+            self.stop_workers(threads)
+    
+    def shut_down(self):
+        """Stop the background services and release the queue"""
+        if self.api_server:
+            self.stop_api()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.archive:
+            self.archive.stop()
+        self.publish_status(force=True)
+        self.results.close()
+        if self.leases:
+            self.leases.close()
+            # Empty once the in-flight jobs have finished
+            try:
+                self.running_dir.rmdir()
+            except OSError:
+                pass
+        self.warm.close()
+        self.watcher.close()
+        self.index.close()
+        self.logger.stop()
+    
+    def stop_workers(self, threads):
+        """Wake idle workers and wait for in-flight jobs to finish"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        deadline = time.monotonic() + KILL_GRACE
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        # Jobs that ignored SIGTERM from stop() lose their whole process group
+        with self.cond:
+            for process in list(self.active.values()):
+                signal_group(process, signal.SIGKILL)
+        for thread in threads:
+            thread.join()
+
+class AsyncQueueProcessor(QueueProcessor):
+    """QueueProcessor driven by one asyncio event loop instead of a worker thread per job"""
+    
+    engine = 'asyncio'
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.wakeup = None
+    
+    def stop(self, signum=None, frame=None):
+        """Gracefully stop the processor and wake the event loop"""
+        super().stop(signum, frame)
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+    
+    def serve(self):
+        """Run the event loop until stopped"""
+        asyncio.run(self.serve_async())
+    
+    async def serve_async(self):
+        """Start a task per claimed job, at most `workers` at a time"""
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        # File, SQLite and fsync work runs here, off the loop. Batch and warm jobs hold
+        # at most `workers` threads, so the watcher and job bookkeeping always get one
+        self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+            self.workers + 4, thread_name_prefix='async-io'))
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(signum, self.stop)
+        slots = asyncio.Semaphore(self.workers)
+        watch = self.loop.create_task(self.watch_async())
+        tasks = set()
+        
+        try:
+            while self.running:
+                await slots.acquire()
+                self.wakeup.clear()
+                job, due = await self.loop.run_in_executor(None, self.claim_next)
+                if job is None:
+                    slots.release()
+                    # stop() may have fired before the clear above
+                    if self.running:
+                        try:
+                            await asyncio.wait_for(self.wakeup.wait(), due)
+                        except asyncio.TimeoutError:
+                            pass
+                    continue
+                task = self.loop.create_task(self.run_job_async(job, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self.running = False
+            if tasks:
+                _, stubborn = await asyncio.wait(set(tasks), timeout=KILL_GRACE)
+                # Jobs that ignored SIGTERM from stop() lose their whole process group
+                with self.cond:
+                    for process in list(self.active.values()):
+                        signal_group(process, signal.SIGKILL)
+                if stubborn:
+                    await asyncio.wait(stubborn)
+            self.watcher.wake()
+            await watch
+            self.loop = None
+    
+    def claim_next(self):
+        """take_job(), else (None, seconds until the next timer is due)"""
+        job = self.take_job() if self.running else None
+        if job:
+            return job, None
+        with self.cond:
+            return None, self.release_timers()
+    
+    def watch_once(self):
+        """Wait for watcher events and fold them into the pending index; whether there were any"""
+        events = self.watch_events()
+        if events:
+            self.apply_events(events)
+        return bool(events)
+    
+    async def watch_async(self):
+        """Feed watcher events into the pending index from a helper thread"""
         while self.running:
             try:
-                # Get all pending jobs
-                jobs = sorted(PENDING_DIR.iterdir())
-                
-                if jobs:
-                    # Skip directories
-                    job_files = [j for j in jobs if j.is_file()]
-                    if job_files:
-                        # Process the oldest job
-                        self.process_job(job_files[0])
-                    else:
-                        time.sleep(1)
-                else:
-                    # No jobs, wait a bit
-                    time.sleep(2)
-                    
+                if await self.loop.run_in_executor(None, self.watch_once):
+                    self.wakeup.set()
             except Exception as e:
                 self.log(f"Error in main loop: {str(e)}", 'ERROR')
-                time.sleep(5)
+                await asyncio.sleep(5)
+    
+    async def run_job_async(self, job, slots):
+        """Process one claimed job, then free its slot"""
+        job_file, meta = job
+        try:
+            status = await self.process_job_async(job_file, meta and meta.get('data'))
+            await asyncio.to_thread(self.job_processed, job_file, meta, status)
+        except Exception as e:
+            self.log(f"Error in worker: {str(e)}", 'ERROR')
+        finally:
+            slots.release()
+            self.wakeup.set()
+    
+    async def process_job_async(self, job_file, data=None):
+        """Process a single job file (or an in-memory JSON job) and return its final status"""
+        try:
+            if data is not None:
+                return await self.process_json_job_async(job_file, data)
+            if job_file.suffix == '.json':
+                data = json.loads(await asyncio.to_thread(job_file.read_bytes))
+                return await self.process_json_job_async(job_file, data)
+            elif job_file.suffix == '.jsonl':
+                # Batches keep their line-by-line checkpointing on a helper thread
+                return await asyncio.to_thread(self.process_batch_job, job_file)
+            elif job_file.suffix in ['.txt', '.sh']:
+                return await self.process_text_job_async(job_file)
+            else:
+                self.log(f"Unknown job format: {job_file.name}", 'WARNING')
+                
+        except Exception as e:
+            await asyncio.to_thread(self.job_crashed, job_file, e)
+        return 'failed'
+    
+    async def process_json_job_async(self, job_file, data):
+        """Process a JSON format job"""
+        self.log(f"Processing JSON job: {job_file.name}")
         
-        self.log("Queue processor stopped")
+        try:
+            cmd = job_command(data)
+        except ValueError as e:
+            return await asyncio.to_thread(self.json_job_failed, job_file, data,
+                                           f"Invalid command: {e}", retry=False)
+        
+        # Result files, the index and retries are written off the loop
+        try:
+            result = await self.run_json_command_async(job_file, data, cmd)
+            return await asyncio.to_thread(self.json_job_done, job_file, data, result)
+        except Exception as e:
+            return await asyncio.to_thread(self.json_job_failed, job_file, data, e)
+    
+    async def process_text_job_async(self, job_file):
+        """Process a text format job (shell command)"""
+        self.log(f"Processing text job: {job_file.name}")
+        cmd = None
+        
+        try:
+            cmd = (await asyncio.to_thread(job_file.read_text)).strip()
+            self.log(f"Executing: {cmd}")
+            argv = direct_argv(cmd)
+            result = await self.execute_async(job_file, argv or cmd, shell=argv is None,
+                                              limits=TEXT_JOB_LIMITS)
+            return await asyncio.to_thread(self.text_job_done, job_file, cmd, result)
+            
+        except Exception as e:
+            return await asyncio.to_thread(self.text_job_failed, job_file, cmd, e)
+    
+    async def run_json_command_async(self, job_file, data, cmd):
+        """Execute a JSON job's command (or answer it from the cache) and return its result block"""
+        # Cache lookups may hash input files
+        key, result_path, result = await asyncio.to_thread(self.prepare_json_command, job_file, data, cmd)
+        if result:
+            return result
+        
+        options = spawn_options(data)
+        if data.get('runner') == 'python-warm' and not data.get('limits') and not options:
+            result = await asyncio.to_thread(self.execute_warm, job_file, cmd, result_path,
+                                             data.get('timeout'))
+        else:
+            result = await self.execute_async(job_file, cmd, isinstance(cmd, str), result_path,
+                                              timeout=data.get('timeout'), limits=data.get('limits'),
+                                              options=options)
+        return await asyncio.to_thread(self.json_command_done, key, result_path, result)
+    
+    async def execute_async(self, job_file, cmd, shell, result_path=None, timeout=None, limits=None,
+                            options=None):
+        """Run a command with its output streamed on the event loop, and return the result block"""
+        self.running_dir.mkdir(parents=True, exist_ok=True)
+        timeout = job_timeout(timeout)
+        limits = ResourceLimits(limits, job_file.name) if limits else None
+        if limits:
+            await asyncio.to_thread(limits.setup)
+        started = time.monotonic()
+        # Spawned like the thread engine's children, so the loop leaves reaping (and wait4) to us
+        try:
+            process = self.spawn(job_file, cmd, shell, limits, options)
+        except Exception:
+            if limits:
+                limits.cleanup()
+            raise
+        sinks = self.output_sinks(job_file, result_path)
+        progress = self.track_progress(job_file, process, sinks)
+        ticker = asyncio.ensure_future(self.tick_progress_async(progress))
+        
+        try:
+            usage = await asyncio.wait_for(self.stream_output_async(process, sinks), timeout)
+            returncode = process.returncode
+            result = {
+                'status': 'completed' if returncode == 0 else 'failed',
+                'returncode': returncode
+            }
+        except asyncio.TimeoutError:
+            usage = await asyncio.to_thread(kill_group, process, KILL_GRACE)
+            result = self.timed_out(job_file, timeout)
+        finally:
+            ticker.cancel()
+            self.untrack(job_file)
+            for pipe in (process.stdout, process.stderr):
+                pipe.close()
+            for sink in sinks.values():
+                sink.close()
+        
+        if progress.reported:
+            result['progress'] = progress.reported
+        if limits:
+            self.check_limits(job_file, limits, result, process.returncode, usage, sinks)
+        return await asyncio.to_thread(self.finish_result, job_file, result, sinks, started, usage)
+    
+    async def tick_progress_async(self, progress):
+        """Rewrite a job's progress record every PROGRESS_INTERVAL until cancelled"""
+        while True:
+            await asyncio.sleep(progress.due())
+            progress.tick()
+    
+    async def stream_output_async(self, process, sinks):
+        """Copy the child's stdout/stderr into their sinks until EOF, then reap it for its usage"""
+        async def pump(pipe, sink):
+            reader = asyncio.StreamReader(limit=OUTPUT_CHUNK)
+            transport, _ = await self.loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), pipe)
+            try:
+                while True:
+                    chunk = await reader.read(OUTPUT_CHUNK)
+                    if not chunk:
+                        return
+                    sink.write(chunk)
+            finally:
+                transport.close()
+        
+        await asyncio.gather(pump(process.stdout, sinks['stdout']),
+                             pump(process.stderr, sinks['stderr']))
+        return await self.reap_async(process)
+    
+    async def reap_async(self, process):
+        """Wait for the child to exit without blocking the loop, then reap it with wait4"""
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        if pidfd is None:
+            # No pidfds (macOS, older kernels): poll, backing off like reap()
+            delay = 0.0005
+            while True:
+                try:
+                    return reap(process, 0)
+                except subprocess.TimeoutExpired:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+        exited = self.loop.create_future()
+        self.loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            self.loop.remove_reader(pidfd)
+            os.close(pidfd)
+        return reap(process, None)
+
+
+def parse_duration(text):
+    """Parse '90', '90s', '15m', '2h' or '1d' into seconds"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    text = str(text).strip().lower()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def jobs_command(args):
+    """Answer a job index query from the command line"""
+    index = JobIndex()
+    try:
+        if args.action == 'status':
+            record = index.get(args.job) or index.find_task(args.job)
+            if record is None:
+                print(f"No job named {args.job}", file=sys.stderr)
+                return 1
+            print(json.dumps(record, indent=2))
+        elif args.action == 'count':
+            since = parse_duration(args.since) if args.since else None
+            print(index.count(state=args.state, since=since))
+        elif args.action == 'counts':
+            for state, count in sorted(index.counts().items()):
+                print(f"{state} {count}")
+        elif args.action == 'list':
+            for record in index.recent(state=args.state, limit=args.limit):
+                print(json.dumps(record))
+    finally:
+        index.close()
+    return 0
+
+
+def archive_command(args):
+    """Run a retention pass or fetch an archived result from the command line"""
+    max_age = parse_duration(args.max_age) if args.max_age else None
+    results = make_result_store(args.result_store)
+    archive = ResultArchive(max_age=max_age, max_count=args.max_count,
+                            results=results if results.name == 'log' else None)
+    try:
+        if args.action == 'run':
+            print(archive.run_once())
+        elif args.action == 'get':
+            data = archive.fetch(name=args.job) or archive.fetch(task_id=args.job)
+            if data is None:
+                print(f"No archived result for {args.job}", file=sys.stderr)
+                return 1
+            sys.stdout.buffer.write(data)
+    finally:
+        archive.stop()
+        results.close()
+    return 0
+
+
+def results_command(args):
+    """Read results back from the configured store, or write them out as per-job files"""
+    results = make_result_store(args.result_store)
+    index = JobIndex()
+    try:
+        if args.action == 'get':
+            record = index.get(args.job) or index.find_task(args.job)
+            paths = [Path(record['result_path'])] if record and record['result_path'] else []
+            paths += [dir / args.job for dir in (COMPLETED_DIR, FAILED_DIR)]
+            data = next(filter(None, map(results.read, paths)), None)
+            if data is None:
+                print(f"No result for {args.job}", file=sys.stderr)
+                return 1
+            sys.stdout.buffer.write(data)
+        elif args.action == 'materialize':
+            if args.all:
+                paths = [QUEUE_BASE / dir / name for dir, name in results.names()]
+            else:
+                paths = [dir / name for name in args.jobs for dir in (COMPLETED_DIR, FAILED_DIR)
+                         if results.written_at(dir / name) is not None]
+            for path in paths:
+                if results.materialize(path):
+                    print(path)
+    finally:
+        results.close()
+        index.close()
+    return 0
+
+
+def api_call(request, path=None):
+    """Send one request to a running server's API socket and yield its replies"""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(str(path or API_SOCKET))
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as replies:
+            for line in replies:
+                yield json.loads(line)
+
+
+def submit_command(args):
+    """Submit a JSON job through the API, optionally waiting for or streaming its result"""
+    if args.id:
+        request = {'op': 'stream' if args.stream else 'wait', 'id': args.id}
+    else:
+        with (sys.stdin if args.job == '-' else open(args.job)) as f:
+            request = {'op': 'submit', 'job': json.load(f), 'wait': args.wait,
+                       'stream': args.stream}
+        if args.name:
+            request['name'] = args.name
+    if args.timeout is not None:
+        request['timeout'] = args.timeout
+    
+    path = API_SOCKET.with_name(f"exec.{args.via}.sock") if args.via else None
+    for reply in api_call(request, path):
+        if not reply['ok']:
+            print(reply['error'], file=sys.stderr)
+            if reply.get('event') == 'rejected':
+                print(f"Retry after {reply['retry_after']:g}s", file=sys.stderr)
+                return 75  # EX_TEMPFAIL
+            return 1
+        if reply['event'] == 'accepted':
+            print(reply['id'], file=sys.stderr if args.wait or args.stream else sys.stdout)
+        elif reply['event'] == 'output':
+            out = sys.stdout if reply['stream'] == 'stdout' else sys.stderr
+            out.write(reply['data'])
+            out.flush()
+        elif reply['event'] == 'result':
+            if not args.stream:
+                print(json.dumps(reply['result'], indent=2))
+            return 0 if reply['status'] == 'completed' else 1
+    return 0
+
+
+def progress_command(args):
+    """Print a job's progress record, or its state once it is not running"""
+    path = API_SOCKET.with_name(f"exec.{args.via}.sock") if args.via else None
+    reply = next(api_call({'op': 'progress', 'id': args.id}, path))
+    if not reply['ok']:
+        print(reply['error'], file=sys.stderr)
+        return 1
+    print(json.dumps({k: v for k, v in reply.items() if k not in ('ok', 'event')}, indent=2))
+    return 0
+
+
+def tail_command(args):
+    """Print a job's output from an offset, and with --follow keep printing until it ends"""
+    path = API_SOCKET.with_name(f"exec.{args.via}.sock") if args.via else None
+    out = sys.stdout if args.stream == 'stdout' else sys.stderr
+    offset = args.offset
+    while True:
+        reply = next(api_call({'op': 'tail', 'id': args.id, 'stream': args.stream,
+                               'offset': offset}, path))
+        if not reply['ok']:
+            print(reply['error'], file=sys.stderr)
+            return 1
+        out.write(reply['data'])
+        out.flush()
+        offset = reply['next_offset']
+        if reply['data']:
+            continue
+        if not args.follow or reply['state'] not in JobIndex.OPEN_STATES:
+            return 0
+        time.sleep(PROGRESS_INTERVAL)
+
 
 def main():
     """Run the queue processor"""
-    processor = QueueProcessor()
+    parser = argparse.ArgumentParser(description='Brain Execution Queue Processor')
+    parser.add_argument('--queue', default=str(QUEUE_BASE),
+                        help='queue base directory')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='jobs to run concurrently (env BRAIN_EXEC_WORKERS, default: CPU count)')
+    parser.add_argument('--watcher', choices=['auto', 'inotify', 'poll'], default=WATCHER_BACKEND,
+                        help='pending/ watcher backend (env BRAIN_EXEC_WATCHER)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default=ENGINE,
+                        help='execution engine (env BRAIN_EXEC_ENGINE)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve Prometheus metrics on 127.0.0.1:PORT (env BRAIN_EXEC_METRICS_PORT, 0: off)')
+    parser.add_argument('--result-store', choices=['files', 'log'], default=RESULT_STORE,
+                        help='where results are written (env BRAIN_EXEC_RESULT_STORE)')
+    parser.add_argument('--node', default=NODE,
+                        help='share the queue with other servers under this node name (env BRAIN_EXEC_NODE)')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    jobs = subparsers.add_parser('jobs', help='query the job index')
+    actions = jobs.add_subparsers(dest='action', required=True)
+    status = actions.add_parser('status', help='newest record for a job file name or task_id')
+    status.add_argument('job')
+    count = actions.add_parser('count', help='count jobs')
+    count.add_argument('--state', help='only jobs in this state (e.g. failed)')
+    count.add_argument('--since', help='only jobs finished within this long (e.g. 1h)')
+    actions.add_parser('counts', help='number of jobs in each state')
+    recent = actions.add_parser('list', help='most recent jobs')
+    recent.add_argument('--state', help='only jobs in this state')
+    recent.add_argument('--limit', type=int, default=20)
+    
+    archive = subparsers.add_parser('archive', help='result retention and archived results')
+    archive.set_defaults(max_age=None, max_count=None)
+    actions = archive.add_subparsers(dest='action', required=True)
+    run = actions.add_parser('run', help='archive results outside the retention limits now')
+    run.add_argument('--max-age', help='archive results older than this (e.g. 7d)')
+    run.add_argument('--max-count', type=int, help='keep at most this many results per directory')
+    get = actions.add_parser('get', help='print an archived result by file name or task_id')
+    get.add_argument('job')
+    results = subparsers.add_parser('results', help='read results from the result store')
+    actions = results.add_subparsers(dest='action', required=True)
+    get = actions.add_parser('get', help='print a result by file name or task_id')
+    get.add_argument('job')
+    materialize = actions.add_parser('materialize',
+                                     help='write stored results out as completed/ and failed/ files')
+    materialize.add_argument('jobs', nargs='*', metavar='NAME', help='result file names')
+    materialize.add_argument('--all', action='store_true', help='every result in the store')
+    submit = subparsers.add_parser('submit', help='submit a JSON job through the API socket')
+    submit.add_argument('job', nargs='?', default='-', help='JSON job file (default: stdin)')
+    submit.add_argument('--name', help='job id (default: generated)')
+    submit.add_argument('--id', help='follow an already submitted job instead')
+    submit.add_argument('--wait', action='store_true', help='block until the result, then print it')
+    submit.add_argument('--stream', action='store_true', help='print output as it is produced')
+    submit.add_argument('--timeout', type=float, help='give up waiting after this many seconds')
+    submit.add_argument('--via', metavar='NODE', help="use this node's API socket (node mode)")
+    progress = subparsers.add_parser('progress', help="print a running job's progress through the API")
+    progress.add_argument('id', help='job id')
+    progress.add_argument('--via', metavar='NODE', help="use this node's API socket (node mode)")
+    tail = subparsers.add_parser('tail', help="print a job's output through the API")
+    tail.add_argument('id', help='job id')
+    tail.add_argument('--stream', choices=['stdout', 'stderr'], default='stdout')
+    tail.add_argument('--offset', type=int, default=0, help='start at this byte')
+    tail.add_argument('--follow', '-f', action='store_true', help='keep printing until the job ends')
+    tail.add_argument('--via', metavar='NODE', help="use this node's API socket (node mode)")
+    subparsers.add_parser('warm-worker', help='(internal) serve python-warm jobs on stdin')
+    args = parser.parse_args()
+    
+    if args.queue != str(QUEUE_BASE):
+        set_queue_base(args.queue)
+    if args.command == 'jobs':
+        return jobs_command(args)
+    if args.command == 'archive':
+        return archive_command(args)
+    if args.command == 'results':
+        return results_command(args)
+    if args.command == 'submit':
+        return submit_command(args)
+    if args.command == 'progress':
+        return progress_command(args)
+    if args.command == 'tail':
+        return tail_command(args)
+    if args.command == 'warm-worker':
+        return warm_worker()
+    
+    engine = AsyncQueueProcessor if args.engine == 'asyncio' else QueueProcessor
+    processor = engine(watcher=args.watcher, workers=args.workers,
+                       metrics_port=args.metrics_port, results=args.result_store, node=args.node)
     
     print("🚀 Brain Execution Queue Processor")
     print(f"📁 Monitoring: {PENDING_DIR}")
+    print(f"👷 Workers: {processor.workers} ({processor.engine} engine)")
+    if processor.node:
+        print(f"🔗 Node: {processor.node} ({len(processor.leases.shards)} shards)")
     print(f"📝 Log file: {LOG_FILE}")
     print("\nPress Ctrl+C to stop...\n")
     
@@ -282,6 +5041,7 @@ def main():
         processor.run()
     except KeyboardInterrupt:
         print("\n✋ Processor stopped")
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -27,13 +27,36 @@ echo ""
 
 # Check queue status
 echo "📁 Queue Status:"
-PENDING=$(ls -1 /Users/bard/mcp/memory_files/command_queue/pending/*.json 2>/dev/null | wc -l | tr -d ' ')
-COMPLETED=$(ls -1 /Users/bard/mcp/memory_files/command_queue/completed/*.json 2>/dev/null | wc -l | tr -d ' ')
-FAILED=$(ls -1 /Users/bard/mcp/memory_files/command_queue/failed/*.json 2>/dev/null | wc -l | tr -d ' ')
+QUEUE=/Users/bard/mcp/memory_files/command_queue
+SERVER="$(cd "$(dirname "$0")" && pwd)/server.py"
+if [ -f "$QUEUE/jobs.db" ]; then
+    # Indexed lookups instead of listing the result directories
+    COUNTS=$(python3 "$SERVER" --queue "$QUEUE" jobs counts)
+    count() { echo "$COUNTS" | awk -v s="$1" '$1 == s { print $2 }' | grep . || echo 0; }
+    # Every state a job can be in before a worker claims it
+    PENDING=0
+    PENDING_DETAIL=""
+    for state in queued waiting delayed coalesced; do
+        PENDING=$(( PENDING + $(count $state) ))
+        PENDING_DETAIL="$PENDING_DETAIL, $(count $state) $state"
+    done
+    PENDING_DETAIL="(${PENDING_DETAIL#, })"
+    RUNNING=$(count running)
+    COMPLETED=$(count completed)
+    FAILED=$(count failed)
+    RECENT_FAILED=$(python3 "$SERVER" --queue "$QUEUE" jobs count --state failed --since 1h)
+else
+    PENDING=$(ls -1 $QUEUE/pending/*.json 2>/dev/null | wc -l | tr -d ' ')
+    RUNNING=$(ls -1 $QUEUE/running/*.json 2>/dev/null | wc -l | tr -d ' ')
+    COMPLETED=$(ls -1 $QUEUE/completed/*.json 2>/dev/null | wc -l | tr -d ' ')
+    FAILED=$(ls -1 $QUEUE/failed/*.json 2>/dev/null | wc -l | tr -d ' ')
+    RECENT_FAILED="?"
+fi
 
-echo "   Pending:   $PENDING jobs"
+echo "   Pending:   $PENDING jobs${PENDING_DETAIL:+ $PENDING_DETAIL}"
+echo "   Running:   $RUNNING jobs"
 echo "   Completed: $COMPLETED jobs"
-echo "   Failed:    $FAILED jobs"
+echo "   Failed:    $FAILED jobs ($RECENT_FAILED in the last hour)"
 echo ""
 
 # Show recent log entries
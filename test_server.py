@@ -3,6 +3,9 @@
 Unit tests for the Brain Execution Server Queue Processor
 """
 
+import asyncio
+import collections
+import gzip
 import json
 import os
 import sys
@@ -10,13 +13,113 @@ import tempfile
 import subprocess
 import time
 import shutil
+import threading
+import signal
+import socket
+import urllib.request
 from pathlib import Path
+from datetime import datetime
 import unittest
 from unittest.mock import patch, MagicMock
 
 # Add the parent directory to the path so we can import server
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from server import QueueProcessor
+import server
+from server import (QueueProcessor, AsyncQueueProcessor, PendingIndex, PollWatcher, InotifyWatcher, JobGraph,
+                    ResultCache, JobIndex, ResultArchive, LogWriter, Metrics, job_meta, api_call,
+                    write_atomic, retry_delay, Scheduler, parse_cron, cron_next, FileResultStore,
+                    LogResultStore, ShardLeases, shard_of, Admission, PendingJobs, Coalescer,
+                    dedupe_key, JobProgress, OutputSink, parse_progress, process_usage, ps_usage,
+                    utf8_prefix, job_command, spawn_options, direct_argv, QueueFull,
+                    WarmPool)
+
+
+def queue_patches(base):
+    """Patches that point every queue path in the server module at base"""
+    return [
+        patch('server.QUEUE_BASE', base),
+        patch('server.PENDING_DIR', base / 'pending'),
+        patch('server.COMPLETED_DIR', base / 'completed'),
+        patch('server.FAILED_DIR', base / 'failed'),
+        patch('server.RUNNING_DIR', base / 'running'),
+        patch('server.REJECTED_DIR', base / 'rejected'),
+        patch('server.QUEUE_STATUS', base / 'queue_status.json'),
+        patch('server.CACHE_DIR', base / 'cache'),
+        patch('server.JOB_DB', base / 'jobs.db'),
+        patch('server.ARCHIVE_DIR', base / 'archive'),
+        patch('server.RESULTS_DIR', base / 'results'),
+        patch('server.SCHEDULES_DIR', base / 'schedules'),
+        patch('server.SCHEDULE_STATE', base / 'schedule_state.json'),
+        patch('server.LEASES_DIR', base / 'leases'),
+        patch('server.NODES_DIR', base / 'nodes'),
+        patch('server.LOG_FILE', base / 'daemon.log'),
+        patch('server.API_SOCKET', base / 'exec.sock')
+    ]
+
+
+def wait_for(predicate, timeout=5):
+    """Poll predicate until it returns true or the timeout expires"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class QueueTestCase(unittest.TestCase):
+    """Base for tests run against a scratch queue that the server module is pointed at"""
+    
+    # Module globals patched for every test of a class, on top of the queue paths
+    extra_patches = {}
+    
+    def setUp(self):
+        """Set up a scratch queue, removed after the processors started by a test stop"""
+        self.test_base = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.test_base)
+        extra = [patch(target, value) for target, value in self.extra_patches.items()]
+        for p in queue_patches(self.test_base) + extra:
+            p.start()
+            self.addCleanup(p.stop)
+        for dir in ['pending', 'running', 'completed', 'failed']:
+            (self.test_base / dir).mkdir()
+    
+    def submit(self, name, job_data):
+        """Drop a job into pending/ as a submitter would: a JSON object, or a text job's line"""
+        tmp = self.test_base / f'.{name}.tmp'
+        tmp.write_text(job_data if isinstance(job_data, str) else json.dumps(job_data))
+        os.rename(tmp, self.test_base / 'pending' / name)
+        return self.test_base / 'pending' / name
+    
+    def run_processor(self, processor):
+        """Run a processor on a background thread until the test ends, and return the thread"""
+        thread = threading.Thread(target=processor.run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 10)
+        self.addCleanup(processor.stop)
+        self.assertTrue(wait_for(lambda: processor.watcher is not None))
+        return thread
+    
+    def wait_result(self, dir, name, timeout=5):
+        """Wait for a job's result file and return its contents"""
+        path = self.test_base / dir / name
+        self.assertTrue(wait_for(path.exists, timeout), f"{dir}/{name} never appeared")
+        with open(path) as f:
+            return json.load(f)
+    
+    def result(self, name):
+        """Result block of a finished job, from completed/ or failed/"""
+        for dir in ['completed', 'failed']:
+            path = self.test_base / dir / name
+            if path.exists():
+                with open(path) as f:
+                    return json.load(f)['result']
+        self.fail(f"No result for {name}")
+    
+    def run_job(self, name, job_data):
+        """Submit a job, process it on self.processor in this thread and return its result block"""
+        self.processor.process_job(self.submit(name, job_data))
+        return self.result(name)
 
 
 class TestQueueProcessor(unittest.TestCase):
@@ -36,13 +139,7 @@ class TestQueueProcessor(unittest.TestCase):
             dir.mkdir(parents=True, exist_ok=True)
         
         # Patch the queue directories in the module
-        self.patches = [
-            patch('server.QUEUE_BASE', self.test_base),
-            patch('server.PENDING_DIR', self.test_pending),
-            patch('server.COMPLETED_DIR', self.test_completed),
-            patch('server.FAILED_DIR', self.test_failed),
-            patch('server.LOG_FILE', self.test_log)
-        ]
+        self.patches = queue_patches(self.test_base)
         
         for p in self.patches:
             p.start()
@@ -201,10 +298,12 @@ class TestQueueProcessor(unittest.TestCase):
         with open(job_file, 'w') as f:
             json.dump(job_data, f)
         
-        # Mock subprocess to simulate timeout
-        with patch('subprocess.Popen') as mock_popen:
+        # Mock subprocess and output streaming to simulate timeout
+        with patch('subprocess.Popen') as mock_popen, \
+                patch('server.kill_group', return_value=None) as mock_kill, \
+                patch.object(QueueProcessor, 'stream_output',
+                             side_effect=subprocess.TimeoutExpired('cmd', 5)):
             mock_process = MagicMock()
-            mock_process.communicate.side_effect = subprocess.TimeoutExpired('cmd', 5)
             mock_popen.return_value = mock_process
             
             # Process the job
@@ -219,6 +318,7 @@ class TestQueueProcessor(unittest.TestCase):
         
         self.assertEqual(result_data['result']['status'], 'failed')
         self.assertIn('Timeout', result_data['result']['error'])
+        mock_kill.assert_called_once_with(mock_process, server.KILL_GRACE)
     
     def test_logging(self):
         """Test logging functionality"""
@@ -235,6 +335,49 @@ class TestQueueProcessor(unittest.TestCase):
         self.assertIn("[INFO] Test message", log_content)
         self.assertIn("[ERROR] Test error", log_content)
     
+    def test_background_log_writer(self):
+        """Test that queued records are all flushed when the writer stops"""
+        writer = LogWriter(echo=False)
+        writer.start()
+        for i in range(1000):
+            writer.write(f"line {i}")
+        writer.stop()
+        
+        lines = self.test_log.read_text().splitlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertTrue(lines[-1].endswith("[INFO] line 999"))
+    
+    def test_log_rotation(self):
+        """Test that the log rotates by size and keeps a bounded number of backups"""
+        writer = LogWriter(max_bytes=500, backups=2, echo=False)
+        for i in range(100):
+            writer.write(f"rotating line {i}")
+        
+        backups = sorted(p.name for p in self.test_log.parent.glob('daemon.log.*'))
+        self.assertEqual(backups, ['daemon.log.1', 'daemon.log.2'])
+        newest = (self.test_log.parent / 'daemon.log.1').read_text()
+        if self.test_log.exists():
+            newest += self.test_log.read_text()
+        self.assertIn("rotating line 99", newest)
+        for path in self.test_log.parent.glob('daemon.log*'):
+            self.assertLess(path.stat().st_size, 600)
+    
+    def test_json_log_fields(self):
+        """Test structured JSON-lines logging of job completions"""
+        job_file = self.test_pending / "structured.json"
+        with open(job_file, 'w') as f:
+            json.dump({"command": "false"}, f)
+        self.processor.logger = LogWriter(format='json', echo=False)
+        self.processor.process_job(job_file)
+        
+        records = [json.loads(line) for line in self.test_log.read_text().splitlines()]
+        done = [r for r in records if r.get('status')]
+        self.assertEqual(len(done), 1)
+        self.assertEqual(done[0]['job'], 'structured.json')
+        self.assertEqual(done[0]['returncode'], 1)
+        self.assertGreaterEqual(done[0]['duration'], 0)
+        self.assertEqual(done[0]['level'], 'INFO')
+    
     def test_invalid_job_format(self):
         """Test handling of invalid job formats"""
         # Create a job with no command
@@ -265,13 +408,7 @@ class TestIntegration(unittest.TestCase):
     def setUp(self):
         """Set up integration test environment"""
         self.test_base = Path(tempfile.mkdtemp())
-        self.patches = [
-            patch('server.QUEUE_BASE', self.test_base),
-            patch('server.PENDING_DIR', self.test_base / 'pending'),
-            patch('server.COMPLETED_DIR', self.test_base / 'completed'),
-            patch('server.FAILED_DIR', self.test_base / 'failed'),
-            patch('server.LOG_FILE', self.test_base / 'daemon.log')
-        ]
+        self.patches = queue_patches(self.test_base)
         
         for p in self.patches:
             p.start()
@@ -311,6 +448,2082 @@ class TestIntegration(unittest.TestCase):
         self.assertEqual(len(completed_files), 3, "All jobs should be completed")
 
 
+
+class TestPendingWatcher(unittest.TestCase):
+    """Tests for the pending directory watchers and index"""
+    
+    def setUp(self):
+        """Set up a scratch queue"""
+        self.test_base = Path(tempfile.mkdtemp())
+        self.patches = queue_patches(self.test_base)
+        for p in self.patches:
+            p.start()
+        (self.test_base / 'pending').mkdir()
+    
+    def tearDown(self):
+        """Clean up"""
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.test_base)
+    
+    def test_index_keeps_name_order(self):
+        """Test that the index pops names in lexical order and honours discards"""
+        index = PendingIndex()
+        for name in ['c.json', 'a.json', 'b.txt', 'a.json']:
+            index.add(name)
+        index.discard('b.txt')
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.pop(), 'a.json')
+        self.assertEqual(index.pop(), 'c.json')
+        self.assertIsNone(index.pop())
+    
+    def test_poll_watcher_reports_changes(self):
+        """Test that the poll watcher diffs directory scans"""
+        pending = self.test_base / 'pending'
+        (pending / 'old.txt').write_text('true')
+        watcher = PollWatcher(interval=0)
+        try:
+            self.assertEqual(watcher.add_dir(pending), ['old.txt'])
+            (pending / 'new.txt').write_text('true')
+            (pending / 'old.txt').unlink()
+            events = watcher.wait(1)
+        finally:
+            watcher.close()
+        self.assertIn(('added', pending / 'new.txt'), events)
+        self.assertIn(('removed', pending / 'old.txt'), events)
+    
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_inotify_watcher_wakes_on_close(self):
+        """Test that inotify reports a file once it is closed for writing"""
+        pending = self.test_base / 'pending'
+        watcher = InotifyWatcher()
+        try:
+            watcher.add_dir(pending)
+            with open(pending / 'job.json', 'w') as f:
+                f.write('{}')
+            start = time.time()
+            events = watcher.wait(5)
+        finally:
+            watcher.close()
+        self.assertLess(time.time() - start, 1)
+        self.assertIn(('added', pending / 'job.json'), events)
+    
+    def test_run_loop_processes_new_job(self):
+        """Test that a running processor picks up a job without a poll delay"""
+        processor = QueueProcessor()
+        thread = threading.Thread(target=processor.run, daemon=True)
+        thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: processor.watcher is not None))
+            with open(self.test_base / 'pending' / 'live.json', 'w') as f:
+                json.dump({"command": "echo", "args": ["live"]}, f)
+            result = self.test_base / 'completed' / 'live.json'
+            timeout = 5 if processor.watcher.name == 'poll' else 1
+            self.assertTrue(wait_for(result.exists, timeout), "Job should complete promptly")
+        finally:
+            processor.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive(), "Processor should stop promptly")
+
+
+
+class TestWorkerPool(QueueTestCase):
+    """Tests for concurrent workers and atomic job claiming"""
+    
+    def test_claim_is_exclusive(self):
+        """Test that only one claim of a pending job succeeds"""
+        (self.test_base / 'pending' / 'job.txt').write_text('true')
+        first, second = QueueProcessor(), QueueProcessor()
+        self.assertEqual(first.claim_job('job.txt'), self.test_base / 'running' / 'job.txt')
+        self.assertIsNone(second.claim_job('job.txt'))
+    
+    def test_jobs_run_concurrently(self):
+        """Test that sleep-bound jobs overlap across workers"""
+        for i in range(4):
+            self.submit(f'sleep_{i}.txt', 'sleep 0.5')
+        processor = QueueProcessor(workers=4)
+        start = time.time()
+        self.run_processor(processor)
+        done = lambda: len(list((self.test_base / 'completed').iterdir())) == 4
+        self.assertTrue(wait_for(done, 10), "All jobs should complete")
+        processor.stop()
+        self.assertLess(time.time() - start, 1.5, "Jobs should not run one at a time")
+        self.assertEqual(list((self.test_base / 'running').iterdir()), [])
+    
+    def test_stop_terminates_all_children(self):
+        """Test that stop() terminates every in-flight job"""
+        for i in range(3):
+            self.submit(f'long_{i}.json', {"command": "sleep", "args": ["30"]})
+        processor = QueueProcessor(workers=3)
+        thread = self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: len(processor.active) == 3))
+        processor.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(list((self.test_base / 'failed').iterdir())), 3)
+    
+    def test_orphans_requeued_on_start(self):
+        """Test that jobs left in running/ by a dead server are run again"""
+        (self.test_base / 'running' / 'orphan.txt').write_text('echo again')
+        self.run_processor(QueueProcessor())
+        self.wait_result('completed', 'orphan_result.json')
+
+
+
+class TestOutputStreaming(QueueTestCase):
+    """Tests for streamed stdout/stderr capture"""
+    
+    extra_patches = {'server.OUTPUT_PREVIEW_BYTES': 1000, 'server.OUTPUT_MAX_BYTES': 50000}
+    
+    def setUp(self):
+        """Set up a scratch queue and a processor to run jobs on"""
+        super().setUp()
+        self.processor = QueueProcessor()
+    
+    def test_small_output_stays_inline(self):
+        """Test that short output is embedded without spool files"""
+        result = self.run_job('small.json', {"command": "echo", "args": ["tiny"]})
+        self.assertEqual(result['stdout'], 'tiny\n')
+        self.assertNotIn('stdout_file', result)
+        self.assertEqual(sorted(p.name for p in (self.test_base / 'completed').iterdir()),
+                         ['small.json'])
+        self.assertEqual(list((self.test_base / 'running').iterdir()), [])
+    
+    def test_large_output_is_spooled_and_capped(self):
+        """Test that long output is previewed in JSON and capped in the spool"""
+        code = "import sys; sys.stdout.write('x' * 200000); sys.stderr.write('oops')"
+        result = self.run_job('big.json', {"command": "python3", "args": ["-c", code]})
+        
+        self.assertEqual(result['status'], 'completed')
+        self.assertTrue(result['stdout'].startswith('x' * 1000))
+        self.assertIn('preview truncated', result['stdout'])
+        self.assertEqual(result['stdout_bytes'], 200000)
+        self.assertTrue(result['stdout_truncated'])
+        self.assertEqual(result['stderr'], 'oops')
+        
+        spool = Path(result['stdout_file'])
+        self.assertEqual(spool.parent, self.test_base / 'completed')
+        content = spool.read_bytes()
+        self.assertTrue(content.startswith(b'x' * 50000))
+        self.assertIn(b'output truncated at 50000 bytes', content)
+    
+    def test_result_file_fed_from_stream(self):
+        """Test that result_file receives the full stream, not the preview"""
+        code = "print('y' * 5000)"
+        result = self.run_job('report.json', {"command": "python3", "args": ["-c", code],
+                                              "result_file": "report.txt"})
+        report = self.test_base / 'report.txt'
+        self.assertEqual(report.read_text(), 'y' * 5000 + '\n')
+        self.assertEqual(result['stdout_file'], str(report))
+        self.assertEqual(list((self.test_base / 'running').iterdir()), [])
+
+
+
+class TestPriorityLanes(QueueTestCase):
+    """Tests for priority scheduling and per-source fairness"""
+    
+    def test_high_priority_jumps_the_flood(self):
+        """Test that a high-priority job pops ahead of a low-priority flood"""
+        index = PendingIndex()
+        for i in range(1000):
+            index.add(f'a_{i:04d}.json', priority=-10, source='bulk')
+        index.add('z_urgent.json', priority=10, source='chat')
+        self.assertEqual(index.pop(), 'z_urgent.json')
+        self.assertEqual(index.pop(), 'a_0000.json')
+    
+    def test_sources_round_robin_within_a_level(self):
+        """Test that one source cannot monopolise a priority level"""
+        index = PendingIndex()
+        for i in range(3):
+            index.add(f'flood_{i}.json', source='flood')
+        index.add('single.json', source='todo')
+        index.discard('flood_1.json')
+        order = [index.pop() for _ in range(3)]
+        self.assertEqual(order, ['flood_0.json', 'single.json', 'flood_2.json'])
+        self.assertIsNone(index.pop())
+    
+    def test_job_meta_lanes(self):
+        """Test lane resolution for JSON and text jobs"""
+        lane = lambda path: (job_meta(path)['priority'], job_meta(path)['source'])
+        named = self.submit('named.json', {"command": "true", "priority": "high", "tool": "brain"})
+        self.assertEqual(lane(named), (10, 'brain'))
+        plain = self.submit('plain.json', {"command": "true"})
+        self.assertEqual(lane(plain), (0, 'default'))
+        self.assertEqual(lane(self.submit('shell.sh', 'true')), (0, 'text'))
+    
+    def test_flood_does_not_delay_high_priority(self):
+        """Test end to end that a high-priority job overtakes queued low-priority work"""
+        for i in range(20):
+            self.submit(f'a_low_{i:02d}.json', {"command": "sleep", "args": ["0.05"],
+                                                "priority": "low", "source": "bulk"})
+        self.submit('z_high.json', {"command": "true", "priority": "high"})
+        self.run_processor(QueueProcessor(workers=1))
+        self.wait_result('completed', 'z_high.json', 10)
+        low_done = len(list((self.test_base / 'completed').glob('a_low_*')))
+        self.assertLessEqual(low_done, 1, "High-priority job should not wait behind the flood")
+
+
+
+class TestJobDependencies(QueueTestCase):
+    """Tests for depends_on job chains"""
+    
+    def run_until(self, names, workers=2, timeout=10):
+        """Run a processor until every named job has a result"""
+        processor = QueueProcessor(workers=workers)
+        thread = self.run_processor(processor)
+        done = lambda: all((self.test_base / 'completed' / n).exists() or
+                           (self.test_base / 'failed' / n).exists() for n in names)
+        self.assertTrue(wait_for(done, timeout), "All jobs should finish")
+        processor.stop()
+        thread.join(5)
+        return {name: self.result(name) for name in names}
+    
+    def test_graph_rejects_cycles_and_missing_parents(self):
+        """Test submission-time validation of the dependency graph"""
+        graph = JobGraph()
+        meta = lambda job_id, *parents: {'id': job_id, 'depends_on': list(parents)}
+        ready, rejected = graph.add([
+            ('a.json', meta('a')),
+            ('b.json', meta('b', 'c')),
+            ('c.json', meta('c', 'b')),
+            ('d.json', meta('d', 'nowhere')),
+            ('e.json', meta('e', 'a'))
+        ])
+        self.assertEqual([name for name, _ in ready], ['a.json'])
+        errors = {name: error for name, _, error in rejected}
+        self.assertIn('cycle', errors['b.json'])
+        self.assertIn('c.json', errors)
+        self.assertIn('Unknown dependency: nowhere', errors['d.json'])
+        released, failed = graph.finish('a', 'completed')
+        self.assertEqual([name for name, _ in released], ['e.json'])
+    
+    def test_chain_runs_in_order(self):
+        """Test that a job starts only after its parent completes"""
+        self.submit('c_last.json', {"command": "true", "depends_on": ["b_middle"]})
+        self.submit('b_middle.json', {"command": "sleep", "args": ["0.2"], "depends_on": ["a_first"]})
+        self.submit('a_first.json', {"command": "sleep", "args": ["0.2"]})
+        results = self.run_until(['a_first.json', 'b_middle.json', 'c_last.json'])
+        self.assertTrue(all(r['status'] == 'completed' for r in results.values()))
+        finished = [results[n]['completed_at'] for n in ['a_first.json', 'b_middle.json', 'c_last.json']]
+        self.assertEqual(finished, sorted(finished))
+    
+    def test_independent_branches_run_in_parallel(self):
+        """Test that siblings released by one parent run concurrently"""
+        self.submit('root.json', {"command": "true"})
+        for branch in ['left', 'right']:
+            self.submit(f'{branch}.json', {"command": "sleep", "args": ["0.5"], "depends_on": ["root"]})
+        start = time.time()
+        self.run_until(['root.json', 'left.json', 'right.json'])
+        self.assertLess(time.time() - start, 1.0)
+    
+    def test_failure_cascades_to_dependents(self):
+        """Test that dependents of a failed job fail without running"""
+        self.submit('parent.json', {"command": "false"})
+        self.submit('child.json', {"command": "touch", "args": [str(self.test_base / 'ran')],
+                                   "depends_on": ["parent"]})
+        self.submit('grandchild.json', {"command": "true", "depends_on": ["child"]})
+        results = self.run_until(['parent.json', 'child.json', 'grandchild.json'])
+        self.assertEqual(results['child.json']['error'], 'Dependency failed: parent')
+        self.assertEqual(results['grandchild.json']['error'], 'Dependency failed: child')
+        self.assertFalse((self.test_base / 'ran').exists())
+    
+    def test_missing_parent_rejected_on_submission(self):
+        """Test that a job naming an unknown parent fails immediately"""
+        self.submit('orphan.json', {"command": "true", "depends_on": ["ghost"]})
+        results = self.run_until(['orphan.json'])
+        self.assertEqual(results['orphan.json']['error'], 'Unknown dependency: ghost')
+    
+    def test_parent_finished_earlier_is_found_on_disk(self):
+        """Test that a parent completed by an earlier run satisfies the dependency"""
+        with open(self.test_base / 'completed' / 'setup.json', 'w') as f:
+            json.dump({"command": "true", "result": {"status": "completed"}}, f)
+        self.submit('after.json', {"command": "true", "depends_on": ["setup"]})
+        results = self.run_until(['after.json'])
+        self.assertEqual(results['after.json']['status'], 'completed')
+    
+    def test_resubmitted_job_replaces_earlier_result(self):
+        """Test that a failed id submitted again is pending, and finished ids are capped"""
+        graph = JobGraph(lookup=lambda job_id: None)
+        graph.finish('build', 'failed')
+        ready, rejected = graph.add([
+            ('build.json', {'id': 'build', 'depends_on': []}),
+            ('deploy.json', {'id': 'deploy', 'depends_on': ['build']})
+        ])
+        self.assertEqual(([name for name, _ in ready], rejected), (['build.json'], []))
+        self.assertEqual(graph.state('build'), 'pending')
+        released, failed = graph.finish('build', 'completed')
+        self.assertEqual(([name for name, _ in released], failed), (['deploy.json'], []))
+        with patch.object(JobGraph, 'MAX_FINISHED', 2):
+            for job_id in ['a', 'b', 'c']:
+                graph.finish(job_id, 'completed')
+        self.assertEqual(list(graph.finished), ['b', 'c'])
+        self.assertIsNone(graph.state('a'))
+    
+    def test_deleted_parent_fails_dependents(self):
+        """Test that deleting a queued parent from pending/ fails the jobs waiting on it"""
+        self.submit('a_blocker.json', {"command": "sleep", "args": ["1"]})
+        self.submit('parent.json', {"command": "true"})
+        self.submit('child.json', {"command": "true", "depends_on": ["parent"]})
+        self.run_processor(QueueProcessor(workers=1))
+        self.assertTrue(wait_for(lambda: (self.test_base / 'running' / 'a_blocker.json').exists()))
+        (self.test_base / 'pending' / 'parent.json').unlink()
+        child = self.wait_result('failed', 'child.json')
+        self.assertEqual(child['result']['error'], 'Dependency failed: parent')
+
+
+
+class TestBatchJobs(QueueTestCase):
+    """Tests for JSONL batch job files"""
+    
+    def setUp(self):
+        """Set up a scratch queue and a processor to run jobs on"""
+        super().setUp()
+        self.processor = QueueProcessor()
+    
+    def write_batch(self, name, jobs):
+        """Write a JSONL batch file into pending/"""
+        return self.submit(name, ''.join((job if isinstance(job, str) else json.dumps(job)) + '\n'
+                                         for job in jobs))
+    
+    def read_results(self, path):
+        """Load a consolidated results file"""
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+    
+    def test_batch_results_consolidated(self):
+        """Test that every line runs and reports into one results file"""
+        job_file = self.write_batch('many.jsonl', [
+            {"command": "echo", "args": [f"line {i}"]} for i in range(5)
+        ])
+        status = self.processor.process_job(job_file)
+        
+        self.assertEqual(status, 'completed')
+        self.assertFalse(job_file.exists())
+        self.assertEqual(sorted(p.name for p in (self.test_base / 'completed').iterdir()),
+                         ['many_results.jsonl'])
+        results = self.read_results(self.test_base / 'completed' / 'many_results.jsonl')
+        self.assertEqual([r['line'] for r in results], [1, 2, 3, 4, 5])
+        self.assertEqual(results[2]['result']['stdout'], 'line 2\n')
+        self.assertEqual(list((self.test_base / 'running').iterdir()), [])
+    
+    def test_failed_lines_reported_per_line(self):
+        """Test that bad lines fail individually without stopping the batch"""
+        job_file = self.write_batch('mixed.jsonl', [
+            {"command": "true"},
+            "not json",
+            {"command": "false"},
+            {"description": "no command"},
+            {"command": "echo", "args": ["still runs"]}
+        ])
+        status = self.processor.process_job(job_file)
+        
+        self.assertEqual(status, 'failed')
+        results = self.read_results(self.test_base / 'failed' / 'mixed_results.jsonl')
+        statuses = [r['result']['status'] for r in results]
+        self.assertEqual(statuses, ['completed', 'failed', 'failed', 'failed', 'completed'])
+        self.assertEqual(results[1]['source_line'], 'not json')
+    
+    def test_resume_from_checkpoint(self):
+        """Test that a restarted batch skips lines already checkpointed"""
+        marker = self.test_base / 'first_ran'
+        job_file = self.write_batch('resume.jsonl', [
+            {"command": "touch", "args": [str(marker)]},
+            {"command": "echo", "args": ["second"]}
+        ])
+        checkpoint = self.test_base / 'running' / 'resume_results.jsonl.part'
+        done = {"command": "touch", "line": 1, "result": {"status": "completed"}}
+        checkpoint.write_text(json.dumps(done) + '\n{"torn": ')
+        
+        self.processor.process_job(job_file)
+        
+        self.assertFalse(marker.exists(), "Checkpointed line should not run again")
+        results = self.read_results(self.test_base / 'completed' / 'resume_results.jsonl')
+        self.assertEqual([r['line'] for r in results], [1, 2])
+        self.assertEqual(results[1]['result']['stdout'], 'second\n')
+    
+    def test_stop_mid_line_reruns_it(self):
+        """Test that a line killed by stop() is not checkpointed, so the resumed batch reruns it"""
+        marker = self.test_base / 'started'
+        job_file = self.test_base / 'running' / 'b.jsonl'
+        job_file.write_text('\n'.join(json.dumps(job) for job in [
+            {"command": "sh", "args": ["-c", f"test -f {marker} && exit 0; touch {marker}; sleep 30"]},
+            {"command": "true"},
+            {"command": "true"}]) + '\n')
+        statuses = []
+        runner = threading.Thread(target=lambda: statuses.append(self.processor.process_job(job_file)))
+        runner.start()
+        self.assertTrue(wait_for(lambda: marker.exists() and 'b.1' in self.processor.active))
+        self.processor.stop()
+        runner.join(10)
+        self.assertEqual(statuses, [None])
+        self.assertEqual((self.test_base / 'running' / 'b_results.jsonl.part').read_text(), '')
+        self.assertEqual(os.listdir(self.test_base / 'failed'), [])
+        
+        self.assertEqual(QueueProcessor().process_job(job_file), 'completed')
+        results = self.read_results(self.test_base / 'completed' / 'b_results.jsonl')
+        self.assertEqual([(r['line'], r['result']['status']) for r in results],
+                         [(1, 'completed'), (2, 'completed'), (3, 'completed')])
+    
+    def test_crashed_batch_drops_checkpoint(self):
+        """Test that a batch that crashes goes to failed/ without leaving its checkpoint behind"""
+        job_file = self.test_base / 'pending' / 'garbled.jsonl'
+        job_file.write_bytes(b'{"command": "true"}\n\xff\xfe\n')
+        self.assertEqual(self.processor.process_job(job_file), 'failed')
+        self.assertTrue((self.test_base / 'failed' / 'garbled.jsonl').exists())
+        self.assertEqual(list((self.test_base / 'running').iterdir()), [])
+    
+    def test_checkpoint_follows_adopted_batch(self):
+        """Test that a batch recovered from a dead node resumes on its own node's running/"""
+        marker = self.test_base / 'first_ran'
+        processor = QueueProcessor(node='b', api=False, archive=False)
+        adopted = self.test_base / 'running' / '.a.adopted-by.b'
+        adopted.mkdir()
+        (adopted / 'resume.jsonl').write_text('\n'.join([
+            json.dumps({"command": "touch", "args": [str(marker)]}),
+            json.dumps({"command": "echo", "args": ["second"]})]) + '\n')
+        done = {"command": "touch", "line": 1, "result": {"status": "completed"}}
+        (adopted / 'resume_results.jsonl.part').write_text(json.dumps(done) + '\n')
+        processor.running_dir.mkdir()
+        processor.recover_dir(adopted)
+        
+        job_file = processor.claim_job('resume.jsonl')
+        self.assertEqual(job_file.parent, self.test_base / 'running' / 'b')
+        self.assertEqual(processor.process_job(job_file), 'completed')
+        self.assertFalse(marker.exists(), "Checkpointed line should not run again")
+        results = self.read_results(self.test_base / 'completed' / 'resume_results.jsonl')
+        self.assertEqual([r['line'] for r in results], [1, 2])
+        self.assertEqual(list((self.test_base / 'running' / 'b').iterdir()), [])
+
+
+
+class TestResultCache(QueueTestCase):
+    """Tests for cacheable job results"""
+    
+    def setUp(self):
+        """Set up a scratch queue and a processor to run jobs on"""
+        super().setUp()
+        self.processor = QueueProcessor()
+        self.clock = "import time; print(time.time_ns())"
+    
+    def test_hit_skips_execution(self):
+        """Test that a repeated cacheable job is answered from the cache"""
+        job = {"command": "python3", "args": ["-c", self.clock], "cacheable": True}
+        first = self.run_job('first.json', job)
+        second = self.run_job('second.json', job)
+        self.assertNotIn('cached', first)
+        self.assertTrue(second['cached'])
+        self.assertEqual(first['stdout'], second['stdout'])
+        self.assertEqual((self.processor.cache.hits, self.processor.cache.misses), (1, 1))
+        with open(self.test_base / 'daemon.log') as f:
+            self.assertIn('Cache hit for second.json (hits=1 misses=1)', f.read())
+    
+    def test_uncacheable_jobs_always_run(self):
+        """Test that jobs without cacheable are never served from the cache"""
+        job = {"command": "python3", "args": ["-c", self.clock]}
+        first = self.run_job('first.json', job)
+        second = self.run_job('second.json', job)
+        self.assertNotEqual(first['stdout'], second['stdout'])
+    
+    def test_input_change_and_ttl_invalidate(self):
+        """Test that changed inputs or an expired ttl force a fresh run"""
+        source = self.test_base / 'input.txt'
+        source.write_text('v1')
+        job = {"command": "python3", "args": ["-c", self.clock], "cacheable": True,
+               "cache_inputs": [str(source)], "cache_hash_inputs": True}
+        first = self.run_job('a.json', job)
+        self.assertTrue(self.run_job('b.json', job)['cached'])
+        source.write_text('v2')
+        changed = self.run_job('c.json', job)
+        self.assertNotIn('cached', changed)
+        self.assertNotEqual(first['stdout'], changed['stdout'])
+        expired = self.run_job('d.json', dict(job, cache_ttl=-1))
+        self.assertNotIn('cached', expired)
+    
+    def test_lru_eviction_by_size(self):
+        """Test that the least recently used entry is evicted over the size cap"""
+        cache = ResultCache(self.test_base / 'lru', max_bytes=250)
+        for key in ['a', 'b']:
+            cache.put(key, {'stdout': key * 50})
+        cache.get('a', 60)
+        cache.put('c', {'stdout': 'c' * 50})
+        self.assertIsNotNone(cache.get('a', 60))
+        self.assertIsNone(cache.get('b', 60))
+        self.assertEqual(sorted(p.stem for p in (self.test_base / 'lru').iterdir()), ['a', 'c'])
+
+
+
+class TestJobIndex(QueueTestCase):
+    """Tests for the SQLite job index"""
+    
+    def test_state_transitions_recorded(self):
+        """Test that a job's lifecycle lands in the index"""
+        self.submit('indexed.json', {"task_id": "task-42", "command": "sleep", "args": ["0.1"]})
+        self.submit('blocked.json', {"command": "true", "depends_on": ["task-42"]})
+        self.run_processor(QueueProcessor())
+        index = JobIndex()
+        self.assertTrue(wait_for(lambda: (index.get('indexed.json') or {}).get('state') == 'running'))
+        self.assertEqual(index.get('blocked.json')['state'], 'waiting')
+        self.assertTrue(wait_for(lambda: index.get('blocked.json')['state'] == 'completed'))
+        
+        record = index.find_task('task-42')
+        self.assertEqual(record['name'], 'indexed.json')
+        self.assertEqual(record['state'], 'completed')
+        self.assertEqual(record['returncode'], 0)
+        self.assertGreaterEqual(record['duration'], 0.1)
+        self.assertEqual(record['result_path'], str(self.test_base / 'completed' / 'indexed.json'))
+        index.close()
+    
+    def test_counts_and_recent_failures(self):
+        """Test indexed counting by state and time window"""
+        processor = QueueProcessor()
+        for i, command in enumerate(['true', 'false', 'false']):
+            processor.process_job(self.submit(f'job_{i}.json', {"command": command}))
+        index = JobIndex()
+        self.assertEqual(index.counts(), {'completed': 1, 'failed': 2})
+        self.assertEqual(index.count(state='failed', since=3600), 2)
+        self.assertEqual(index.count(state='failed', since=-60), 0)
+        index.close()
+    
+    def test_cli_queries(self):
+        """Test the jobs command line interface"""
+        processor = QueueProcessor()
+        processor.process_job(self.submit('cli.json', {"task_id": "from-cli", "command": "false"}))
+        server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+        cli = lambda *args: subprocess.run(
+            [sys.executable, server_py, '--queue', str(self.test_base), 'jobs'] + list(args),
+            capture_output=True, text=True)
+        self.assertEqual(cli('count', '--state', 'failed', '--since', '1h').stdout.strip(), '1')
+        status = json.loads(cli('status', 'from-cli').stdout)
+        self.assertEqual(status['state'], 'failed')
+        self.assertEqual(cli('status', 'nothing').returncode, 1)
+
+
+
+class TestResultArchive(QueueTestCase):
+    """Tests for result retention and archiving"""
+    
+    def finished(self, dir, name, data, age=0):
+        """Write a result file with its mtime pushed age seconds into the past"""
+        path = self.test_base / dir / name
+        path.write_text(json.dumps(data))
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+    
+    def test_age_and_count_limits(self):
+        """Test that only results outside the retention limits are archived"""
+        old = self.finished('completed', 'old.json', {"task_id": "t-old", "status": "completed"}, age=7200)
+        for i in range(4):
+            self.finished('failed', f'f{i}.json', {"status": "failed"}, age=i)
+        archive = ResultArchive(max_age=3600, max_count=2)
+        
+        self.assertEqual(archive.run_once(), 3)
+        self.assertFalse(old.exists())
+        self.assertEqual(sorted(p.name for p in (self.test_base / 'failed').iterdir()),
+                         ['f0.json', 'f1.json'])
+        self.assertEqual(json.loads(archive.fetch(task_id='t-old'))['status'], 'completed')
+        self.assertEqual(json.loads(archive.fetch(name='f3.json')), {"status": "failed"})
+        self.assertEqual(archive.lookup(name='f3.json')['dir'], 'failed')
+        self.assertIsNone(archive.fetch(name='f0.json'))
+        archive.stop()
+    
+    def test_spools_archived_with_their_result(self):
+        """Test that output spools neither count toward the limit nor outlive their result"""
+        for i in range(3):
+            self.finished('completed', f'j{i}.json', {"stdout_file": f"j{i}.json.stdout"}, age=10 - i)
+            self.finished('completed', f'j{i}.json.stdout', {"spool": i}, age=10 - i)
+        self.finished('completed', 't_result.json', {"status": "completed"}, age=20)
+        self.finished('completed', 't.txt.stderr', {"spool": "t"}, age=20)
+        self.finished('completed', 'lost.json.stdout', {"spool": "lost"}, age=7200)
+        archive = ResultArchive(max_age=3600, max_count=2)
+        
+        self.assertEqual(archive.run_once(), 5)
+        self.assertEqual(sorted(p.name for p in (self.test_base / 'completed').iterdir()),
+                         ['j1.json', 'j1.json.stdout', 'j2.json', 'j2.json.stdout'])
+        self.assertEqual(json.loads(archive.fetch(name='j0.json.stdout')), {"spool": 0})
+        self.assertEqual(json.loads(archive.fetch(name='t.txt.stderr')), {"spool": "t"})
+        archive.stop()
+    
+    def test_batch_line_spools_follow_the_batch(self):
+        """Test that a batch line's spools are archived with the batch's results file"""
+        self.finished('failed', 'new.json', {"status": "failed"}, age=1)
+        self.finished('failed', 'b_results.jsonl', {"line": 3}, age=5)
+        self.finished('failed', 'b.3.stdout', {"spool": 3}, age=5)
+        archive = ResultArchive(max_age=3600, max_count=1)
+        
+        self.assertEqual(archive.run_once(), 2)
+        self.assertEqual([p.name for p in (self.test_base / 'failed').iterdir()], ['new.json'])
+        self.assertEqual(json.loads(archive.fetch(name='b.3.stdout')), {"spool": 3})
+        archive.stop()
+    
+    def test_segments_are_plain_gzip(self):
+        """Test that a segment decompresses to the archived files back to back"""
+        self.finished('completed', 'a.json', {"n": 1}, age=100)
+        self.finished('completed', 'a.stdout', {"n": 2}, age=100)
+        archive = ResultArchive(max_age=10)
+        archive.run_once()
+        archive.stop()
+        
+        segments = list((self.test_base / 'archive').glob('segment-*.gz'))
+        self.assertEqual(len(segments), 1)
+        contents = gzip.decompress(segments[0].read_bytes()).decode()
+        self.assertIn('{"n": 1}', contents)
+        self.assertIn('{"n": 2}', contents)
+    
+    def test_archived_dependency_still_satisfied(self):
+        """Test that a job depending on an archived result is released"""
+        self.finished('completed', 'dep.json', {"task_id": "dep", "status": "completed"}, age=100)
+        ResultArchive(max_age=10).run_once()
+        self.submit('child.json', {"command": "true", "depends_on": ["dep"]})
+        self.run_processor(QueueProcessor())
+        self.wait_result('completed', 'child.json')
+    
+    def test_cli_get(self):
+        """Test fetching an archived result from the command line"""
+        self.finished('completed', 'cli.json', {"task_id": "cli-task", "stdout": "hi"}, age=100)
+        server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+        cli = lambda *args: subprocess.run(
+            [sys.executable, server_py, '--queue', str(self.test_base), 'archive'] + list(args),
+            capture_output=True, text=True)
+        self.assertEqual(cli('run', '--max-age', '10s').stdout.strip(), '1')
+        self.assertEqual(json.loads(cli('get', 'cli-task').stdout)['stdout'], 'hi')
+        self.assertEqual(cli('get', 'missing').returncode, 1)
+
+
+class TestMetrics(QueueTestCase):
+    """Tests for per-job timing and the metrics endpoint"""
+    
+    def free_port(self):
+        """A localhost port nothing is listening on"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+    
+    def test_result_timing_and_rusage(self):
+        """Test that the result block carries timestamps, CPU time and peak RSS"""
+        QueueProcessor().process_job(self.submit('busy.json', {
+            "command": sys.executable,
+            "args": ["-c", "x = bytearray(32 * 1024 * 1024); sum(range(2000000))"]}))
+        
+        result = self.result('busy.json')
+        self.assertLessEqual(result['timing']['started_at'], result['timing']['ended_at'])
+        self.assertGreater(result['rusage']['user_cpu'] + result['rusage']['system_cpu'], 0)
+        self.assertGreater(result['rusage']['max_rss_bytes'], 32 * 1024 * 1024)
+    
+    def test_histogram_rendering(self):
+        """Test the Prometheus text format of counters and histograms"""
+        metrics = Metrics()
+        metrics.inc('brain_exec_jobs_total', type='json', status='failed')
+        metrics.observe('brain_exec_run_seconds', 0.2, type='json')
+        metrics.observe('brain_exec_run_seconds', 7, type='json')
+        text = metrics.render()
+        self.assertIn('brain_exec_jobs_total{status="failed",type="json"} 1', text)
+        self.assertIn('brain_exec_run_seconds_bucket{type="json",le="0.25"} 1', text)
+        self.assertIn('brain_exec_run_seconds_bucket{type="json",le="10"} 2', text)
+        self.assertIn('brain_exec_run_seconds_bucket{type="json",le="+Inf"} 2', text)
+        self.assertIn('brain_exec_run_seconds_count{type="json"} 2', text)
+    
+    def test_metrics_endpoint(self):
+        """Test scraping job counts, wait times and timeouts over HTTP"""
+        for i, command in enumerate(['true', 'false']):
+            self.submit(f'job_{i}.json', {"command": command})
+        processor = QueueProcessor(metrics_port=self.free_port())
+        self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: len(os.listdir(self.test_base / 'failed')) == 1 and
+                                 len(os.listdir(self.test_base / 'completed')) == 1))
+        self.assertTrue(wait_for(lambda: processor.metrics_server is not None))
+        url = f"http://127.0.0.1:{processor.metrics_port}/metrics"
+        self.assertTrue(wait_for(lambda: 'status="failed"' in urllib.request.urlopen(url).read().decode()))
+        text = urllib.request.urlopen(url).read().decode()
+        
+        self.assertIn('brain_exec_jobs_total{status="completed",type="json"} 1', text)
+        self.assertIn('brain_exec_jobs_total{status="failed",type="json"} 1', text)
+        self.assertIn('brain_exec_wait_seconds_count{type="json"} 2', text)
+        self.assertIn('brain_exec_queue_depth 0', text)
+
+
+class TestResourceLimits(QueueTestCase):
+    """Tests for per-job resource limits"""
+    
+    def setUp(self):
+        """Set up a scratch queue and a processor to run jobs on"""
+        super().setUp()
+        self.processor = QueueProcessor()
+    
+    def test_cpu_limit(self):
+        """Test that a CPU-bound job is stopped at its CPU limit"""
+        result = self.run_job('spin.json', {"command": sys.executable, "args": ["-c", "while True: pass"],
+                                            "limits": {"cpu_seconds": 1}})
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['limit_hit'], 'cpu_seconds')
+        self.assertLess(result['duration'], 10)
+    
+    def test_memory_limit(self):
+        """Test that an allocation beyond the memory limit is refused and reported"""
+        result = self.run_job('hog.json', {"command": sys.executable,
+                                           "args": ["-c", "x = bytearray(1024 * 1024 * 1024)"],
+                                           "limits": {"memory_bytes": "256M"}})
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['limit_hit'], 'memory_bytes')
+        self.assertEqual(result['limits'], {"memory_bytes": 256 * 1024 * 1024})
+    
+    def test_file_size_limit(self):
+        """Test that writes beyond the file size limit kill the job"""
+        target = self.test_base / 'big.bin'
+        result = self.run_job('dd.json', {"command": "dd",
+                                          "args": ["if=/dev/zero", f"of={target}", "bs=1k", "count=100"],
+                                          "limits": {"file_size_bytes": 4096}})
+        self.assertEqual(result['limit_hit'], 'file_size_bytes')
+        self.assertLessEqual(target.stat().st_size, 4096)
+    
+    def test_within_limits(self):
+        """Test that a well-behaved job completes and reports no limit hit"""
+        result = self.run_job('ok.json', {"command": "true", "limits": {"cpu_seconds": 5, "open_files": 64}})
+        self.assertEqual(result['status'], 'completed')
+        self.assertIsNone(result['limit_hit'])
+    
+    def test_limits_applied_without_preexec(self):
+        """Test that limits reach the command through the wrapper, with no preexec_fn in the server"""
+        with patch('subprocess.Popen', wraps=subprocess.Popen) as popen:
+            result = self.run_job('nofile.json', {"shell": "ulimit -n", "limits": {"open_files": 64}})
+        self.assertEqual(result['stdout'], '64\n')
+        self.assertIsNone(popen.call_args.kwargs.get('preexec_fn'))
+        result = self.run_job('missing.json', {"command": "no-such-command-xyz", "limits": {"open_files": 64}})
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('No such file or directory', result['error'])
+    
+    def test_processes_limit_needs_cgroup(self):
+        """Test that a process limit fails the job rather than falling back to RLIMIT_NPROC"""
+        with patch('server.CGROUP_ROOT', None):
+            result = self.run_job('forks.json', {"command": "true", "limits": {"processes": 4}})
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('processes limit needs a delegated cgroup', result['error'])
+    
+    def test_unknown_limit_rejected(self):
+        """Test that a job asking for an unsupported limit fails without running"""
+        result = self.run_job('bad.json', {"command": "true", "limits": {"gpus": 1}})
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('Unknown limits: gpus', result['error'])
+    
+    def test_text_job_defaults(self):
+        """Test that server-wide limits apply to text jobs"""
+        job_file = self.submit('spin.sh', f"{sys.executable} -c 'while True: pass'")
+        with patch('server.TEXT_JOB_LIMITS', {"cpu_seconds": 1}):
+            self.processor.process_job(job_file)
+        result = self.wait_result('failed', 'spin_result.json')['result']
+        self.assertEqual(result['limit_hit'], 'cpu_seconds')
+
+
+def process_alive(pid):
+    """Whether a pid belongs to a live (non-zombie) process"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/stat'), 'needs /proc to inspect processes')
+class TestTimeouts(QueueTestCase):
+    """Tests for per-job timeouts and process-group kills"""
+    
+    extra_patches = {'server.KILL_GRACE': 0.5}
+    
+    def setUp(self):
+        """Set up a scratch queue and a file for jobs to record their children's pids in"""
+        super().setUp()
+        self.pids = self.test_base / 'pids'
+    
+    def background_pids(self):
+        """Pids the job's shell recorded for its background children"""
+        return [int(pid) for pid in self.pids.read_text().split()]
+    
+    def test_job_timeout_field(self):
+        """Test that a JSON job's timeout kills its grandchildren too"""
+        script = f"sleep 30 & echo $! > {self.pids}; sleep 30 & echo $! >> {self.pids}; wait"
+        job_file = self.submit('slow.json', {"command": "sh", "args": ["-c", script], "timeout": 0.5})
+        start = time.monotonic()
+        QueueProcessor().process_job(job_file)
+        
+        self.assertLess(time.monotonic() - start, 5)
+        result = self.wait_result('failed', 'slow.json')['result']
+        self.assertEqual(result['error'], 'Timeout after 0.5 seconds')
+        self.assertTrue(result['timed_out'])
+        self.assertTrue(wait_for(lambda: not any(process_alive(p) for p in self.background_pids())))
+    
+    def test_sigterm_ignored_then_killed(self):
+        """Test that a group ignoring SIGTERM is killed after the grace period"""
+        job_file = self.submit('stubborn.sh', f"trap '' TERM; sleep 30 & echo $! > {self.pids}; wait; wait")
+        with patch('server.JOB_TIMEOUT', 0.5):
+            start = time.monotonic()
+            QueueProcessor().process_job(job_file)
+            elapsed = time.monotonic() - start
+        
+        self.assertGreaterEqual(elapsed, 1.0)
+        self.assertLess(elapsed, 5)
+        self.assertTrue((self.test_base / 'failed' / 'stubborn_result.json').exists())
+        self.assertTrue(wait_for(lambda: not any(process_alive(p) for p in self.background_pids())))
+    
+    def test_invalid_timeout(self):
+        """Test that a non-positive timeout fails the job"""
+        QueueProcessor().process_job(self.submit('bad.json', {"command": "true", "timeout": 0}))
+        self.assertIn('Invalid timeout', self.wait_result('failed', 'bad.json')['result']['error'])
+    
+    def test_no_orphans_after_shutdown(self):
+        """Test that stop() takes down a text job's background children"""
+        self.submit('tree.sh', f"trap '' TERM; sleep 30 & echo $! > {self.pids}; wait; wait")
+        processor = QueueProcessor()
+        thread = self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: self.pids.exists() and self.pids.read_text().strip()))
+        pids = self.background_pids()
+        processor.stop()
+        thread.join(5)
+        
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(wait_for(lambda: not any(process_alive(p) for p in pids)))
+
+
+class TestWarmPython(QueueTestCase):
+    """Tests for the python-warm runner"""
+    
+    def setUp(self):
+        """Set up a scratch queue and a processor whose warm pool is closed after the test"""
+        super().setUp()
+        self.processor = QueueProcessor()
+        self.addCleanup(self.processor.warm.close)
+    
+    def run_job(self, name, job_data):
+        """Process a python-warm job and return its result block"""
+        return super().run_job(name, dict(job_data, runner='python-warm'))
+    
+    def python(self, code):
+        """A python3 -c job"""
+        return {"command": "python3", "args": ["-c", code]}
+    
+    def test_output_and_reuse(self):
+        """Test that jobs capture output and share one warm interpreter"""
+        first = self.run_job('a.json', self.python("import os, sys; print('out', os.getpid()); print('err', file=sys.stderr)"))
+        second = self.run_job('b.json', self.python("import os; print('out', os.getpid())"))
+        
+        self.assertEqual(first['status'], 'completed')
+        self.assertEqual(first['runner'], 'python-warm')
+        self.assertEqual(first['stderr'], 'err\n')
+        self.assertEqual(first['stdout'], second['stdout'])
+        self.assertEqual(self.processor.warm.started, 1)
+    
+    def test_fresh_main_per_job(self):
+        """Test that globals and argv do not leak between jobs"""
+        self.run_job('set.json', {"command": "python3", "args": ["-c", "leak = 1; import os; os.chdir('/')", "x"]})
+        result = self.run_job('check.json', self.python(
+            "import os, sys; print('leak' in globals(), sys.argv, os.getcwd() == '/')"))
+        self.assertEqual(result['stdout'], "False ['-c'] False\n")
+    
+    def test_exit_codes(self):
+        """Test sys.exit, uncaught exceptions and os._exit"""
+        self.assertEqual(self.run_job('exit.json', self.python("import sys; sys.exit(3)"))['returncode'], 3)
+        crashed = self.run_job('raise.json', self.python("raise RuntimeError('boom')"))
+        self.assertEqual(crashed['returncode'], 1)
+        self.assertIn('RuntimeError: boom', crashed['stderr'])
+        self.assertEqual(self.run_job('hard.json', self.python("import os; os._exit(4)"))['returncode'], 4)
+        self.assertEqual(self.run_job('after.json', self.python("print('ok')"))['stdout'], 'ok\n')
+    
+    def test_script_path(self):
+        """Test running a script file with arguments"""
+        script = self.test_base / 'script.py'
+        script.write_text("import sys\nprint(sys.argv[1:], __name__)\n")
+        result = self.run_job('script.json', {"command": "python3", "args": [str(script), "one"]})
+        self.assertEqual(result['stdout'], "['one'] __main__\n")
+    
+    def test_recycle_after_max_jobs(self):
+        """Test that a worker is replaced after WARM_MAX_JOBS jobs"""
+        with patch('server.WARM_MAX_JOBS', 2):
+            pids = [self.run_job(f'p{i}.json', self.python("import os; print(os.getpid())"))['stdout']
+                    for i in range(3)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+    
+    def test_prefork_and_background_replacement(self):
+        """Test that a started pool is warm before any job and refills itself after a recycle"""
+        pool = WarmPool(size=2)
+        self.addCleanup(pool.close)
+        pool.start()
+        self.assertEqual((len(pool.idle), pool.started), (2, 2))
+        captures = {stream: self.test_base / f'job.{stream}' for stream in ('stdout', 'stderr')}
+        with patch('server.WARM_MAX_JOBS', 1):
+            worker = pool.acquire()
+            self.assertEqual(pool.started, 2, "The job should get a pre-forked worker")
+            self.assertTrue(worker.send(['-c', 'pass'], captures))
+            reply = None
+            while reply is None:
+                reply = worker.feed()
+            self.assertEqual(reply['returncode'], 0)
+            pool.release(worker)
+            self.assertTrue(wait_for(lambda: len(pool.idle) == 2 and pool.started == 3))
+        self.assertNotIn(worker, pool.idle)
+    
+    def test_output_capped_and_streamed(self):
+        """Test that warm output is capped as it is written and feeds the progress record"""
+        captures = self.test_base / 'running' / 'big.json.warm.stdout'
+        code = ("import sys, time; print('##progress 1/4 warming', flush=True); time.sleep(0.5); "
+                "sys.stdout.write('x' * 5000000)")
+        seen = []
+        with patch('server.OUTPUT_MAX_BYTES', 1000), patch('server.PROGRESS_INTERVAL', 0.1):
+            runner = threading.Thread(target=lambda: seen.append(self.run_job('big.json', self.python(code))))
+            runner.start()
+            record = self.test_base / 'running' / 'big.json.progress'
+            self.assertTrue(wait_for(lambda: record.exists() and 'progress' in json.loads(record.read_text())))
+            self.assertTrue(captures.is_fifo())
+            runner.join(10)
+        result, = seen
+        self.assertEqual(result['stdout_bytes'], 5000000 + len('##progress 1/4 warming\n'))
+        self.assertTrue(result['stdout_truncated'])
+        self.assertLess(Path(result['stdout_file']).stat().st_size, 2000)
+        self.assertEqual(result['progress']['done'], 1)
+        self.assertFalse(captures.exists())
+    
+    def test_timeout_replaces_worker(self):
+        """Test that a timed-out job's worker is killed and the pool recovers"""
+        result = self.run_job('spin.json', dict(self.python("while True: pass"), timeout=0.5))
+        self.assertTrue(result['timed_out'])
+        self.assertEqual(self.run_job('next.json', self.python("print(2)"))['stdout'], '2\n')
+    
+    def test_rejects_non_python(self):
+        """Test that python-warm refuses to run other programs"""
+        result = self.run_job('echo.json', {"command": "echo", "args": ["hi"]})
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('must run python', result['error'])
+
+
+class TestAsyncEngine(QueueTestCase):
+    """Tests for the asyncio execution engine"""
+    
+    extra_patches = {'server.KILL_GRACE': 0.5}
+    
+    def test_concurrent_jobs(self):
+        """Test that many sleep-bound jobs overlap on one event loop"""
+        for i in range(20):
+            self.submit(f'sleep_{i:02d}.json', {"command": "sleep", "args": ["0.5"]})
+        start = time.monotonic()
+        self.run_processor(AsyncQueueProcessor(workers=20))
+        self.assertTrue(wait_for(lambda: len(os.listdir(self.test_base / 'completed')) == 20, 10))
+        self.assertLess(time.monotonic() - start, 4)
+    
+    def test_same_result_files_as_threads(self):
+        """Test that both engines write the same result files and fields"""
+        layouts = {}
+        for engine in (QueueProcessor, AsyncQueueProcessor):
+            for dir in ['completed', 'failed']:
+                for path in (self.test_base / dir).iterdir():
+                    path.unlink()
+            self.submit('echo.json', {"command": "echo", "args": ["hi"], "task_id": "echo"})
+            self.submit('bad.json', {"command": "false", "depends_on": ["echo"]})
+            self.submit('shell.txt', 'echo out; echo err >&2')
+            self.submit('lines.jsonl', json.dumps({"command": "true"}) + '\n')
+            processor = engine()
+            thread = self.run_processor(processor)
+            self.assertTrue(wait_for(lambda: len(os.listdir(self.test_base / 'completed')) == 3 and
+                                     len(os.listdir(self.test_base / 'failed')) == 1))
+            processor.stop()
+            thread.join(5)
+            layouts[engine.engine] = {
+                (dir, path.name): sorted(json.load(open(path))['result'])
+                for dir in ['completed', 'failed'] for path in (self.test_base / dir).iterdir()
+                if path.suffix == '.json'
+            }
+            self.assertEqual(self.result('shell_result.json')['stderr'], 'err\n')
+        
+        self.assertEqual(layouts['threads'], layouts['asyncio'])
+    
+    def test_rusage_and_cpu_limit(self):
+        """Test that asyncio results carry wait4 usage, so CPU limits are detected as with threads"""
+        self.submit('spin.json', {"command": sys.executable, "args": ["-c", "while True: pass"],
+                                  "limits": {"cpu_seconds": 1}})
+        self.run_processor(AsyncQueueProcessor())
+        result = self.wait_result('failed', 'spin.json', 10)['result']
+        self.assertEqual(result['limit_hit'], 'cpu_seconds')
+        self.assertGreaterEqual(result['rusage']['user_cpu'] + result['rusage']['system_cpu'], 0.9)
+    
+    def test_blocking_work_off_the_loop(self):
+        """Test that job files, the index and result writes are handled on helper threads"""
+        processor = AsyncQueueProcessor()
+        calls = []
+        
+        def on_loop():
+            try:
+                return asyncio.get_running_loop() is not None
+            except RuntimeError:
+                return False
+        for method in ('apply_events', 'take_job', 'json_job_done', 'job_processed'):
+            def traced(*args, _method=method, _original=getattr(processor, method), **kwargs):
+                calls.append((_method, on_loop()))
+                return _original(*args, **kwargs)
+            setattr(processor, method, traced)
+        self.run_processor(processor)
+        self.submit('echo.json', {"command": "echo", "args": ["hi"]})
+        self.wait_result('completed', 'echo.json')
+        self.assertTrue(wait_for(lambda: ('job_processed', False) in calls))
+        self.assertIn(('apply_events', False), calls)
+        self.assertEqual([call for call in calls if call[1]], [])
+    
+    def test_timeout_kills_group(self):
+        """Test that a timeout takes down the job's background children"""
+        pids = self.test_base / 'pids'
+        self.submit('slow.json', {"command": "sh", "timeout": 0.5,
+                                  "args": ["-c", f"trap '' TERM; sleep 30 & echo $! > {pids}; wait; wait"]})
+        self.run_processor(AsyncQueueProcessor())
+        self.assertTrue(self.wait_result('failed', 'slow.json')['result']['timed_out'])
+        pid = int(pids.read_text())
+        if os.path.exists('/proc/self/stat'):
+            self.assertTrue(wait_for(lambda: not process_alive(pid)))
+    
+    def test_stop_terminates_children(self):
+        """Test that stop() ends running jobs and the event loop"""
+        self.submit('long.json', {"command": "sleep", "args": ["30"]})
+        processor = AsyncQueueProcessor()
+        thread = self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: processor.active))
+        processor.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.result('long.json')['returncode'], -signal.SIGTERM)
+
+class TestApi(QueueTestCase):
+    """Tests for the Unix socket job API"""
+    
+    def start(self, engine=QueueProcessor):
+        """Run a processor with its API on a background thread until the test stops it"""
+        processor = engine(api=True)
+        self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: processor.api_server is not None))
+        return processor
+    
+    def call(self, **request):
+        """Send a request and collect every reply"""
+        return list(api_call(request, self.test_base / 'exec.sock'))
+    
+    def test_submit_writes_job_file(self):
+        """Test that a submitted job runs from pending/ and leaves the usual result file"""
+        self.start()
+        replies = self.call(op='submit', job={"command": "echo", "args": ["hi"]})
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(replies[0]['event'], 'accepted')
+        self.assertEqual(self.wait_result('completed', replies[0]['id'])['result']['stdout'], 'hi\n')
+    
+    def test_submit_and_wait(self):
+        """Test that wait blocks until the job's result is written"""
+        self.start()
+        accepted, result = self.call(op='submit', name='greet', wait=True,
+                                     job={"command": "sh", "args": ["-c", "sleep 0.2; echo hi"]})
+        self.assertEqual(accepted['id'], 'greet.json')
+        self.assertEqual(result['event'], 'result')
+        self.assertEqual(result['status'], 'completed')
+        self.assertEqual(result['result']['stdout'], 'hi\n')
+        self.assertEqual(result['result_file'], str(self.test_base / 'completed' / 'greet.json'))
+        self.assertTrue((self.test_base / 'completed' / 'greet.json').exists())
+    
+    def test_stream_output(self):
+        """Test that stream delivers output chunks before the result, on both engines"""
+        for engine in (QueueProcessor, AsyncQueueProcessor):
+            processor = self.start(engine)
+            replies = self.call(op='submit', name=f'talk_{engine.engine}', stream=True,
+                                job={"command": "sh", "args": ["-c", "echo one; sleep 0.2; echo two >&2; exit 3"]})
+            processor.stop()
+            self.assertTrue(wait_for(lambda: not (self.test_base / 'exec.sock').exists()))
+            events = [reply['event'] for reply in replies]
+            self.assertEqual(events[0], 'accepted')
+            self.assertEqual(events[-1], 'result')
+            self.assertEqual(set(events[1:-1]), {'output'})
+            output = {stream: ''.join(r['data'] for r in replies if r.get('stream') == stream)
+                      for stream in ('stdout', 'stderr')}
+            self.assertEqual(output, {'stdout': 'one\n', 'stderr': 'two\n'})
+            self.assertEqual(replies[-1]['status'], 'failed')
+            self.assertEqual(replies[-1]['result']['returncode'], 3)
+    
+    def test_wait_for_existing_job(self):
+        """Test waiting on a job submitted as a file, both before and after it finishes"""
+        self.submit('nap.json', {"command": "sleep", "args": ["0.3"]})
+        self.start()
+        self.assertEqual(self.call(op='wait', id='nap')[-1]['status'], 'completed')
+        # Already finished: answered from the job index
+        replies = self.call(op='wait', id='nap.json')
+        self.assertEqual([r['event'] for r in replies], ['result'])
+        self.assertEqual(replies[0]['result']['returncode'], 0)
+    
+    def test_wait_errors(self):
+        """Test wait timeouts and unknown job ids"""
+        self.start()
+        self.assertEqual(self.call(op='wait', id='missing')[0]['event'], 'unknown')
+        self.call(op='submit', name='slow', job={"command": "sleep", "args": ["5"]})
+        reply = self.call(op='wait', id='slow', timeout=0.2)[0]
+        self.assertFalse(reply['ok'])
+        self.assertEqual(reply['event'], 'timeout')
+    
+    def test_invalid_requests(self):
+        """Test that bad requests get an error reply instead of a job"""
+        self.start()
+        for request in [{'op': 'submit', 'job': {"args": ["x"]}},
+                        {'op': 'submit', 'job': ["echo"]},
+                        {'op': 'submit', 'name': '../escape', 'job': {"command": "true"}},
+                        {'op': 'frobnicate'},
+                        {'op': 'wait'}]:
+            replies = self.call(**request)
+            self.assertEqual(len(replies), 1, request)
+            self.assertFalse(replies[0]['ok'], request)
+        self.assertEqual(os.listdir(self.test_base / 'pending'), [])
+        
+        self.call(op='submit', name='twice', job={"command": "sleep", "args": ["5"]})
+        self.assertFalse(self.call(op='submit', name='twice', job={"command": "true"})[0]['ok'])
+    
+    def test_submit_needs_json_name(self):
+        """Test that an id with a text or batch suffix is refused rather than run as that type"""
+        self.start()
+        for name in ['evil.txt', 'evil.sh', 'evil.jsonl']:
+            reply, = self.call(op='submit', name=name, job={"command": "echo", "args": ["hi"]})
+            self.assertFalse(reply['ok'], name)
+            self.assertIn('*.json', reply['error'])
+        self.assertEqual(self.call(op='submit', name='fine', job={"command": "true"})[0]['id'], 'fine.json')
+        self.wait_result('completed', 'fine.json')
+        self.assertEqual(os.listdir(self.test_base / 'failed'), [])
+    
+    def test_stop_releases_waiters(self):
+        """Test that waiting clients are told when the server stops"""
+        processor = self.start()
+        self.call(op='submit', name='long', job={"command": "sleep", "args": ["5"]})
+        replies = []
+        waiter = threading.Thread(target=lambda: replies.extend(self.call(op='wait', id='long')))
+        waiter.start()
+        self.assertTrue(wait_for(lambda: 'long.json' in processor.events.subscribers))
+        processor.stop()
+        waiter.join(5)
+        self.assertIn(replies[-1]['event'], ('closed', 'result'))
+        self.assertTrue(wait_for(lambda: not (self.test_base / 'exec.sock').exists()))
+
+class TestCrashRecovery(QueueTestCase):
+    """Tests for atomic result writes and recovery of interrupted jobs"""
+    
+    def setUp(self):
+        """Set up a scratch queue and a processor to recover jobs with"""
+        super().setUp()
+        self.processor = QueueProcessor(api=False)
+        self.addCleanup(self.processor.index.close)
+    
+    def orphan(self, name, job_data):
+        """Leave a job in running/ as a dead server would"""
+        with open(self.test_base / 'running' / name, 'w') as f:
+            json.dump(job_data, f)
+    
+    def test_write_atomic_keeps_old_file_on_failure(self):
+        """Test that a failed write leaves neither a partial file nor a temp file"""
+        path = self.test_base / 'completed' / 'job.json'
+        write_atomic(path, '{"old": true}')
+        with patch('server.os.replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                write_atomic(path, '{"new": true}')
+        self.assertEqual(path.read_text(), '{"old": true}')
+        self.assertEqual(os.listdir(path.parent), ['job.json'])
+    
+    def test_temp_files_in_pending_ignored(self):
+        """Test that submitters' temp files are never claimed as jobs"""
+        pending = self.test_base / 'pending'
+        (pending / '.job.json.tmp').write_text('{"command": "tr')
+        (pending / 'job.json.tmp').write_text('{"command": "tr')
+        self.submit('real.json', {"command": "true"})
+        self.run_processor(QueueProcessor(api=False))
+        self.wait_result('completed', 'real.json')
+        self.assertEqual(sorted(os.listdir(pending)), ['.job.json.tmp', 'job.json.tmp'])
+        self.assertEqual(os.listdir(self.test_base / 'failed'), [])
+    
+    def test_interrupted_job_requeued_then_failed(self):
+        """Test that the default policy requeues an interrupted job once"""
+        self.orphan('flaky.json', {"command": "true"})
+        self.processor.recover_orphans()
+        self.assertTrue((self.test_base / 'pending' / 'flaky.json').exists())
+        
+        # Interrupted again after being requeued
+        os.rename(self.test_base / 'pending' / 'flaky.json', self.test_base / 'running' / 'flaky.json')
+        self.processor.recover_orphans()
+        result = self.result('flaky.json')
+        self.assertIn('Interrupted by a server restart 2 time(s)', result['error'])
+        self.assertEqual(self.processor.index.get('flaky.json')['state'], 'failed')
+    
+    def test_retry_policy(self):
+        """Test that a job's retry field overrides the default policy"""
+        self.orphan('once.json', {"command": "true", "retry": False})
+        self.orphan('always.json', {"command": "true", "retry": True})
+        (self.test_base / 'running' / 'shell.txt').write_text('true')
+        for _ in range(3):
+            self.processor.recover_orphans()
+            os.rename(self.test_base / 'pending' / 'always.json', self.test_base / 'running' / 'always.json')
+        self.assertTrue((self.test_base / 'failed' / 'once.json').exists())
+        self.assertTrue((self.test_base / 'running' / 'always.json').exists())
+        # Text jobs have no fields and get the default policy
+        self.assertTrue((self.test_base / 'pending' / 'shell.txt').exists())
+    
+    def test_finished_job_not_rerun(self):
+        """Test that a job whose result was written before the crash is not run again"""
+        self.orphan('done.json', {"command": "true"})
+        write_atomic(self.test_base / 'completed' / 'done.json', '{"result": {"status": "completed"}}')
+        (self.test_base / 'completed' / '.done.json.1234abcd.tmp').write_text('{"res')
+        (self.test_base / 'running' / 'done.json.stdout').write_text('partial')
+        self.processor.recover_orphans()
+        self.assertEqual(os.listdir(self.test_base / 'running'), [])
+        self.assertEqual(os.listdir(self.test_base / 'pending'), [])
+        self.assertEqual(os.listdir(self.test_base / 'completed'), ['done.json'])
+        self.assertEqual(self.processor.index.get('done.json')['state'], 'completed')
+
+class TestRetries(QueueTestCase):
+    """Tests for automatic retries with backoff"""
+    
+    def start(self, engine=QueueProcessor, workers=1):
+        """Run a processor without its API on a background thread until the test stops it"""
+        processor = engine(workers=workers, api=False)
+        self.run_processor(processor)
+        return processor
+    
+    def test_retry_until_success(self):
+        """Test that a job failing once succeeds on its retry, with both attempts recorded"""
+        for engine in (QueueProcessor, AsyncQueueProcessor):
+            marker = self.test_base / f'marker_{engine.engine}'
+            self.submit(f'flaky_{engine.engine}.json', {
+                "command": "sh", "args": ["-c", f"test -f {marker} || {{ touch {marker}; exit 3; }}"],
+                "retries": 2, "backoff": 0.1})
+            processor = self.start(engine)
+            data = self.wait_result('completed', f'flaky_{engine.engine}.json')
+            processor.stop()
+            attempts = data['result']['attempts']
+            self.assertEqual([a['returncode'] for a in attempts], [3, 0])
+            self.assertEqual([a['attempt'] for a in attempts], [1, 2])
+            self.assertNotIn('attempts', data)
+            self.assertNotIn('retry_at', data)
+    
+    def test_retries_exhausted(self):
+        """Test that a job that keeps failing ends in failed/ after its last retry"""
+        self.submit('broken.json', {"command": "false", "retries": 2, "backoff": 0.05})
+        start = time.time()
+        self.start()
+        result = self.wait_result('failed', 'broken.json')['result']
+        # Backoff doubles: 0.05s, then 0.1s
+        self.assertGreaterEqual(time.time() - start, 0.15)
+        self.assertEqual(len(result['attempts']), 3)
+        self.assertEqual(result['status'], 'failed')
+    
+    def test_retry_on(self):
+        """Test that only the listed return codes and timeouts are retried"""
+        self.submit('other.json', {"command": "sh", "args": ["-c", "exit 1"],
+                                   "retries": 3, "retry_on": [2]})
+        self.submit('slow.json', {"command": "sleep", "args": ["5"], "timeout": 0.2,
+                                  "retries": 1, "backoff": 0, "retry_on": ["timeout"]})
+        self.submit('missing.json', {"command": "/nonexistent/tool", "retries": 1, "backoff": 0,
+                                     "retry_on": ["error"]})
+        self.start(workers=3)
+        self.assertNotIn('attempts', self.wait_result('failed', 'other.json')['result'])
+        attempts = self.wait_result('failed', 'slow.json')['result']['attempts']
+        self.assertEqual([a.get('timed_out') for a in attempts], [True, True])
+        attempts = self.wait_result('failed', 'missing.json')['result']['attempts']
+        self.assertEqual(len(attempts), 2)
+        self.assertIn('error', attempts[0])
+    
+    def test_backoff_does_not_block_workers(self):
+        """Test that a job backing off leaves its worker free for other jobs"""
+        self.submit('a_flaky.json', {"command": "false", "retries": 1, "backoff": 2, "priority": "high"})
+        processor = self.start(workers=1)
+        self.assertTrue(wait_for(lambda: len(processor.delayed) == 1))
+        self.submit('b_quick.json', {"command": "true"})
+        self.wait_result('completed', 'b_quick.json', timeout=1)
+        self.assertFalse((self.test_base / 'failed' / 'a_flaky.json').exists())
+        self.assertEqual(processor.index.get('a_flaky.json')['state'], 'delayed')
+        self.wait_result('failed', 'a_flaky.json')
+    
+    def test_retry_at_honoured_after_restart(self):
+        """Test that a pending job written back for a retry waits until its retry time"""
+        self.submit('later.json', {"command": "true", "retry_at": time.time() + 0.3,
+                                   "attempts": [{"attempt": 1, "status": "failed"}]})
+        processor = QueueProcessor(api=False)
+        self.addCleanup(processor.index.close)
+        processor.apply_events([('added', self.test_base / 'pending' / 'later.json')])
+        self.assertIsNone(processor.take_job())
+        self.assertTrue(wait_for(lambda: processor.take_job() is not None, 2))
+    
+    def test_retry_delay(self):
+        """Test that backoff doubles per attempt up to the cap"""
+        with patch('server.RETRY_MAX_BACKOFF', 10):
+            self.assertEqual([retry_delay({"backoff": 1.5}, n) for n in range(1, 5)], [1.5, 3, 6, 10])
+            self.assertEqual(retry_delay({"backoff": "soon"}, 1), server.RETRY_BACKOFF)
+
+class TestSchedules(QueueTestCase):
+    """Tests for cron and interval schedules"""
+    
+    def setUp(self):
+        """Set up a scratch queue with a schedules/ directory"""
+        super().setUp()
+        (self.test_base / 'schedules').mkdir()
+    
+    def schedule(self, name, spec):
+        """Write a schedule file"""
+        with open(self.test_base / 'schedules' / f'{name}.json', 'w') as f:
+            json.dump(spec, f)
+    
+    def start(self, workers=2):
+        """Run a processor on a background thread until the test stops it"""
+        processor = QueueProcessor(workers=workers, api=False)
+        self.run_processor(processor)
+        return processor
+    
+    def runs(self, name):
+        """Result files written by a schedule's runs"""
+        return sorted(p.name for p in (self.test_base / 'completed').glob(f'{name}_*.json'))
+    
+    def test_cron_next(self):
+        """Test cron matching, including ranges, steps, names and the day OR rule"""
+        def after(expr, *start):
+            return datetime.fromtimestamp(cron_next(parse_cron(expr), datetime(*start).timestamp()))
+        self.assertEqual(after('*/15 * * * *', 2026, 10, 17, 10, 7), datetime(2026, 10, 17, 10, 15))
+        self.assertEqual(after('0 9 * * mon-fri', 2026, 10, 17, 10, 7), datetime(2026, 10, 19, 9, 0))
+        self.assertEqual(after('@daily', 2026, 12, 31, 23, 59), datetime(2027, 1, 1, 0, 0))
+        # Friday the 23rd comes before the 13th of next month
+        self.assertEqual(after('0 0 13 * 5', 2026, 10, 17), datetime(2026, 10, 23, 0, 0))
+        for bad in ['61 * * * *', '* * *', 'x * * * *', '5-1 * * * *', '*/0 * * * *']:
+            with self.assertRaises(ValueError, msg=bad):
+                parse_cron(bad)
+        with self.assertRaises(ValueError):
+            cron_next(parse_cron('0 0 31 2 *'), time.time())
+    
+    def test_interval_runs_in_memory(self):
+        """Test that an interval schedule runs repeatedly without job files in pending/"""
+        self.schedule('tick', {"every": 0.2, "command": "echo", "args": ["tick"]})
+        processor = self.start()
+        self.assertTrue(wait_for(lambda: len(self.runs('tick')) >= 3))
+        processor.stop()
+        data = self.wait_result('completed', self.runs('tick')[0])
+        self.assertEqual(data['result']['stdout'], 'tick\n')
+        self.assertNotIn('every', data)
+        self.assertEqual(processor.index.get(self.runs('tick')[0])['state'], 'completed')
+    
+    def test_overlapping_runs_skipped(self):
+        """Test that a run is skipped while the previous run of its schedule is still going"""
+        self.schedule('slow', {"every": 0.1, "command": "sleep", "args": ["0.5"]})
+        processor = self.start(workers=4)
+        time.sleep(1.3)
+        processor.stop()
+        self.assertTrue(wait_for(lambda: not processor.active))
+        finished = len(self.runs('slow')) + len(list((self.test_base / 'failed').glob('slow_*.json')))
+        self.assertIn(finished, (2, 3))
+    
+    def test_state_persisted(self):
+        """Test that the last run survives a restart and missed runs catch up once"""
+        self.schedule('daily', {"schedule": "@daily", "command": "true"})
+        self.schedule('hourly', {"schedule": "@hourly", "catch_up": False, "command": "true"})
+        day_ago = time.time() - 86400 - 60
+        (self.test_base / 'schedule_state.json').write_text(json.dumps(
+            {'daily': {'last_run': day_ago}, 'hourly': {'last_run': day_ago}}))
+        scheduler = Scheduler()
+        scheduler.load()
+        now = time.time()
+        runs = scheduler.due(now)
+        self.assertEqual([name for name, _, _ in runs], ['daily'])
+        self.assertEqual(runs[0][1], {"command": "true"})
+        self.assertGreater(scheduler.next_due(), now)
+        
+        state = json.loads((self.test_base / 'schedule_state.json').read_text())
+        self.assertGreater(state['daily']['last_run'], day_ago)
+        restarted = Scheduler()
+        restarted.load()
+        self.assertEqual(restarted.due(now), [])
+    
+    def test_retry_stays_in_memory(self):
+        """Test that a failed scheduled run retries from the scheduler without touching pending/"""
+        marker = self.test_base / 'marker'
+        self.schedule('flaky', {"every": 3600, "command": "sh", "retries": 2, "backoff": 0.3,
+                                "args": ["-c", f"test -f {marker} || {{ touch {marker}; exit 3; }}"]})
+        processor = self.start()
+        seen = set()
+        
+        def done():
+            seen.update(p.name for d in ('pending', 'running') for p in (self.test_base / d).rglob('flaky_*'))
+            return len(self.runs('flaky')) == 1
+        self.assertTrue(wait_for(done))
+        self.assertEqual(seen, set())
+        run = self.runs('flaky')[0]
+        data = self.wait_result('completed', run)
+        self.assertEqual([a['returncode'] for a in data['result']['attempts']], [3, 0])
+        self.assertTrue(wait_for(lambda: processor.index.get(run)['state'] == 'completed'))
+        self.assertTrue(wait_for(lambda: not processor.scheduler.runs))
+    
+    def test_retry_holds_overlap_guard(self):
+        """Test that later ticks are skipped while a failed run waits to retry"""
+        marker = self.test_base / 'marker'
+        self.schedule('flaky', {"every": 0.2, "command": "sh", "retries": 1, "backoff": 0.8,
+                                "args": ["-c", f"test -f {marker} || {{ touch {marker}; exit 3; }}"]})
+        processor = self.start()
+        self.assertTrue(wait_for(lambda: self.runs('flaky')))
+        first = self.runs('flaky')
+        processor.stop()
+        self.assertEqual(len(first), 1)
+        attempts = self.wait_result('completed', first[0])['result']['attempts']
+        self.assertEqual([a['returncode'] for a in attempts], [3, 0])
+    
+    def test_schedules_reloaded(self):
+        """Test that schedule files added while running are picked up, and bad ones ignored"""
+        self.schedule('broken', {"every": 1})
+        processor = self.start()
+        self.assertTrue(wait_for(lambda: processor.watcher is not None))
+        self.schedule('late', {"every": 10, "command": "true"})
+        self.assertTrue(wait_for(lambda: len(self.runs('late')) == 1, 5))
+        self.assertEqual(sorted(processor.scheduler.schedules), ['late'])
+
+class TestResultStore(QueueTestCase):
+    """Tests for the file and segmented log result stores"""
+    
+    def store(self, **kwargs):
+        """A log store closed at the end of the test"""
+        store = LogResultStore(**kwargs)
+        self.addCleanup(store.close)
+        return store
+    
+    def record(self, n, status='completed'):
+        """A finished job's result document"""
+        return {'command': 'echo', 'args': [str(n)], 'result': {'status': status, 'stdout': f'{n}\n'}}
+    
+    def test_round_trip_and_view(self):
+        """Test that results read back intact, the view without copying the mapping"""
+        store = self.store()
+        path = self.test_base / 'completed' / 'job.json'
+        store.write(path, self.record(1))
+        store.write(self.test_base / 'failed' / 'job.json', self.record(2, 'failed'))
+        self.assertEqual(json.loads(store.read(path)), self.record(1))
+        self.assertEqual(json.loads(store.read(self.test_base / 'failed' / 'job.json'))['result']['status'],
+                         'failed')
+        with store.view(path) as view:
+            self.assertTrue(view.readonly)
+            self.assertEqual(json.loads(view.tobytes()), self.record(1))
+        self.assertIsNone(store.read(self.test_base / 'completed' / 'other.json'))
+        self.assertFalse(path.exists())
+        
+        # A rewrite under the same name supersedes the old record
+        store.write(path, self.record(3))
+        self.assertEqual(json.loads(store.read(path)), self.record(3))
+    
+    def test_segments_roll(self):
+        """Test that appends move to a new segment once the current one is full"""
+        store = self.store(segment_bytes=512)
+        for n in range(20):
+            store.write(self.test_base / 'completed' / f'job{n}.json', self.record(n))
+        segments = sorted((self.test_base / 'results').glob('segment-*.log'))
+        self.assertGreater(len(segments), 1)
+        for segment in segments:
+            self.assertLessEqual(segment.stat().st_size, 512)
+        for n in range(20):
+            self.assertEqual(json.loads(store.read(self.test_base / 'completed' / f'job{n}.json')),
+                             self.record(n))
+    
+    def test_recovers_unindexed_and_torn_records(self):
+        """Test that records missing from the index are found and a partial record is cut off"""
+        store = LogResultStore()
+        store.write(self.test_base / 'completed' / 'a.json', self.record(1))
+        store.write(self.test_base / 'completed' / 'b.json', self.record(2))
+        # Crash after b's append but before its index insert, in the middle of c's append
+        store.conn.execute("DELETE FROM results WHERE name = 'b.json'")
+        store.conn.commit()
+        store.close()
+        segment = self.test_base / 'results' / 'segment-000001.log'
+        intact = segment.stat().st_size
+        with open(segment, 'ab') as f:
+            f.write(LogResultStore.HEADER.pack(LogResultStore.MAGIC, 18, 500) + b'completed/c.json{"')
+        
+        reader = self.store()
+        self.assertIsNone(reader.read(self.test_base / 'completed' / 'b.json'))
+        self.assertEqual(segment.stat().st_size, intact + 28)
+        
+        store = self.store()
+        store.recover()
+        self.assertEqual(segment.stat().st_size, intact)
+        self.assertEqual(json.loads(store.read(self.test_base / 'completed' / 'b.json')), self.record(2))
+        self.assertIsNone(store.read(self.test_base / 'completed' / 'c.json'))
+        store.write(self.test_base / 'completed' / 'c.json', self.record(3))
+        self.assertEqual(json.loads(store.read(self.test_base / 'completed' / 'c.json')), self.record(3))
+    
+    def test_materialize_matches_file_store(self):
+        """Test that a materialised result is byte-for-byte the file the files store writes"""
+        store = self.store()
+        path = self.test_base / 'completed' / 'job.json'
+        store.write(path, self.record(1))
+        self.assertEqual(store.materialize(path), path)
+        materialized = path.read_bytes()
+        path.unlink()
+        FileResultStore().write(path, self.record(1))
+        self.assertEqual(materialized, path.read_bytes())
+        self.assertIsNone(store.materialize(self.test_base / 'completed' / 'missing.json'))
+    
+    def test_processor_with_log_store(self):
+        """Test that jobs finish into the log, visible to the API, dependencies and recovery"""
+        processor = QueueProcessor(api=True, results='log')
+        self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: processor.api_server is not None))
+        
+        replies = list(api_call({'op': 'submit', 'name': 'first', 'wait': True,
+                                 'job': {'command': 'echo', 'args': ['logged']}},
+                                self.test_base / 'exec.sock'))
+        self.assertEqual(replies[-1]['result']['stdout'], 'logged\n')
+        replies = list(api_call({'op': 'wait', 'id': 'first'}, self.test_base / 'exec.sock'))
+        self.assertEqual(replies[-1]['result']['stdout'], 'logged\n')
+        self.assertEqual(os.listdir(self.test_base / 'completed'), [])
+        self.assertEqual(processor.lookup_finished('first'), 'completed')
+        
+        # A crash between the result append and removing the job is not rerun
+        (self.test_base / 'running' / 'first.json').write_text('{"command": "echo"}')
+        os.utime(self.test_base / 'running' / 'first.json', (time.time() - 60,) * 2)
+        processor.recover_job(self.test_base / 'running' / 'first.json')
+        self.assertEqual(os.listdir(self.test_base / 'pending'), [])
+    
+    def test_old_segments_archived(self):
+        """Test that sealed segments past the retention age move into the archive"""
+        store = self.store(segment_bytes=256)
+        for n in range(6):
+            store.write(self.test_base / 'completed' / f'job{n}.json', self.record(n))
+        store.conn.execute("UPDATE results SET written_at = written_at - 86400 * 30")
+        store.conn.commit()
+        archive = ResultArchive(max_age=86400, results=store, log=lambda *args, **kwargs: None)
+        self.addCleanup(archive.stop)
+        self.assertGreater(len(list((self.test_base / 'results').glob('segment-*.log'))), 1)
+        
+        # Only the segment still being appended to stays
+        archived = archive.run_once()
+        self.assertEqual(len(list((self.test_base / 'results').glob('segment-*.log'))), 1)
+        self.assertEqual(archived + len(store.names()), 6)
+        self.assertEqual(json.loads(archive.fetch(name='job0.json')), self.record(0))
+        self.assertIsNone(store.read(self.test_base / 'completed' / 'job0.json'))
+        self.assertEqual(json.loads(store.read(self.test_base / 'completed' / 'job5.json')), self.record(5))
+
+class TestNodes(QueueTestCase):
+    """Tests for several processors sharing one queue through shard leases"""
+    
+    extra_patches = {'server.LEASE_TIMEOUT': 0.6}
+    
+    def start(self, node, workers=2):
+        """Run a node on a background thread until the test stops it"""
+        processor = QueueProcessor(node=node, workers=workers, api=False, archive=False)
+        self.run_processor(processor)
+        return processor
+    
+    def balanced(self, nodes):
+        """Whether the nodes have settled on an even split of every shard"""
+        held = [node.leases.held for node in nodes]
+        return (sum(map(len, held)) == server.SHARDS and
+                max(map(len, held)) - min(map(len, held)) <= 1 + server.SHARDS % len(nodes))
+    
+    def submit_many(self, count, command):
+        """Drop count shell jobs into pending/, with {name} in the command replaced by each job's name"""
+        for i in range(count):
+            name = f'job_{i:03d}.json'
+            self.submit(name, {'command': 'sh', 'args': ['-c', command.format(name=name)]})
+    
+    def test_shard_of(self):
+        """Test that shards are stable, in range and reasonably even"""
+        self.assertEqual(shard_of('job.json'), shard_of('job.json'))
+        counts = collections.Counter(shard_of(f'job_{i}.json') for i in range(1600))
+        self.assertEqual(sorted(counts), [f'{n:02x}' for n in range(16)])
+        self.assertGreater(min(counts.values()), 50)
+        self.assertEqual(shard_of('job.json', 1), '00')
+    
+    def test_parent_queued_elsewhere(self):
+        """Test that a parent still open in the shared index is pending, not missing"""
+        processor = QueueProcessor(node='a', api=False, archive=False)
+        processor.index.update('parent.json', 'queued', task_id='parent')
+        self.assertEqual(processor.lookup_finished('parent'), 'pending')
+        processor.index.update('parent.json', 'completed', finished_at=time.time())
+        self.assertEqual(processor.lookup_finished('parent'), 'completed')
+    
+    def test_leases_split_and_expire(self):
+        """Test that nodes share the shards, and a silent node's leases are taken over"""
+        a, b = ShardLeases('a'), ShardLeases('b')
+        a.heartbeat()
+        self.assertEqual(len(a.held), 16)
+        self.assertTrue(a.leads())
+        b.heartbeat()
+        a.heartbeat()
+        b.heartbeat()
+        self.assertEqual((len(a.held), len(b.held)), (8, 8))
+        self.assertFalse(a.held & b.held)
+        self.assertEqual((self.test_base / 'leases' / '00.lease').read_text(), 'a')
+        
+        # a stops heartbeating
+        old = time.time() - 5
+        for path in list((self.test_base / 'leases').iterdir()) + [self.test_base / 'nodes' / 'a.json']:
+            if path.name == 'a.json' or path.read_text() == 'a':
+                os.utime(path, (old, old))
+        self.assertEqual(b.dead_nodes(), ['a'])
+        gained, lost = b.heartbeat()
+        self.assertEqual(len(b.held), 16)
+        self.assertEqual(len(gained), 8)
+        self.assertTrue(b.leads())
+        
+        # a comes back and finds its leases gone
+        gained, lost = a.heartbeat()
+        self.assertEqual(len(lost), 8)
+        self.assertFalse(a.held & b.held)
+        b.close()
+        self.assertEqual(sorted(os.listdir(self.test_base / 'leases')), sorted(f'{s}.lease' for s in a.held))
+    
+    def test_jobs_run_exactly_once(self):
+        """Test that jobs dropped into a shared pending/ run once each, spread over the nodes"""
+        nodes = [self.start(name) for name in ('a', 'b', 'c')]
+        self.assertTrue(wait_for(lambda: self.balanced(nodes)))
+        ran = self.test_base / 'ran.log'
+        self.submit_many(60, f"echo {{name}} >> {ran}")
+        self.assertTrue(wait_for(lambda: len(os.listdir(self.test_base / 'completed')) == 60, timeout=20))
+        
+        lines = ran.read_text().split()
+        self.assertEqual(len(lines), 60)
+        self.assertEqual(len(set(lines)), 60)
+        ran_on = collections.Counter()
+        for path in (self.test_base / 'completed').iterdir():
+            with open(path) as f:
+                ran_on[json.load(f)['result']['node']] += 1
+        self.assertEqual(sorted(ran_on), ['a', 'b', 'c'])
+        self.assertEqual(list((self.test_base / 'pending').glob('*.json')), [])
+    
+    def test_throughput_scales(self):
+        """Test that three single-worker nodes finish sleeping jobs much sooner than one"""
+        elapsed = []
+        for count in (1, 3):
+            nodes = [self.start(f'{count}_{i}', workers=1) for i in range(count)]
+            self.assertTrue(wait_for(lambda: self.balanced(nodes)))
+            start = time.monotonic()
+            self.submit_many(12, 'sleep 0.15')
+            self.assertTrue(wait_for(lambda: len(os.listdir(self.test_base / 'completed')) == 12,
+                                     timeout=20))
+            elapsed.append(time.monotonic() - start)
+            for node in nodes:
+                node.stop()
+            self.assertTrue(wait_for(lambda: not any(n.leases.held for n in nodes)))
+            shutil.rmtree(self.test_base / 'completed')
+            (self.test_base / 'completed').mkdir()
+        self.assertLess(elapsed[1], elapsed[0] * 0.7)
+    
+    def test_dead_node_jobs_recovered(self):
+        """Test that a node takes over a dead node's leases and reruns its interrupted job"""
+        old = time.time() - 5
+        for dir in ['leases', 'nodes', 'running/ghost']:
+            (self.test_base / dir).mkdir(parents=True)
+        (self.test_base / 'leases' / '00.lease').write_text('ghost')
+        (self.test_base / 'nodes' / 'ghost.json').write_text('{"node": "ghost"}')
+        (self.test_base / 'running' / 'ghost' / 'cut.json').write_text('{"command": "echo", "args": ["again"]}')
+        for path in [self.test_base / 'leases' / '00.lease', self.test_base / 'nodes' / 'ghost.json',
+                     self.test_base / 'running' / 'ghost' / 'cut.json']:
+            os.utime(path, (old, old))
+        
+        node = self.start('survivor')
+        result = self.wait_result('completed', 'cut.json')['result']
+        self.assertEqual((result['stdout'], result['node']), ('again\n', 'survivor'))
+        self.assertTrue(node.leases.leads())
+        self.assertFalse((self.test_base / 'nodes' / 'ghost.json').exists())
+        self.assertEqual(sorted(os.listdir(self.test_base / 'running')), ['survivor'])
+
+class TestAdmission(QueueTestCase):
+    """Tests for queue watermarks, rejected/ and the queue status file"""
+    
+    def meta(self, n, source='default', size=100):
+        return {'id': f'job{n}', 'priority': 0, 'source': source, 'depends_on': [], 'bytes': size}
+    
+    def status(self):
+        with open(self.test_base / 'queue_status.json') as f:
+            return json.load(f)
+    
+    def test_watermarks(self):
+        """Test that a full queue sheds until it drains to the low watermark"""
+        admission, jobs = Admission(max_jobs=4, max_bytes=0, max_per_source=0, resume=0.5), PendingJobs()
+        for n in range(4):
+            self.assertIsNone(admission.check(jobs, self.meta(n)))
+            jobs[f'job{n}.json'] = self.meta(n)
+        self.assertIn('jobs limit of 4', admission.check(jobs, self.meta(4)))
+        jobs.pop('job0.json')
+        # Under the high watermark again, but not yet down to the low one
+        self.assertIsNotNone(admission.check(jobs, self.meta(4)))
+        jobs.pop('job1.json')
+        self.assertIsNone(admission.check(jobs, self.meta(4)))
+        self.assertEqual(admission.rejected, 2)
+    
+    def test_bytes_and_source_limits(self):
+        """Test the byte limit and that one noisy source cannot shut out the others"""
+        admission, jobs = Admission(max_jobs=0, max_bytes=1000, max_per_source=2), PendingJobs()
+        jobs['a.json'] = self.meta(0, 'noisy')
+        jobs['b.json'] = self.meta(1, 'noisy')
+        self.assertEqual((len(jobs), jobs.bytes, jobs.sources['noisy']), (2, 200, 2))
+        self.assertIn('source noisy limit of 2', admission.check(jobs, self.meta(2, 'noisy')))
+        self.assertIsNone(admission.check(jobs, self.meta(3, 'quiet')))
+        self.assertIn('bytes limit of 1000', admission.check(jobs, self.meta(4, 'quiet', size=900)))
+        jobs.pop('a.json')
+        jobs.pop('b.json')
+        self.assertEqual((jobs.bytes, dict(jobs.sources)), (0, {}))
+        self.assertIsNone(admission.check(jobs, self.meta(5, 'noisy')))
+    
+    def test_excess_jobs_rejected(self):
+        """Test that jobs past the high watermark move to rejected/ with a reason"""
+        with patch('server.MAX_PENDING', 3):
+            processor = QueueProcessor(api=False)
+        self.addCleanup(processor.index.close)
+        pending = self.test_base / 'pending'
+        for n in range(5):
+            (pending / f'job{n}.json').write_text('{"command": "true"}')
+        processor.apply_events([('added', pending / f'job{n}.json') for n in range(5)])
+        
+        self.assertEqual(sorted(os.listdir(pending)), ['job0.json', 'job1.json', 'job2.json'])
+        self.assertEqual(sorted(os.listdir(self.test_base / 'rejected')),
+                         ['job3.json', 'job3.json.reason', 'job4.json', 'job4.json.reason'])
+        with open(self.test_base / 'rejected' / 'job3.json.reason') as f:
+            reason = json.load(f)
+        self.assertIn('Queue full', reason['reason'])
+        self.assertEqual(reason['retry_after'], server.ADMIT_RETRY_AFTER)
+        self.assertEqual(processor.index.get('job4.json')['state'], 'rejected')
+        status = self.status()
+        self.assertEqual((status['pending'], status['accepting'], status['shedding']), (3, False, ['jobs']))
+        self.assertEqual(status['limits']['jobs'], 3)
+    
+    def test_admitted_jobs_never_rejected(self):
+        """Test that the startup backlog and recovered jobs skip the check, and new ones do not"""
+        with patch('server.MAX_PENDING', 2):
+            processor = QueueProcessor(api=False)
+        self.addCleanup(processor.index.close)
+        pending = self.test_base / 'pending'
+        for n in range(3):
+            (pending / f'old{n}.json').write_text('{"command": "true"}')
+            processor.index.update(f'old{n}.json', 'queued')
+        (self.test_base / 'running' / 'crashed.json').write_text('{"command": "true"}')
+        (pending / 'z_new.json').write_text('{"command": "true"}')
+        processor.recover_orphans()
+        processor.apply_events([('added', pending / name) for name in sorted(os.listdir(pending))])
+        
+        self.assertEqual(sorted(processor.meta), ['crashed.json', 'old0.json', 'old1.json', 'old2.json'])
+        self.assertEqual(sorted(os.listdir(self.test_base / 'rejected')), ['z_new.json', 'z_new.json.reason'])
+    
+    def test_api_reserves_capacity(self):
+        """Test that a job the API accepted holds its place until the watcher queues it"""
+        with patch('server.MAX_PENDING', 2):
+            processor = QueueProcessor(api=False)
+        self.addCleanup(processor.index.close)
+        pending = self.test_base / 'pending'
+        for name in ['a.json', 'b.json']:
+            processor.submit_job(name, {'command': 'true'})
+        self.assertEqual(len(processor.admission.reserved), 2)
+        with self.assertRaises(QueueFull):
+            processor.submit_job('c.json', {'command': 'true'})
+        (pending / 'dropped.json').write_text('{"command": "true"}')
+        processor.apply_events([('added', pending / 'dropped.json')])
+        processor.apply_events([('added', pending / 'a.json'), ('added', pending / 'b.json')])
+        
+        self.assertEqual(sorted(processor.meta), ['a.json', 'b.json'])
+        self.assertEqual(len(processor.admission.reserved), 0)
+        self.assertTrue((self.test_base / 'rejected' / 'dropped.json').exists())
+    
+    def test_api_refuses_with_retry_after(self):
+        """Test that API submissions are refused while shedding, and the status file recovers"""
+        with patch('server.MAX_PENDING', 1):
+            processor = QueueProcessor(api=True, workers=1)
+        self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: processor.api_server is not None))
+        sock = self.test_base / 'exec.sock'
+        
+        def submit(name, seconds):
+            return list(api_call({'op': 'submit', 'name': name,
+                                  'job': {'command': 'sleep', 'args': [str(seconds)]}}, sock))[-1]
+        self.assertTrue(submit('busy', 0.5)['ok'])
+        self.assertTrue(wait_for(lambda: processor.timing))
+        self.assertTrue(submit('queued', 0)['ok'])
+        self.assertTrue(wait_for(lambda: len(processor.meta) == 1))
+        reply = submit('refused', 0)
+        self.assertEqual((reply['ok'], reply['event']), (False, 'rejected'))
+        self.assertGreater(reply['retry_after'], 0)
+        self.assertTrue(wait_for(lambda: not self.status()['accepting']))
+        
+        # Drained: the trailing status write reopens the queue
+        self.assertTrue(wait_for(lambda: self.status()['pending'] == 0 and self.status()['running'] == 0))
+        self.assertTrue(self.status()['accepting'])
+        self.assertTrue(submit('refused', 0)['ok'])
+
+
+class TestCoalescing(QueueTestCase):
+    """Tests for identical jobs collapsing into one run with the result fanned out"""
+    
+    def test_dedupe_key(self):
+        """Test that coalesce hashes the argv and an explicit dedupe_key wins"""
+        key = dedupe_key({'command': 'echo hi', 'coalesce': True})
+        self.assertEqual(key, dedupe_key({'command': 'echo', 'args': ['hi'], 'coalesce': True}))
+        self.assertNotEqual(key, dedupe_key({'command': 'echo', 'args': ['ho'], 'coalesce': True}))
+        self.assertIsNone(dedupe_key({'command': 'echo hi'}))
+        self.assertIsNone(dedupe_key({'coalesce': True}))
+        self.assertEqual(dedupe_key({'command': 'sync', 'args': ['--all'], 'dedupe_key': 'sync'}), 'sync')
+        self.assertEqual(job_meta(self.submit('a.json', {'command': 'sync', 'dedupe_key': 'sync'}))
+                         ['dedupe_key'], 'sync')
+    
+    def test_coalescer(self):
+        """Test leaders, followers and promotion when a queued leader is removed"""
+        group = Coalescer()
+        meta = {'dedupe_key': 'k'}
+        self.assertIsNone(group.join('a', meta))
+        self.assertIsNone(group.join('x', {}))
+        self.assertEqual(group.join('b', meta), 'a')
+        self.assertEqual(group.join('c', meta), 'a')
+        self.assertIsNone(group.discard('b'))
+        self.assertEqual(group.discard('a'), 'c')
+        self.assertEqual(group.join('d', meta), 'c')
+        self.assertEqual(group.finish('c'), ['d'])
+        self.assertEqual((group.leaders, group.followers, group.leader_of), ({}, {}, {}))
+        self.assertEqual(group.coalesced, 3)
+    
+    def test_duplicates_share_one_run(self):
+        """Test that queued and late duplicates run once and each get a result file"""
+        processor = QueueProcessor(api=False, archive=False, workers=1)
+        self.run_processor(processor)
+        runs = self.test_base / 'runs.txt'
+        job = {'command': 'sh', 'args': ['-c', f'echo run >> {runs}; sleep 0.5; echo synced'],
+               'coalesce': True}
+        
+        # Held behind a busy worker, the duplicates are all pending together
+        self.submit('a_busy.json', {'command': 'sleep', 'args': ['0.3']})
+        self.assertTrue(wait_for(lambda: 'a_busy.json' in processor.timing))
+        for name in ('b_sync.json', 'c_sync.json', 'd_sync.json'):
+            self.submit(name, job)
+        self.assertTrue(wait_for(lambda: runs.exists()))
+        # Arriving while the run is under way attaches to it
+        self.submit('e_sync.json', job)
+        
+        names = ['b_sync.json', 'c_sync.json', 'd_sync.json', 'e_sync.json']
+        completed = self.test_base / 'completed'
+        self.assertTrue(wait_for(lambda: all((completed / name).exists() for name in names)))
+        self.assertEqual(runs.read_text(), 'run\n')
+        results = {name: self.result(name) for name in names}
+        leaders = [name for name, result in results.items() if 'coalesced_with' not in result]
+        self.assertEqual(len(leaders), 1)
+        for result in results.values():
+            self.assertEqual(result['stdout'], 'synced\n')
+            self.assertEqual(result.get('coalesced_with', leaders[0]), leaders[0])
+        self.assertEqual(processor.index.get('e_sync.json')['state'], 'completed')
+        self.assertEqual(processor.coalesce.coalesced, 3)
+        self.assertEqual(processor.coalesce.leaders, {})
+    
+    def test_removed_leader_promotes_follower(self):
+        """Test that deleting a queued leader lets its first follower run instead"""
+        processor = QueueProcessor(api=False)
+        self.addCleanup(processor.index.close)
+        job = {'command': 'true', 'dedupe_key': 'refresh'}
+        paths = [self.submit(name, job) for name in ('a.json', 'b.json')]
+        processor.apply_events([('added', path) for path in paths])
+        self.assertEqual((len(processor.pending), len(processor.meta)), (1, 2))
+        self.assertEqual(processor.index.get('b.json')['state'], 'coalesced')
+        
+        paths[0].unlink()
+        processor.apply_events([('removed', paths[0])])
+        self.assertEqual(processor.pending.pop(), 'b.json')
+        self.assertEqual(processor.index.get('b.json')['state'], 'queued')
+        self.assertEqual(processor.coalesce.leaders, {'refresh': 'b.json'})
+
+
+class TestProgress(QueueTestCase):
+    """Tests for running/<job>.progress records, ##progress lines and output tails"""
+    
+    extra_patches = {'server.PROGRESS_INTERVAL': 0.1}
+    
+    def test_parse_progress(self):
+        """Test percentages, counts, fractions and junk after the marker"""
+        self.assertEqual(parse_progress('##progress 40%')['percent'], 40)
+        progress = parse_progress('##progress 3/12 files indexed')
+        self.assertEqual((progress['done'], progress['total'], progress['percent'], progress['message']),
+                         (3, 12, 25, 'files indexed'))
+        self.assertEqual(parse_progress('##progress 0.5')['percent'], 50)
+        self.assertEqual(parse_progress('##progress 250%')['percent'], 100)
+        self.assertIsNone(parse_progress('##progress'))
+        self.assertIsNone(parse_progress('##progress soon'))
+    
+    def test_scan_across_chunks(self):
+        """Test that a marker split between reads is found and over-long lines are skipped"""
+        sink = OutputSink(self.test_base / 'out')
+        progress = JobProgress(self.test_base / 'job.progress', 'job.json', os.getpid(), {'stdout': sink})
+        progress.scan(b'starting\n##prog')
+        self.assertIsNone(progress.reported)
+        progress.scan(b'ress 50% half way\nmore')
+        self.assertEqual((progress.reported['percent'], progress.reported['message']), (50, 'half way'))
+        progress.scan(b'x' * (server.PROGRESS_LINE_MAX + 1))
+        progress.scan(b'##progress 10%\n##progress 60%\n')
+        self.assertEqual(progress.reported['percent'], 60)
+        self.assertEqual(progress.partial, b'')
+    
+    def test_utf8_prefix(self):
+        """Test that a tail never ends inside a multi-byte character"""
+        text = 'a\u00e9\u20ac'.encode()
+        self.assertEqual(utf8_prefix(text), text)
+        self.assertEqual(utf8_prefix(text[:2]), b'a')
+        self.assertEqual(utf8_prefix(text[:4]), 'a\u00e9'.encode())
+        self.assertEqual(utf8_prefix(text[:5]), 'a\u00e9'.encode())
+        self.assertEqual(utf8_prefix(b''), b'')
+    
+    def test_process_usage(self):
+        """Test CPU and RSS readings for a live process, from /proc and from ps"""
+        usage = process_usage(os.getpid())
+        self.assertGreater(usage['rss_bytes'], 0)
+        self.assertGreaterEqual(usage['cpu_seconds'], 0)
+        if shutil.which('ps'):
+            self.assertGreater(ps_usage(os.getpid())['rss_bytes'], 0)
+        child = subprocess.Popen(['true'])
+        child.wait()
+        self.assertIsNone(process_usage(child.pid))
+    
+    def check_live_progress(self, engine):
+        """Run a slow job that reports progress and check its record, tails and result"""
+        processor = engine(api=True, workers=1, archive=False)
+        self.run_processor(processor)
+        self.assertTrue(wait_for(lambda: processor.api_server is not None))
+        sock = self.test_base / 'exec.sock'
+        script = 'echo start; echo "##progress 2/5 chunks"; echo oops >&2; sleep 0.6; echo done'
+        list(api_call({'op': 'submit', 'name': 'slow',
+                       'job': {'command': 'sh', 'args': ['-c', script]}}, sock))
+        record_path = self.test_base / 'running' / 'slow.json.progress'
+        self.assertTrue(wait_for(lambda: record_path.exists()))
+        self.assertTrue(wait_for(lambda: 'progress' in json.loads(record_path.read_text())))
+        record = json.loads(record_path.read_text())
+        self.assertEqual((record['id'], record['state']), ('slow.json', 'running'))
+        self.assertEqual(record['progress']['percent'], 40)
+        self.assertGreater(record['stdout_bytes'], 0)
+        self.assertGreater(record['rss_bytes'], 0)
+        self.assertIn('cpu_seconds', record)
+        # The spool starts with the first byte, so the file record can be read by offset
+        self.assertTrue(Path(record['stdout_file']).read_bytes().startswith(b'start\n'))
+        
+        reply = next(api_call({'op': 'tail', 'id': 'slow'}, sock))
+        self.assertEqual((reply['state'], reply['offset']), ('running', 0))
+        self.assertTrue(reply['data'].startswith('start\n'))
+        offset = reply['next_offset']
+        reply = next(api_call({'op': 'tail', 'id': 'slow', 'stream': 'stderr'}, sock))
+        self.assertEqual(reply['data'], 'oops\n')
+        live = next(api_call({'op': 'progress', 'id': 'slow'}, sock))
+        self.assertEqual((live['event'], live['state']), ('progress', 'running'))
+        
+        result = list(api_call({'op': 'wait', 'id': 'slow'}, sock))[-1]['result']
+        self.assertEqual(result['progress']['done'], 2)
+        self.assertEqual(result['stdout'], 'start\n##progress 2/5 chunks\ndone\n')
+        # Output that fits in the result is not left spooled beside it
+        self.assertNotIn('stdout_file', result)
+        self.assertEqual(sorted(os.listdir(self.test_base / 'completed')), ['slow.json'])
+        self.assertFalse(record_path.exists())
+        reply = next(api_call({'op': 'tail', 'id': 'slow', 'offset': offset}, sock))
+        self.assertEqual((reply['state'], reply['data']), ('completed', 'done\n'))
+        self.assertEqual(next(api_call({'op': 'progress', 'id': 'slow'}, sock))['state'], 'completed')
+    
+    def test_live_progress(self):
+        """Test progress records and tails with worker threads"""
+        self.check_live_progress(QueueProcessor)
+    
+    def test_live_progress_async(self):
+        """Test progress records and tails with the asyncio engine"""
+        self.check_live_progress(AsyncQueueProcessor)
+
+
+class TestCommandModel(QueueTestCase):
+    """Tests for argv/shell/cwd/env/stdin jobs and spawning text jobs without /bin/sh"""
+    
+    def run_jobs(self, engine, jobs):
+        """Run {name: job} on a processor and return {name: result block}"""
+        self.run_processor(engine(api=False, archive=False, workers=2))
+        for name, job in jobs.items():
+            self.submit(name, job)
+        names = [name if name.endswith('.json') else f"{Path(name).stem}_result.json" for name in jobs]
+        done = lambda: all((self.test_base / 'completed' / name).exists() or
+                           (self.test_base / 'failed' / name).exists() for name in names)
+        self.assertTrue(wait_for(done))
+        return {job_name: self.result(name) for job_name, name in zip(jobs, names)}
+    
+    def test_job_command(self):
+        """Test argv, shell and shlex-split command strings, and malformed commands"""
+        self.assertEqual(job_command({'argv': ['printf', '%s', 'a b']}), ['printf', '%s', 'a b'])
+        self.assertEqual(job_command({'shell': 'ls | wc -l'}), 'ls | wc -l')
+        self.assertEqual(job_command({'command': "python3 'my script.py' -v"}),
+                         ['python3', 'my script.py', '-v'])
+        self.assertEqual(job_command({'command': 'echo', 'args': ['a b']}), ['echo', 'a b'])
+        for bad in [{'argv': []}, {'argv': 'ls'}, {'argv': ['ls', 1]}, {'shell': ['ls']},
+                    {'shell': ' '}, {'command': "echo 'open"}, {'cwd': '/tmp'}]:
+            with self.assertRaises(ValueError, msg=bad):
+                job_command(bad)
+    
+    def test_spawn_options(self):
+        """Test cwd expansion, env layered over the server's, and type checks"""
+        self.assertEqual(spawn_options({'argv': ['true']}), {})
+        with patch.dict(os.environ, {'KEEP': '1', 'DROP': '2'}):
+            options = spawn_options({'cwd': '~', 'env': {'ADDED': 'x', 'DROP': None}, 'stdin': 'in'})
+        self.assertEqual(options['cwd'], os.path.expanduser('~'))
+        self.assertEqual((options['env']['KEEP'], options['env']['ADDED']), ('1', 'x'))
+        self.assertNotIn('DROP', options['env'])
+        self.assertEqual(options['stdin'], 'in')
+        for bad in [{'cwd': 1}, {'env': ['A=1']}, {'env': {'A': 1}}, {'stdin': 5}]:
+            with self.assertRaises(ValueError, msg=bad):
+                spawn_options(bad)
+    
+    def test_direct_argv(self):
+        """Test which text job lines skip the shell"""
+        self.assertEqual(direct_argv('ls -la /tmp'), ['ls', '-la', '/tmp'])
+        self.assertEqual(direct_argv('grep "a b" file.txt'), ['grep', 'a b', 'file.txt'])
+        for line in ['ls | wc -l', 'sleep 1 && date', 'cat $HOME/x', 'ls *.log', 'ls > out',
+                     'A=1 env', 'cd /tmp', 'echo hi', 'no-such-program-here', "echo 'open", '']:
+            self.assertIsNone(direct_argv(line), line)
+    
+    def check_command_model(self, engine):
+        """Run argv, shell, quoted-command and text jobs on an engine and check their output"""
+        work = self.test_base / 'work dir'
+        work.mkdir()
+        probe = 'import os, sys; print(os.getcwd()); print(os.environ.get("GREETING")); print(sys.stdin.read())'
+        results = self.run_jobs(engine, {
+            'env.json': {'argv': ['python3', '-c', probe], 'cwd': str(work),
+                         'env': {'GREETING': 'hi'}, 'stdin': 'fed'},
+            'quiet.json': {'argv': ['python3', '-c', 'import sys; print(repr(sys.stdin.read()))']},
+            'shell.json': {'shell': 'echo abc | tr a-c x-z'},
+            'quoted.json': {'command': "printf '%s|' 'a b' c"},
+            'nowhere.json': {'argv': ['true'], 'cwd': str(self.test_base / 'missing')},
+            'unbalanced.json': {'command': "echo 'open", 'retries': 2},
+            'direct.txt': 'printf %s, one "two three"',
+            'piped.txt': 'echo text | tr a-z A-Z',
+        })
+        self.assertEqual(results['env.json']['stdout'], f"{work}\nhi\nfed\n")
+        # Jobs without stdin read /dev/null instead of the server's stdin
+        self.assertEqual(results['quiet.json']['stdout'], "''\n")
+        self.assertEqual(results['shell.json']['stdout'], 'xyz\n')
+        self.assertEqual(results['quoted.json']['stdout'], 'a b|c|')
+        self.assertEqual(results['nowhere.json']['status'], 'failed')
+        self.assertIn('missing', results['nowhere.json']['error'])
+        # A malformed command is a normal failed result, not retried
+        self.assertEqual(results['unbalanced.json']['status'], 'failed')
+        self.assertTrue(results['unbalanced.json']['error'].startswith('Invalid command: '))
+        self.assertNotIn('attempts', results['unbalanced.json'])
+        self.assertEqual(results['direct.txt']['stdout'], 'one,two three,')
+        self.assertEqual(results['piped.txt']['stdout'], 'TEXT\n')
+    
+    def test_command_model(self):
+        """Test the command model with worker threads"""
+        self.check_command_model(QueueProcessor)
+    
+    def test_command_model_async(self):
+        """Test the command model with the asyncio engine"""
+        self.check_command_model(AsyncQueueProcessor)
+    
+    def test_text_job_skips_shell(self):
+        """Test that a plain text job line is exec'd directly and a shell line is not"""
+        processor = QueueProcessor(api=False, archive=False)
+        self.addCleanup(processor.index.close)
+        calls = []
+        for name, line in [('plain.txt', 'ls /'), ('shell.txt', 'ls / | head -1')]:
+            job_file = self.test_base / 'running' / name
+            job_file.write_text(line)
+            with patch.object(processor, 'execute', wraps=processor.execute) as execute:
+                self.assertEqual(processor.process_text_job(job_file), 'completed')
+            calls.append((execute.call_args[0][1], execute.call_args[1]['shell']))
+        self.assertEqual(calls, [(['ls', '/'], False), ('ls / | head -1', True)])
+    
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc')
+    def test_children_inherit_only_stdio(self):
+        """Test that no server descriptor leaks into a job, even without close_fds"""
+        probe = 'import os; print(sorted(os.listdir("/proc/self/fd"))); print(os.readlink("/proc/self/fd/0"))'
+        with patch('server.SPAWN_CLOSE_FDS', False):
+            result = self.run_jobs(QueueProcessor, {'fds.json': {'argv': ['python3', '-c', probe]}})
+        # 3 is the directory listdir() itself opened
+        self.assertEqual(result['fds.json']['stdout'], "['0', '1', '2', '3']\n/dev/null\n")
+
 if __name__ == '__main__':
     # Run with verbose output
     unittest.main(verbosity=2)